@@ -2,11 +2,11 @@
 # loads png file + _gpt4.json (or maybe optional filename schema)
 # shows to user, and asks for annotation (to adjust text)
 
-import glob
 import gradio as gr
 import json
 import os
 from PIL import Image
+from utils.storage import list_files
 
 
 file_exts = ['.png', '.jpg', '.jpeg', '.gif', '.webp']
@@ -96,7 +96,7 @@ def create_block(default_path=None, default_annotation_dir=None, default_caption
                 }[caption_type_selected]
                 path = path_input
                 #file_exts
-                image_paths = glob.glob(os.path.join(path, '*'))
+                image_paths = list_files(path)
                 image_paths = [p for p in image_paths if os.path.splitext(p)[-1] in file_exts]
                 # remove if no caption
                 image_paths = [p for p in image_paths if os.path.exists(p.replace(os.path.splitext(p)[-1], caption_ext))]
@@ -134,7 +134,7 @@ def create_block(default_path=None, default_annotation_dir=None, default_caption
                 outputs=[show_image, annotation_text_box, reference_text_box, sanity_checkbox],
             )
             def save(image_path, image, caption_index, annotation_dir, annotation_text):
-                image_paths = glob.glob(os.path.join(image_path, '*'))
+                image_paths = list_files(image_path)
                 image_paths = [p for p in image_paths if os.path.splitext(p)[-1] in file_exts]
                 image_paths.sort()
                 save_captions(image_paths[int(caption_index)], annotation_dir, image, annotation_text)
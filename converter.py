@@ -10,6 +10,7 @@ from typing import Iterable, Optional, Union
 import requests
 import base64
 from PIL import Image
+from utils.storage import register_path
 
 class JsonSerializable(ABC):
     """
@@ -258,6 +259,7 @@ def generate_request(conversation_context:Iterable[Union[str, Image.Image]], api
         with open(dump_path, "w", encoding="utf-8") as f:
             generation_request = GenerationRequest.load(conversation_context)
             f.write(json.dumps(generation_request.json(exclude_image=True), indent=4)) # exclude image
+        register_path(dump_path) # dumps sit next to dataset images, keep sharded index current
     if proxy:
         session = requests.Session()
         if proxy_auth:
@@ -95,37 +95,67 @@ import os
 import logging
 import json
 import tqdm
+from utils.dedup import load_or_create_index
+from utils.storage import get_storage, is_sharded, list_files, register_path, resolve_path
 
 
-async def main(dir="aibooru",tags=["novelai"]):
+async def main(dir="aibooru",tags=["novelai"], dedup_index_path=None):
+    """
+    Downloads all posts with given tags.
+    If dedup_index_path is given, posts which are exact or perceptual duplicates of already indexed images are skipped,
+    and downloaded images are added to the index. (see utils/dedup.py)
+    """
     api = AIBooruAPI(base_url="https://aibooru.online")
     path = pathlib.Path(dir)
     if not path.exists():
         path.mkdir()
+    dedup_index = load_or_create_index(dedup_index_path) if dedup_index_path else None
     posts = await api.get_all_posts(tags=tags, limit=None) # coroutine
     _i = 0
     if posts:
         for post in tqdm.tqdm(posts):
             _i += 1
-            filepath = path / post.filename
+            # flat or sharded dataset folder (see utils/storage.py)
+            filepath = pathlib.Path(resolve_path(dir, post.filename))
             if not filepath.exists():
+                if dedup_index is not None and dedup_index.has_md5(post.md5):
+                    logging.info(f"Skipping {post.filename}, exact duplicate of {dedup_index.md5s[post.md5]}")
+                    continue
                 try:
                     media_data = await post.get_media()
                 except Exception as exception:
                     logging.error(f"Failed to download {post.filename} from {post.link} due to {exception}")
                     continue
+                if dedup_index is not None:
+                    try:
+                        duplicates = dedup_index.find_duplicates(media_data)
+                    except Exception as exception:
+                        # not an image (video etc.), can't be hashed
+                        duplicates = []
+                    if duplicates:
+                        logging.info(f"Skipping {post.filename}, duplicate of {duplicates[0][1]} (distance {duplicates[0][0]})")
+                        continue
                 with open(filepath, "wb") as file:
                     file.write(media_data)
-            json_path = path / f"{post.md5}.json"
+                register_path(str(filepath))
+                if dedup_index is not None:
+                    try:
+                        dedup_index.add(str(filepath), md5=post.md5)
+                    except Exception as exception:
+                        logging.error(f"Failed to index {filepath} due to {exception}")
+            json_path = pathlib.Path(resolve_path(dir, f"{post.md5}.json"))
             if not json_path.exists():
                 with open(json_path, "w", encoding='utf-8') as file:
                     json.dump(post.dict(), file)
-            meta_tag_text_path = path / f"{post.md5}.txt"
+                register_path(str(json_path))
+            meta_tag_text_path = pathlib.Path(resolve_path(dir, f"{post.md5}.txt"))
             if not SKIP_TEXT_EXISTING or not meta_tag_text_path.exists():
                 generate_text_from_json(json_path)
             logging.info(f"Downloaded {post.filename}, {_i} / {len(posts)}")
     else:
         logging.error("No posts found")
+    if dedup_index is not None:
+        dedup_index.save(dedup_index_path)
 
 rating_dict = {
     "s" : "safe",
@@ -149,7 +179,7 @@ async def get_metadata_dict(dir="aibooru",tags=["novelai"]):
                 continue
             json_read = metadata_dict
             id = metadata_dict["md5"]
-            filepath = path / f"{id}.json"
+            filepath = pathlib.Path(resolve_path(dir, f"{id}.json"))
             metadata_dict_stringify = f"""
 copyright: {json_read["tag_string_copyright"]}
 character: {json_read["tag_string_character"]}
@@ -160,10 +190,12 @@ rating: {rating_dict.get([json_read["rating"]] or "unknown")}
             if not filepath.exists():
                 with open(filepath, "w", encoding='utf-8') as file:
                     json.dump(metadata_dict, file)
+                register_path(str(filepath))
                 logging.info(f"Saved metadata dict for {post.link}")
-            filepath_txt = path / f"{id}.txt"
+            filepath_txt = pathlib.Path(resolve_path(dir, f"{id}.txt"))
             with open(filepath_txt, "w", encoding='utf-8') as file:
                 file.write(metadata_dict_stringify)
+            register_path(str(filepath_txt))
             logging.info(f"Saved metadata dict for {post.link}")
     else:
         logging.error("No posts found")
@@ -175,7 +207,7 @@ def cleanup_get_txt_from_existing(dir="aibooru"):
     path = pathlib.Path(dir)
     if not path.exists():
         path.mkdir()
-    for filepath in path.glob("*.json"):
+    for filepath in list_files(dir, "*.json"):
         generate_text_from_json(filepath)
         logging.info(f"Saved metadata dict for {filepath}")
 
@@ -215,14 +247,16 @@ def generate_text_from_json(filepath):
         return
     with open(filepath.replace(".json", ".txt"), "w", encoding='utf-8') as file:
         file.write(string)
+    register_path(filepath.replace(".json", ".txt"))
 
 def create_subset(dir="aibooru", subset_dir="aibooru_subset", filter = lambda x: True, subset_size=10000, strategy="move"):
-    path = pathlib.Path(dir)
     subset_path = pathlib.Path(subset_dir)
     if not subset_path.exists():
         subset_path.mkdir()
     pbar = tqdm.tqdm(total=subset_size)
-    for filepath in path.glob("*.json"):
+    for filepath in map(pathlib.Path, list_files(dir, "*.json")):
+        if not filepath.exists():
+            continue # moved by an earlier run, index of sharded storage is stale until rebuilt below
         pbar.update(1)
         with open(filepath, "r", encoding='utf-8') as file:
             metadata_dict = json.load(file)
@@ -230,8 +264,8 @@ def create_subset(dir="aibooru", subset_dir="aibooru_subset", filter = lambda x:
             # move .json and matching another extension file
             id = metadata_dict["md5"]
             for extension in ["jpg", "jpeg", "png", "webp", "gif", "gifv", "mp4", "webm"]:
-                filepath_origin = path / f"{id}.{extension}"
-                if filepath.exists():
+                filepath_origin = pathlib.Path(resolve_path(dir, f"{id}.{extension}"))
+                if filepath_origin.exists():
                     break
             # move json and file
             if filepath_origin.exists():
@@ -249,6 +283,8 @@ def create_subset(dir="aibooru", subset_dir="aibooru_subset", filter = lambda x:
             else:
                 logging.error(f"Failed to find file for {filepath}")
                 continue
+    if is_sharded(dir):
+        get_storage(dir).rebuild_index() # drop moved files from the index
 
 def translate_tags(tag_json):
     # 0 general tags
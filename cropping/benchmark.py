@@ -0,0 +1,46 @@
+"""
+Compares detection throughput (images/sec) across backends and batch sizes on a fixed local image set.
+Models ending with .onnx run on the CPU backend, others on ultralytics.
+
+Usage:
+    python benchmark.py --image-path /data/bench --limit 256 --models yolov8n.pt yolov8n.onnx yolov8n-int8.onnx --batch-sizes 1 8 32
+"""
+import argparse
+import glob
+import os
+import time
+from crop_yolov8 import detect, load_detector
+
+def benchmark(image_paths, model, batch_size:int, cuda_device:int = 0, max_infer_size:int = 640, decode_workers:int = 2, cpu_threads:int = 1):
+    """
+    Returns images/sec of detect over image_paths, after one warmup minibatch (cudnn / onnx runtime first run).
+    model is loaded once here if given as name, so neither run times model load or graph optimization.
+    """
+    if isinstance(model, str):
+        model = load_detector(model, cuda_device, max_infer_size, cpu_threads=cpu_threads)
+    detect(image_paths[:batch_size], cuda_device, model, batch_size, max_infer_size=max_infer_size, decode_workers=decode_workers, cpu_threads=cpu_threads)
+    start = time.perf_counter()
+    results = detect(image_paths, cuda_device, model, batch_size, max_infer_size=max_infer_size, decode_workers=decode_workers, cpu_threads=cpu_threads)
+    elapsed = time.perf_counter() - start
+    return len(results) / elapsed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--image-path', type=str, required=True, help='folder with benchmark images')
+    parser.add_argument('--limit', type=int, default=256, help='number of images, first files in sorted order')
+    parser.add_argument('--models', type=str, nargs='+', default=['yolov8n.pt', 'yolov8n.onnx'], help='models to compare')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 8, 32], help='batch sizes to compare')
+    parser.add_argument('--cuda-device', type=int, default=0, help='cuda device for ultralytics models')
+    parser.add_argument('--max-infer-size', type=int, default=640, help='inference size')
+    parser.add_argument('--decode-workers', type=int, default=2, help='decoding threads')
+    parser.add_argument('--cpu-threads', type=int, default=os.cpu_count(), help='onnx runtime threads')
+    args = parser.parse_args()
+    image_paths = sorted(path for ext in ('jpg', 'jpeg', 'png', 'webp') for path in glob.glob(os.path.join(args.image_path, f'*.{ext}')))[:args.limit]
+    print(f'benchmarking on {len(image_paths)} images')
+    print(f'{"model":<32}{"batch size":>12}{"images/sec":>12}')
+    for model in args.models:
+        # loaded once, shared by all batch sizes
+        detector = load_detector(model, args.cuda_device, args.max_infer_size, cpu_threads=args.cpu_threads)
+        for batch_size in args.batch_sizes:
+            throughput = benchmark(image_paths, detector, batch_size, args.cuda_device, args.max_infer_size, args.decode_workers, args.cpu_threads)
+            print(f'{model:<32}{batch_size:>12}{throughput:>12.2f}')
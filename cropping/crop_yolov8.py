@@ -1,86 +1,205 @@
+from collections import deque
 from typing import List
-from ultralytics import YOLO
-from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from PIL import Image
 import os
 import argparse
 import numpy as np
 import glob
+import json
 from tqdm import tqdm
 import logging
+import multiprocessing
+import time
 
 logging_path = 'detect.log'
 logging.basicConfig(filename=logging_path, level=logging.ERROR)
 
-def active_preprocessor(imgs, batch_size=1):
+def _load_rgb(path):
+    with Image.open(path) as image:
+        return image.convert("RGB")
+
+def active_preprocessor(imgs, batch_size=1, workers=1, prefetch=2):
     """
     Generator, but actively preprocesses images and return as prepared
+    Images are decoded by workers threads, at most prefetch minibatches are decoded ahead of the consumer.
+    Images which fail to decode are logged and left out of the minibatch.
     :param imgs: image paths
+    :return: yields (paths, images) per minibatch
+    """
+    minibatches = [imgs[i:i + batch_size] for i in range(0, len(imgs), batch_size)]
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as pooling_executor:
+        for minibatch in minibatches:
+            # handle Image.open in threads, one future per image so workers share a minibatch
+            pending.append((minibatch, [pooling_executor.submit(_load_rgb, img) for img in minibatch]))
+            if len(pending) > prefetch:
+                yield _collect_minibatch(*pending.popleft())
+        while pending:
+            yield _collect_minibatch(*pending.popleft())
+
+def _collect_minibatch(paths, futures):
+    loaded_paths, images = [], []
+    for path, future in zip(paths, futures):
+        try:
+            images.append(future.result())
+            loaded_paths.append(path)
+        except Exception as exception:
+            logging.error(f'Exception occured while decoding {path}: {exception}')
+    return loaded_paths, images
+
+def auto_batch_size(imgs, memory_budget_mb:int = 2048, max_infer_size:int = 640, prefetch:int = 2, max_batch_size:int = 64, sample:int = 64):
+    """
+    Picks batch size from image resolutions, sizes are read from headers of a sample of images (no decode).
+    Decoded RGB image and letterboxed float input are counted per image,
+    (prefetch + 2) minibatches are alive at once: prefetched, in inference, being cropped.
+    """
+    step = max(1, len(imgs) // sample)
+    pixels = []
+    for path in imgs[::step][:sample]:
+        try:
+            with Image.open(path) as image:
+                pixels.append(image.size[0] * image.size[1])
+        except Exception:
+            continue
+    if not pixels:
+        return 1
+    # 95th percentile, large outliers should not run out of memory
+    per_image = np.percentile(pixels, 95) * 3 + max_infer_size * max_infer_size * 3 * 4
+    batch_size = int(memory_budget_mb * 1024 * 1024 // (per_image * (prefetch + 2)))
+    return max(1, min(batch_size, max_batch_size, len(imgs)))
+
+def load_detector(model:str, cuda_device=0, max_infer_size=640, conf_threshold=0.3, iou_threshold=0.5, cpu_threads:int=1,
+                  cascade_on_crops:bool=True, cascade_classes=(0,)):
+    """
+    Loads ultralytics model, or OnnxDetector on CPU for .onnx models.
+    For .onnx models cuda_device is the cpu worker index, the process is pinned to its cpu_threads cores.
+    Comma separated models load a CascadeDetector, e.g. 'yolov8n.pt,yolov8n-face.pt'.
+    """
+    if ',' in model:
+        detectors = [load_detector(name, cuda_device, max_infer_size, conf_threshold, iou_threshold, cpu_threads) for name in model.split(',')]
+        return CascadeDetector(detectors, [os.path.basename(name) for name in model.split(',')], cascade_on_crops, cascade_classes)
+    if model.endswith('.onnx'):
+        from onnx_backend import OnnxDetector, pin_threads
+        pin_threads(int(cuda_device), cpu_threads)
+        return OnnxDetector(model, max_infer_size, conf_threshold, iou_threshold, cpu_threads)
+    from ultralytics import YOLO
+    os.environ['CUDA_VISIBLE_DEVICES'] = str(cuda_device)
+    return YOLO(model) #YOLO('yolov8n-face.pt') # for face only
+
+def _boxes_as_lists(r, offset=(0, 0)):
+    xyxy = r.boxes.xyxy.cpu().numpy() + np.array([offset[0], offset[1], offset[0], offset[1]], dtype=np.float32)
+    return xyxy, r.boxes.cls.cpu().numpy(), r.boxes.conf.cpu().numpy()
+
+class CascadeResult:
     """
-    pooling_executor = ThreadPoolExecutor(max_workers=1)
-    futures = []
-    # split imgs into minibatch
-    divmod_result = divmod(len(imgs), batch_size)
-    batch_count = divmod_result[0]
-    if divmod_result[1] != 0:
-        batch_count += 1
-    minibatches = []
-    for i in range(batch_count):
-        minibatches.append(imgs[i*batch_size:min((i+1)*batch_size, len(imgs))])
-    for minibatch in minibatches:
-        # handle Image.open in thread
-        futures.append(pooling_executor.submit(lambda x: [Image.open(img).convert("RGB") for img in x], minibatch))
-    for future in futures:
-        yield future.result()
-
-def detect(imgs, cuda_device=0, model='yolov8n.pt', batch_size=-1,stream:bool=False, max_infer_size=640, conf_threshold=0.3, iou_threshold=0.5):
+    Result of CascadeDetector for one image. boxes are the first stage boxes, so cropping works as with a single model.
+    hierarchy is a list of first stage detections, each with 'children' of later stages found inside its crop,
+    full_image holds later stage detections over the whole image when they do not run on crops.
+    """
+    def __init__(self, first, hierarchy, full_image):
+        self.boxes = first.boxes
+        self.hierarchy = hierarchy
+        self.full_image = full_image
+
+class CascadeDetector:
+    """
+    Runs several detectors over one decoded minibatch, callable like ultralytics YOLO.
+    :param on_crops: later stages run only on crops of first stage boxes of classes, batched over the minibatch
+    """
+    def __init__(self, detectors, names, on_crops:bool=True, classes=(0,)):
+        self.detectors = detectors
+        self.names = names
+        self.on_crops = on_crops
+        self.classes = set(classes)
+
+    def __call__(self, images, verbose=False, **kwargs):
+        first_results = self.detectors[0](images, verbose=verbose, **kwargs)
+        hierarchies, full_images = [], [dict() for _ in images]
+        crops, parents = [], []
+        for i, (image, r) in enumerate(zip(images, first_results)):
+            hierarchy = []
+            for box, cls, conf in zip(*_boxes_as_lists(r)):
+                node = {'box': [round(float(v), 1) for v in box], 'class': int(cls), 'confidence': round(float(conf), 4),
+                        'model': self.names[0], 'children': []}
+                hierarchy.append(node)
+                if self.on_crops and int(cls) in self.classes:
+                    crops.append(image.crop(box.tolist()))
+                    parents.append((node, (float(box[0]), float(box[1]))))
+            hierarchies.append(hierarchy)
+        for name, detector in zip(self.names[1:], self.detectors[1:]):
+            if self.on_crops:
+                # all crops of the minibatch in one call, boxes are mapped back to image coordinates
+                results = detector(crops, verbose=verbose, **kwargs) if crops else []
+                for (node, offset), r in zip(parents, results):
+                    for box, cls, conf in zip(*_boxes_as_lists(r, offset)):
+                        node['children'].append({'box': [round(float(v), 1) for v in box], 'class': int(cls),
+                                                 'confidence': round(float(conf), 4), 'model': name})
+            else:
+                for full_image, r in zip(full_images, detector(images, verbose=verbose, **kwargs)):
+                    full_image[name] = [{'box': [round(float(v), 1) for v in box], 'class': int(cls), 'confidence': round(float(conf), 4)}
+                                        for box, cls, conf in zip(*_boxes_as_lists(r))]
+        return [CascadeResult(r, hierarchy, full_image) for r, hierarchy, full_image in zip(first_results, hierarchies, full_images)]
+
+def detect(imgs, cuda_device=0, model='yolov8n.pt', batch_size=0,stream:bool=False, max_infer_size=640, conf_threshold=0.3, iou_threshold=0.5,
+           with_images:bool=False, decode_workers:int=2, prefetch:int=2, memory_budget_mb:int=2048, cpu_threads:int=1):
+    """
+    Runs detection over image paths.
+    :param batch_size: minibatch size, 0 picks it from image resolutions and memory_budget_mb, -1 means all images at once
+    :param with_images: yield (path, decoded RGB image, result), so the caller can reuse the decode
+    :param decode_workers: threads decoding images
+    :param prefetch: minibatches decoded ahead of inference
+    :param cpu_threads: threads of onnx runtime for .onnx models
+    :param model: model name, or detector from load_detector to reuse a loaded model
+    """
+    results = _detect_iter(imgs, cuda_device, model, batch_size, max_infer_size, conf_threshold, iou_threshold,
+                           with_images, decode_workers, prefetch, memory_budget_mb, cpu_threads)
+    return results if stream else list(results)
+
+def _detect_iter(imgs, cuda_device, model, batch_size, max_infer_size, conf_threshold, iou_threshold,
+                 with_images, decode_workers, prefetch, memory_budget_mb, cpu_threads):
     try:
         if not len(imgs):
-            return []
-        thread_pool = ThreadPoolExecutor(max_workers=1) # 1 thread per device, allows asynchronous execution and preprocessing
-        os.environ['CUDA_VISIBLE_DEVICES'] = str(cuda_device)
-        model = YOLO(model) #YOLO('yolov8n-face.pt') # for face only
-        model.conf = conf_threshold
-        model.iou = iou_threshold
-        model.imgsz = max_infer_size
-        result_list = []
+            return
+        if isinstance(model, str):
+            model = load_detector(model, cuda_device, max_infer_size, conf_threshold, iou_threshold, cpu_threads)
+        # thresholds are predict arguments, attributes on the model are not read by ultralytics
+        predict_kwargs = dict(verbose=False, conf=conf_threshold, iou=iou_threshold, imgsz=max_infer_size)
         if batch_size == -1:
             batch_size = len(imgs)
+        elif batch_size == 0:
+            batch_size = auto_batch_size(imgs, memory_budget_mb, max_infer_size, prefetch)
         else:
             batch_size = min(batch_size, len(imgs))
-        # split imgs into minibatch
-        divmod_result = divmod(len(imgs), batch_size)
-        batch_count = divmod_result[0]
-        if divmod_result[1] != 0:
-            batch_count += 1
-        minibatches_provider = active_preprocessor(imgs, batch_size)
-        futures = []
-        for minibatch in tqdm(minibatches_provider, desc=f'minibatch with device {cuda_device}', total=batch_count):
-            # print(f"handling {minibatch}") # debug once
-            #result_list.extend(model(minibatch))
-            # send to thread and get future, do not block
-            # verbose=False
-            futures.append(thread_pool.submit(model, minibatch, verbose=False))
-        # wait for all futures
-        for future in tqdm(futures, desc=f'Waiting for futures with device {cuda_device}'):
-            try:
-                if stream:
-                    # wait for each future
-                    #print("Yielding")
-                    yield from future.result()
-                else:
-                    result_list.extend(future.result())
-            except Exception as execption:
-                if isinstance(execption, KeyboardInterrupt):
-                    raise execption
-                logging.error(f'Exception occured: {execption}')
-                continue
-        if not stream:
-            return result_list
+        batch_count = -(-len(imgs) // batch_size)
+        minibatches_provider = active_preprocessor(imgs, batch_size, decode_workers, prefetch)
+        pending = deque()
+        # 1 thread per device, allows asynchronous execution and preprocessing
+        with ThreadPoolExecutor(max_workers=1) as thread_pool:
+            for paths, minibatch in tqdm(minibatches_provider, desc=f'minibatch with device {cuda_device} (batch size {batch_size})', total=batch_count, leave=False):
+                if not minibatch:
+                    continue
+                # send to thread and get future, do not block
+                pending.append((paths, minibatch, thread_pool.submit(model, minibatch, **predict_kwargs)))
+                # one minibatch in inference while the next is submitted, the preprocessor waits for us (backpressure)
+                if len(pending) > 1:
+                    yield from _minibatch_results(*pending.popleft(), with_images)
+            while pending:
+                yield from _minibatch_results(*pending.popleft(), with_images)
     except Exception as execption:
         logging.error(f'Exception occured: {execption}')
         raise execption
 
+def _minibatch_results(paths, minibatch, future, with_images):
+    try:
+        results = future.result()
+    except Exception as execption:
+        if isinstance(execption, KeyboardInterrupt):
+            raise execption
+        logging.error(f'Exception occured: {execption}')
+        return []
+    return zip(paths, minibatch, results) if with_images else results
+
 def crop_by_person(image: Image.Image, box_xyxy: list):
     """
     Crop image by person's box
@@ -88,6 +207,9 @@ def crop_by_person(image: Image.Image, box_xyxy: list):
     :param box_xyxy: person's box
     :return: cropped images as list
     """
+    if hasattr(image, 'crop_many'):
+        # tiled.TiledImage assembles all crops in one pass over the bands
+        return image.crop_many([box.tolist() for box in box_xyxy])
     cropped_images = []
     for box in box_xyxy:
         # convert tensor to list
@@ -112,35 +234,156 @@ def save_cropped_images(image: Image.Image, box_xyxy: list, original_filepath:st
     for i, cropped_image in enumerate(cropped_images):
         cropped_image.save(os.path.join(save_dir, f'{filename_without_ext}_{i}.jpg'))
 
-def detect_and_save_cropped_images(image_paths: List[str], save_dir: str, cuda_device: int = 0, model:str = 'yolov8n.pt', idx: int = 0, batch_size: int = -1, max_infer_size: int = 640, conf_threshold: float = 0.3, iou_threshold: float = 0.5):
+def detection_record(path: str, image: Image.Image, r, model: str, conf_threshold: float, iou_threshold: float, max_infer_size: int) -> dict:
+    """
+    Detection of one image as json record, all classes are kept so crops can be chosen later (see lazy_crop.py)
+    Cascade results add 'cascade' (first stage detections with children) and 'full_image' detections of later stages.
+    """
+    record = {
+        'path': path,
+        'width': image.size[0],
+        'height': image.size[1],
+        'boxes': [[round(float(v), 1) for v in box] for box in r.boxes.xyxy.cpu().numpy()],
+        'classes': [int(c) for c in r.boxes.cls.cpu().numpy()],
+        'confidences': [round(float(c), 4) for c in r.boxes.conf.cpu().numpy()],
+        'model': ','.join(os.path.basename(name) for name in model.split(',')),
+        'conf_threshold': conf_threshold,
+        'iou_threshold': iou_threshold,
+        'max_infer_size': max_infer_size,
+    }
+    if isinstance(r, CascadeResult):
+        record['cascade'] = r.hierarchy
+        if r.full_image:
+            record['full_image'] = r.full_image
+    return record
+
+def detect_and_save_cropped_images(image_paths: List[str], save_dir: str, cuda_device: int = 0, model:str = 'yolov8n.pt', idx: int = 0, batch_size: int = 0, max_infer_size: int = 640, conf_threshold: float = 0.3, iou_threshold: float = 0.5,
+                                   writer_workers: int = 4, decode_workers: int = 2, prefetch: int = 2, memory_budget_mb: int = 2048, cpu_threads: int = 1,
+                                   output_mode: str = 'crops', detector = None, tiled: bool = False, tile_size: int = 0, tile_overlap: int = 128):
     """
     Detect person and save cropped images
     :param image_path: image path
     :param save_dir: directory to save cropped images
-    :param cuda_device: cuda device number
-    :param model: model name, 'yolov8n.pt' or 'yolov8n-face.pt'
+    :param cuda_device: cuda device number, cpu worker index for .onnx models
+    :param model: model name, 'yolov8n.pt' or 'yolov8n-face.pt', .onnx runs on CPU (see onnx_backend.py)
     :param idx: index of box to use as person box
-    :param batch_size: minibatch size, -1 means all images at once
+    :param batch_size: minibatch size, 0 means automatic from image resolutions and memory_budget_mb, -1 means all images at once
     :param max_infer_size: max inference size
     :param conf_threshold: confidence threshold
     :param iou_threshold: iou threshold
-    :return: None
+    :param decode_workers: threads decoding images
+    :param prefetch: minibatches decoded ahead of inference
+    :param memory_budget_mb: memory budget of decoded images for automatic batch size
+    :param cpu_threads: cores per cpu worker for .onnx models
+    :param writer_workers: threads encoding and writing crops, detection does not wait for them
+    :param output_mode: 'crops' writes jpg crops, 'boxes' appends detections to save_dir/detections-<device>.jsonl, 'both' does both
+    :param detector: loaded detector (load_detector) reused across calls, model is then only recorded
+    :param tiled: detect over overlapping tiles, images are decoded in bands where possible, memory_budget_mb caps peak memory
+    :param tile_size: tile size, 0 means max_infer_size
+    :param tile_overlap: overlap of neighboring tiles in pixels
+    :return: dict with processed paths, failed paths and crop count
     
     # xyxy[idx] is used for person box as index 0
     """
+    stats = {'processed': [], 'failed': [], 'crops': 0}
     if len(image_paths) == 0:
-        return
-    results = detect(image_paths, cuda_device, model, batch_size, stream=True, max_infer_size=max_infer_size, conf_threshold=conf_threshold, iou_threshold=iou_threshold)
-    for path, r in zip(image_paths, results):
-        #print(f'handling {path}')
-        #print(r.boxes)
-        image = Image.open(path).convert("RGB")
-        where_idx = r.boxes.cls.cpu().numpy() == idx # person classes # [True, False, True, ...]
-        xyxy = r.boxes.xyxy[where_idx] # [tensor([x1, y1, x2, y2]), tensor([x1, y1, x2, y2]), ...]
-        save_cropped_images(image, xyxy, path, save_dir)
+        return stats
+    # images decoded for detection are carried with the results and reused for cropping
+    if tiled:
+        if detector is None:
+            detector = load_detector(model, cuda_device, max_infer_size, conf_threshold, iou_threshold, cpu_threads)
+        results = _tiled_results(image_paths, detector, tile_size or max_infer_size, tile_overlap, memory_budget_mb,
+                                 conf=conf_threshold, iou=iou_threshold)
+    else:
+        results = detect(image_paths, cuda_device, model if detector is None else detector, batch_size, stream=True, max_infer_size=max_infer_size, conf_threshold=conf_threshold, iou_threshold=iou_threshold,
+                         with_images=True, decode_workers=decode_workers, prefetch=prefetch, memory_budget_mb=memory_budget_mb, cpu_threads=cpu_threads)
+    pending = deque()
+    detections_file = open(os.path.join(save_dir, f'detections-{cuda_device}.jsonl'), 'a', encoding='utf-8') if output_mode in ('boxes', 'both') else None
+    with ThreadPoolExecutor(max_workers=writer_workers) as writer_pool:
+        for path, image, r in results:
+            stats['processed'].append(path)
+            if detections_file is not None:
+                detections_file.write(json.dumps(detection_record(path, image, r, model, conf_threshold, iou_threshold, max_infer_size)) + '\n')
+            if output_mode == 'boxes':
+                continue
+            where_idx = r.boxes.cls.cpu().numpy() == idx # person classes # [True, False, True, ...]
+            xyxy = r.boxes.xyxy[where_idx].cpu().numpy() # [[x1, y1, x2, y2], [x1, y1, x2, y2], ...]
+            stats['crops'] += len(xyxy)
+            pending.append((path, writer_pool.submit(save_cropped_images, image, xyxy, path, save_dir)))
+            # bounded, decoded images are released once written
+            while len(pending) > writer_workers * 4 or (pending and pending[0][1].done()):
+                _wait_writer(*pending.popleft(), stats)
+        while pending:
+            _wait_writer(*pending.popleft(), stats)
+    if detections_file is not None:
+        detections_file.close()
+    # images which failed to decode or detect never reach the results
+    processed = set(stats['processed'])
+    stats['failed'].extend(path for path in image_paths if path not in processed)
+    failed = set(stats['failed'])
+    stats['processed'] = [path for path in stats['processed'] if path not in failed]
+    return stats
+
+def _tiled_results(image_paths, detector, tile_size, tile_overlap, memory_cap_mb, **predict_kwargs):
+    """
+    Yields (path, TiledImage, result) as detect(with_images=True), one image at a time, tiles of an image are batched.
+    """
+    from tiled import TiledImage, detect_tiled
+    for path in tqdm(image_paths, desc='tiled detection', leave=False):
+        try:
+            result, _ = detect_tiled(path, detector, tile_size, tile_overlap, memory_cap_mb, **predict_kwargs)
+            yield path, TiledImage(path, memory_cap_mb), result
+        except Exception as exception:
+            logging.error(f'Exception occured while detecting tiles of {path}: {exception}')
+
+def _wait_writer(path: str, future, stats: dict):
+    try:
+        future.result()
+    except Exception as exception:
+        logging.error(f'Exception occured while saving crops of {path}: {exception}')
+        stats['failed'].append(path)
+
+def read_manifest(save_dir: str) -> set:
+    """
+    Returns image paths recorded as completed in save_dir/manifest-*.txt
+    """
+    completed = set()
+    for manifest_path in glob.glob(os.path.join(save_dir, 'manifest-*.txt')):
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            completed.update(line.rstrip('\n') for line in f if line.strip())
+    return completed
+
+def device_worker(chunk_queue, save_dir: str, cuda_device: int, model: str, max_infer_size: int = 640, conf_threshold: float = 0.3,
+                  iou_threshold: float = 0.5, cpu_threads: int = 1, cascade_on_crops: bool = True, cascade_classes = (0,), **kwargs):
+    """
+    Pulls chunks of image paths from chunk_queue until None, model is loaded once per worker.
+    Completed images are appended to save_dir/manifest-<device>.txt after each chunk, so interrupted runs resume.
+    :return: dict with device, images, failed paths, crops and seconds
+    """
+    start = time.time()
+    summary = {'device': cuda_device, 'images': 0, 'failed': [], 'crops': 0, 'chunks': 0, 'seconds': 0.0}
+    detector = load_detector(model, cuda_device, max_infer_size, conf_threshold, iou_threshold, cpu_threads, cascade_on_crops, cascade_classes)
+    with open(os.path.join(save_dir, f'manifest-{cuda_device}.txt'), 'a', encoding='utf-8') as manifest:
+        while True:
+            chunk = chunk_queue.get()
+            if chunk is None:
+                break
+            stats = detect_and_save_cropped_images(chunk, save_dir, cuda_device, model, max_infer_size=max_infer_size, conf_threshold=conf_threshold,
+                                                   iou_threshold=iou_threshold, cpu_threads=cpu_threads, detector=detector, **kwargs)
+            manifest.write(''.join(path + '\n' for path in stats['processed']))
+            manifest.flush()
+            summary['images'] += len(stats['processed'])
+            summary['failed'].extend(stats['failed'])
+            summary['crops'] += stats['crops']
+            summary['chunks'] += 1
+    summary['seconds'] = time.time() - start
+    return summary
 
 def main(cuda_devices:str, image_path:str, recursive:bool, save_dir:str, batch_size:int, model:str = 'yolov8n.pt',
-        max_infer_size:int = 640, conf_threshold:float = 0.3, iou_threshold:float = 0.5):
+        max_infer_size:int = 640, conf_threshold:float = 0.3, iou_threshold:float = 0.5,
+        decode_workers:int = 2, prefetch:int = 2, memory_budget_mb:int = 2048, cpu_workers:int = 0, cpu_threads:int = 1,
+        output_mode:str = 'crops', chunk_size:int = 256, cascade_on_crops:bool = True, cascade_classes = (0,),
+        tiled:bool = False, tile_size:int = 0, tile_overlap:int = 128):
     image_exts = ['jpg', 'jpeg', 'png', 'webp']
     image_paths = []
     if not os.path.exists(save_dir):
@@ -158,22 +401,54 @@ def main(cuda_devices:str, image_path:str, recursive:bool, save_dir:str, batch_s
     # detect and save cropped images
     available_cuda_devices = cuda_devices.split(',')
     available_cuda_devices = [int(cuda_device) for cuda_device in available_cuda_devices]
-    # split image_paths into cuda_devices using numpy.array_split
-    image_paths_split = np.array_split(image_paths, len(available_cuda_devices))
+    if model.endswith('.onnx'):
+        # cpu backend, one process per cpu_threads cores
+        available_cuda_devices = list(range(cpu_workers or max(1, os.cpu_count() // cpu_threads)))
+    # resume, images in manifests were completed by earlier runs
+    completed = read_manifest(save_dir)
+    if completed:
+        image_paths = [path for path in image_paths if path not in completed]
+        print(f'{len(completed)} images completed in earlier runs, {len(image_paths)} remaining')
+    # devices pull chunks from a shared queue, faster devices take more chunks
+    manager = multiprocessing.Manager()
+    chunk_queue = manager.Queue()
+    for i in range(0, len(image_paths), chunk_size):
+        chunk_queue.put(image_paths[i:i + chunk_size])
+    for _ in available_cuda_devices:
+        chunk_queue.put(None)
     # debug with raw execution
-    #for cuda_device, image_paths in zip(available_cuda_devices, image_paths_split):
-    #    detect_and_save_cropped_images(image_paths, save_dir, cuda_device, batch_size=batch_size)
+    #device_worker(chunk_queue, save_dir, available_cuda_devices[0], model)
     #return
+    summaries, worker_errors = [], []
     try:
         with ProcessPoolExecutor(max_workers=len(available_cuda_devices)) as executor:
-            for cuda_device, image_paths in zip(available_cuda_devices, image_paths_split):
-                executor.submit(detect_and_save_cropped_images, image_paths, save_dir, cuda_device, batch_size=batch_size,model=model,
-                                max_infer_size=max_infer_size, conf_threshold=conf_threshold, iou_threshold=iou_threshold
-                                )
+            futures = {executor.submit(device_worker, chunk_queue, save_dir, cuda_device, model,
+                                       max_infer_size=max_infer_size, conf_threshold=conf_threshold, iou_threshold=iou_threshold, cpu_threads=cpu_threads,
+                                       batch_size=batch_size, decode_workers=decode_workers, prefetch=prefetch, memory_budget_mb=memory_budget_mb,
+                                       output_mode=output_mode, cascade_on_crops=cascade_on_crops, cascade_classes=cascade_classes,
+                                       tiled=tiled, tile_size=tile_size, tile_overlap=tile_overlap): cuda_device for cuda_device in available_cuda_devices}
+            for future in as_completed(futures):
+                try:
+                    summaries.append(future.result())
+                except Exception as exception:
+                    logging.error(f'Worker of device {futures[future]} failed: {exception}')
+                    worker_errors.append((futures[future], exception))
     except KeyboardInterrupt:
         executor.shutdown(wait=False)
-        print('KeyboardInterrupt')
+        print('KeyboardInterrupt, completed images are kept in manifests, run again to resume')
         exit(1)
+    for summary in sorted(summaries, key=lambda x: x['device']):
+        throughput = summary['images'] / summary['seconds'] if summary['seconds'] else 0
+        print(f"device {summary['device']}: {summary['images']} images in {summary['chunks']} chunks, {summary['crops']} crops, "
+              f"{len(summary['failed'])} failed, {throughput:.2f} images/sec")
+    failed = [path for summary in summaries for path in summary['failed']]
+    if failed:
+        print(f'{len(failed)} images failed, see {logging_path}. They are not in the manifest and are retried on the next run')
+    for cuda_device, exception in worker_errors:
+        print(f'worker of device {cuda_device} failed: {exception}')
+    if chunk_queue.qsize() > len(available_cuda_devices) - len(summaries):
+        print('some chunks were not processed, run again to resume')
+    return summaries
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -181,11 +456,26 @@ if __name__ == '__main__':
     parser.add_argument('--image-path', type=str, default='/data/dataset/', help='image path')
     parser.add_argument('--recursive', action='store_true', help='recursive')
     parser.add_argument('--save-dir', type=str, default='/data/dataset_cropped', help='directory to save cropped images')
-    parser.add_argument('--batch-size', type=int, default=-1, help='minibatch size, -1 means all images at once')
-    parser.add_argument('--model', type=str, default='yolov8n.pt', help='model name, yolov8n.pt or yolov8n-face.pt')
+    parser.add_argument('--batch-size', type=int, default=0, help='minibatch size, 0 means automatic, -1 means all images at once')
+    parser.add_argument('--model', type=str, default='yolov8n.pt', help='model name, yolov8n.pt or yolov8n-face.pt, .onnx runs on CPU, comma separated for cascade')
+    parser.add_argument('--cascade-full-image', action='store_true', help='cascade: run later models on whole images instead of first stage crops')
+    parser.add_argument('--cascade-classes', type=int, nargs='+', default=[0], help='cascade: first stage classes cropped for later models')
     parser.add_argument('--max-infer-size', type=int, default=640, help='max inference size')
     parser.add_argument('--conf-threshold', type=float, default=0.3, help='confidence threshold')
     parser.add_argument('--iou-threshold', type=float, default=0.5, help='iou threshold')
+    parser.add_argument('--decode-workers', type=int, default=2, help='decoding threads per device')
+    parser.add_argument('--prefetch', type=int, default=2, help='minibatches decoded ahead of inference')
+    parser.add_argument('--memory-budget', type=int, default=2048, help='memory budget in MB per device for automatic batch size, peak memory cap in tiled mode')
+    parser.add_argument('--cpu-workers', type=int, default=0, help='cpu worker processes for .onnx models, 0 means cores / cpu threads')
+    parser.add_argument('--cpu-threads', type=int, default=1, help='cores per cpu worker for .onnx models')
+    parser.add_argument('--tiled', action='store_true', help='detect over overlapping tiles, for very large or tall images')
+    parser.add_argument('--tile-size', type=int, default=0, help='tile size, 0 means max inference size')
+    parser.add_argument('--tile-overlap', type=int, default=128, help='overlap of neighboring tiles in pixels')
+    parser.add_argument('--chunk-size', type=int, default=256, help='images per work chunk pulled by devices')
+    parser.add_argument('--output-mode', type=str, default='crops', choices=['crops', 'boxes', 'both'], help='jpg crops, detections jsonl for lazy_crop.py, or both')
     args = parser.parse_args()
-    main(args.cuda_devices, args.image_path, args.recursive, args.save_dir, args.batch_size, args.model, args.max_infer_size, args.conf_threshold, args.iou_threshold)
+    main(args.cuda_devices, args.image_path, args.recursive, args.save_dir, args.batch_size, args.model, args.max_infer_size, args.conf_threshold, args.iou_threshold,
+         args.decode_workers, args.prefetch, args.memory_budget, args.cpu_workers, args.cpu_threads,
+         args.output_mode, args.chunk_size, not args.cascade_full_image, tuple(args.cascade_classes),
+         args.tiled, args.tile_size, args.tile_overlap)
 
@@ -0,0 +1,116 @@
+"""
+Lazy crops from detection records (crop_yolov8.py --output-mode boxes), instead of eager jpg crops.
+Crops are materialized on demand with padding and aspect ratio chosen at read time, decoded images are kept in a LRU cache.
+
+Usage:
+    python lazy_crop.py --detections /data/dataset_cropped --save-dir /data/crops_padded --padding 0.1 --aspect-ratio 0.75
+"""
+from functools import lru_cache
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+from PIL import Image
+import os
+import argparse
+import glob
+import json
+from tqdm import tqdm
+
+def load_detections(detections_path: str) -> Dict[str, dict]:
+    """
+    Loads detection records from a jsonl file or all detections-*.jsonl in a folder, keyed by image path.
+    Later records of the same image replace earlier ones.
+    """
+    files = sorted(glob.glob(os.path.join(detections_path, 'detections-*.jsonl'))) if os.path.isdir(detections_path) else [detections_path]
+    detections = {}
+    for file in files:
+        with open(file, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    detections[record['path']] = record
+    return detections
+
+def expand_box(box: Sequence[float], width: int, height: int, padding: float = 0.0, aspect_ratio: Optional[float] = None) -> Tuple[int, int, int, int]:
+    """
+    Pads box by fraction of its size, then grows the short side to aspect_ratio (width / height).
+    Ratio boxes are shifted inside the image, all boxes are clipped to it.
+    """
+    x1, y1, x2, y2 = box
+    box_width, box_height = x2 - x1, y2 - y1
+    x1, x2 = x1 - box_width * padding, x2 + box_width * padding
+    y1, y2 = y1 - box_height * padding, y2 + box_height * padding
+    if aspect_ratio:
+        box_width, box_height = x2 - x1, y2 - y1
+        if box_width / max(box_height, 1e-6) < aspect_ratio:
+            grow = (box_height * aspect_ratio - box_width) / 2
+            x1, x2 = x1 - grow, x2 + grow
+        else:
+            grow = (box_width / aspect_ratio - box_height) / 2
+            y1, y2 = y1 - grow, y2 + grow
+        # shift back inside the image to keep the ratio, clipped only if larger than the image
+        x1, x2 = x1 - min(0, x1) - max(0, x2 - width), x2 - min(0, x1) - max(0, x2 - width)
+        y1, y2 = y1 - min(0, y1) - max(0, y2 - height), y2 - min(0, y1) - max(0, y2 - height)
+    return max(0, round(x1)), max(0, round(y1)), min(width, round(x2)), min(height, round(y2))
+
+class LazyCropper:
+    """
+    Materializes crops of detection records on demand.
+    :param classes: classes to crop, None for all
+    :param min_confidence: boxes below are skipped
+    :param cache_size: decoded images kept in LRU cache, crops of one image share the decode
+    """
+    def __init__(self, detections: Dict[str, dict], classes: Optional[Sequence[int]] = (0,), min_confidence: float = 0.0,
+                 padding: float = 0.0, aspect_ratio: Optional[float] = None, cache_size: int = 32):
+        self.detections = detections
+        self.classes = set(classes) if classes is not None else None
+        self.min_confidence = min_confidence
+        self.padding = padding
+        self.aspect_ratio = aspect_ratio
+        self.load_image = lru_cache(maxsize=cache_size)(self._load_image)
+
+    @staticmethod
+    def _load_image(path: str) -> Image.Image:
+        with Image.open(path) as image:
+            return image.convert('RGB')
+
+    def boxes(self, path: str) -> List[Tuple[int, int, int, int]]:
+        """
+        Returns expanded boxes of the image, in detection order.
+        """
+        record = self.detections[path]
+        return [expand_box(box, record['width'], record['height'], self.padding, self.aspect_ratio)
+                for box, cls, confidence in zip(record['boxes'], record['classes'], record['confidences'])
+                if (self.classes is None or cls in self.classes) and confidence >= self.min_confidence]
+
+    def crops(self, path: str) -> List[Image.Image]:
+        boxes = self.boxes(path)
+        if not boxes:
+            return []
+        image = self.load_image(path)
+        return [image.crop(box) for box in boxes]
+
+    def __getitem__(self, key: Tuple[str, int]) -> Image.Image:
+        path, i = key
+        return self.load_image(path).crop(self.boxes(path)[i])
+
+    def __iter__(self) -> Iterator[Tuple[str, int, Image.Image]]:
+        """
+        Yields (path, index, crop) of all images.
+        """
+        for path in self.detections:
+            for i, crop in enumerate(self.crops(path)):
+                yield path, i, crop
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--detections', type=str, required=True, help='detections jsonl or folder with detections-*.jsonl')
+    parser.add_argument('--save-dir', type=str, required=True, help='directory to save cropped images')
+    parser.add_argument('--classes', type=int, nargs='+', default=[0], help='classes to crop')
+    parser.add_argument('--min-confidence', type=float, default=0.0, help='minimum confidence')
+    parser.add_argument('--padding', type=float, default=0.0, help='padding as fraction of box size')
+    parser.add_argument('--aspect-ratio', type=float, default=None, help='width / height of crops')
+    args = parser.parse_args()
+    os.makedirs(args.save_dir, exist_ok=True)
+    cropper = LazyCropper(load_detections(args.detections), args.classes, args.min_confidence, args.padding, args.aspect_ratio)
+    for path, i, crop in tqdm(cropper, desc='cropping'):
+        filename_without_ext = os.path.splitext(os.path.basename(path))[0]
+        crop.save(os.path.join(args.save_dir, f'{filename_without_ext}_{i}.jpg'))
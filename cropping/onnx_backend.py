@@ -0,0 +1,175 @@
+"""
+CPU detection backend: exported YOLOv8 ONNX model on onnxruntime, letterbox and NMS in numpy.
+Results mimic ultralytics Results (r.boxes.xyxy, r.boxes.cls, r.boxes.conf with .cpu().numpy()),
+so detect_and_save_cropped_images works unchanged.
+
+Export (optionally int8 dynamic quantization):
+    python onnx_backend.py --model yolov8n.pt --imgsz 640 --int8
+"""
+from typing import List, Optional, Set
+from PIL import Image
+import os
+import argparse
+import numpy as np
+
+class NumpyTensor(np.ndarray):
+    """
+    ndarray with .cpu() / .numpy(), as torch tensors in ultralytics results.
+    """
+    def cpu(self):
+        return self
+
+    def numpy(self):
+        return np.asarray(self)
+
+    def tolist(self):
+        return np.asarray(self).tolist()
+
+class Boxes:
+    def __init__(self, xyxy: np.ndarray, conf: np.ndarray, cls: np.ndarray):
+        self.xyxy = xyxy.astype(np.float32).view(NumpyTensor)
+        self.conf = conf.astype(np.float32).view(NumpyTensor)
+        self.cls = cls.astype(np.float32).view(NumpyTensor)
+
+    def __len__(self):
+        return len(self.xyxy)
+
+class Result:
+    def __init__(self, boxes: Boxes, orig_shape):
+        self.boxes = boxes
+        self.orig_shape = orig_shape
+
+def letterbox(image: Image.Image, size: int = 640, stride: int = 32, auto: bool = False):
+    """
+    Resizes keeping aspect ratio and pads to size x size (or to stride multiple if auto), pad value 114 as ultralytics.
+    Returns (CHW float32 0..1 array, ratio, (pad_x, pad_y)).
+    """
+    width, height = image.size
+    ratio = min(size / width, size / height)
+    new_width, new_height = round(width * ratio), round(height * ratio)
+    if (new_width, new_height) != (width, height):
+        image = image.resize((new_width, new_height), Image.BILINEAR)
+    target_width, target_height = (size, size)
+    if auto:
+        target_width, target_height = -(-new_width // stride) * stride, -(-new_height // stride) * stride
+    pad_x, pad_y = (target_width - new_width) // 2, (target_height - new_height) // 2
+    canvas = np.full((target_height, target_width, 3), 114, dtype=np.uint8)
+    canvas[pad_y:pad_y + new_height, pad_x:pad_x + new_width] = np.asarray(image.convert('RGB'))
+    return canvas.transpose(2, 0, 1).astype(np.float32) / 255.0, ratio, (pad_x, pad_y)
+
+def nms(boxes: np.ndarray, scores: np.ndarray, iou_threshold: float) -> np.ndarray:
+    """
+    Greedy NMS over xyxy boxes, returns kept indices sorted by score.
+    """
+    order = scores.argsort()[::-1]
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    keep = []
+    while len(order):
+        i = order[0]
+        keep.append(i)
+        rest = order[1:]
+        x1 = np.maximum(boxes[i, 0], boxes[rest, 0])
+        y1 = np.maximum(boxes[i, 1], boxes[rest, 1])
+        x2 = np.minimum(boxes[i, 2], boxes[rest, 2])
+        y2 = np.minimum(boxes[i, 3], boxes[rest, 3])
+        intersection = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+        iou = intersection / (areas[i] + areas[rest] - intersection + 1e-9)
+        order = rest[iou <= iou_threshold]
+    return np.array(keep, dtype=np.int64)
+
+def batched_nms(boxes: np.ndarray, scores: np.ndarray, classes: np.ndarray, iou_threshold: float) -> np.ndarray:
+    """
+    Class aware NMS, boxes of different classes are offset so they never overlap.
+    """
+    if not len(boxes):
+        return np.zeros(0, dtype=np.int64)
+    offsets = classes[:, None] * (boxes.max() + 1)
+    return nms(boxes + offsets, scores, iou_threshold)
+
+def postprocess(prediction: np.ndarray, conf_threshold: float, iou_threshold: float, max_det: int = 300):
+    """
+    YOLOv8 output (4 + classes, anchors) of one image -> (xyxy, conf, cls) in letterboxed coordinates.
+    """
+    prediction = prediction.T
+    scores = prediction[:, 4:]
+    classes = scores.argmax(axis=1)
+    confidences = scores[np.arange(len(scores)), classes]
+    mask = confidences > conf_threshold
+    prediction, classes, confidences = prediction[mask], classes[mask], confidences[mask]
+    xy, wh = prediction[:, :2], prediction[:, 2:4]
+    xyxy = np.concatenate([xy - wh / 2, xy + wh / 2], axis=1)
+    keep = batched_nms(xyxy, confidences, classes, iou_threshold)[:max_det]
+    return xyxy[keep], confidences[keep], classes[keep]
+
+def pin_threads(worker_index: int, threads: int) -> Optional[Set[int]]:
+    """
+    Pins current process to threads cores of its slice, Linux only. Returns pinned cores.
+    """
+    if not hasattr(os, 'sched_setaffinity'):
+        return None
+    available = sorted(os.sched_getaffinity(0))
+    start = worker_index * threads % max(1, len(available))
+    cores = set(available[start:start + threads]) or set(available)
+    os.sched_setaffinity(0, cores)
+    return cores
+
+class OnnxDetector:
+    """
+    Callable like ultralytics YOLO: detector(images, verbose=False, conf=..., iou=..., imgsz=...) -> list of Result.
+    """
+    def __init__(self, model_path: str, imgsz: int = 640, conf: float = 0.3, iou: float = 0.5, threads: int = 1):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+        input_shape = self.session.get_inputs()[0].shape
+        # static exports fix batch and size, dynamic exports have symbolic dims
+        self.static_batch = input_shape[0] if isinstance(input_shape[0], int) else None
+        self.imgsz = input_shape[2] if isinstance(input_shape[2], int) else imgsz
+        self.conf = conf
+        self.iou = iou
+
+    def __call__(self, images: List[Image.Image], verbose: bool = False, conf: float = None, iou: float = None, imgsz: int = None) -> List[Result]:
+        conf = self.conf if conf is None else conf
+        iou = self.iou if iou is None else iou
+        size = self.imgsz if self.static_batch is not None or imgsz is None else imgsz
+        letterboxed = [letterbox(image, size) for image in images]
+        batch = np.stack([array for array, _, _ in letterboxed])
+        if self.static_batch is not None:
+            outputs = [self.session.run(None, {self.input_name: batch[i:i + 1]})[0] for i in range(len(batch))]
+            predictions = np.concatenate(outputs)
+        else:
+            predictions = self.session.run(None, {self.input_name: batch})[0]
+        results = []
+        for image, prediction, (_, ratio, (pad_x, pad_y)) in zip(images, predictions, letterboxed):
+            xyxy, confidences, classes = postprocess(prediction, conf, iou)
+            # undo letterbox
+            xyxy = (xyxy - np.array([pad_x, pad_y, pad_x, pad_y], dtype=np.float32)) / ratio
+            width, height = image.size
+            xyxy = np.clip(xyxy, 0, [width, height, width, height])
+            results.append(Result(Boxes(xyxy, confidences, classes), (height, width)))
+        return results
+
+def export_onnx(model: str, imgsz: int = 640, int8: bool = False) -> str:
+    """
+    Exports ultralytics model to ONNX with dynamic batch, optionally int8 dynamic quantization. Returns model path.
+    """
+    from ultralytics import YOLO
+    onnx_path = YOLO(model).export(format='onnx', imgsz=imgsz, dynamic=True, simplify=True)
+    if not int8:
+        return onnx_path
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    int8_path = os.path.splitext(onnx_path)[0] + '-int8.onnx'
+    quantize_dynamic(onnx_path, int8_path, weight_type=QuantType.QUInt8)
+    return int8_path
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', type=str, default='yolov8n.pt', help='ultralytics model to export')
+    parser.add_argument('--imgsz', type=int, default=640, help='inference size')
+    parser.add_argument('--int8', action='store_true', help='int8 dynamic quantization')
+    args = parser.parse_args()
+    print(export_onnx(args.model, args.imgsz, args.int8))
@@ -0,0 +1,287 @@
+"""
+Tiled detection for very large or very tall images (4K+ illustrations, webtoons).
+Images are decoded in horizontal bands where the format allows (8 bit non-interlaced PNG, streamed),
+detection runs over overlapping tiles in batches and boxes are merged across tiles.
+A downscaled whole image pass, built from the same bands, catches figures larger than a tile.
+Peak memory is kept under memory_cap_mb: band and tile window, tile batch, JPEG is decoded at reduced DCT scale if needed.
+"""
+from typing import Iterator, List, Optional, Tuple
+from PIL import Image
+import io
+import logging
+import struct
+import zlib
+import numpy as np
+from onnx_backend import Boxes, Result
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4} # color type -> samples per pixel
+
+def _png_chunk(chunk_type: bytes, data: bytes) -> bytes:
+    return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', zlib.crc32(chunk_type + data))
+
+class StripReader:
+    """
+    Reads image as horizontal bands of RGB rows.
+    8 bit non-interlaced PNG is streamed: IDAT is inflated once, each band is decoded by PIL as a small PNG,
+    whose first row is the previous band's last row stored unfiltered, so filters referencing it stay exact.
+    Other formats are decoded whole, JPEG at the DCT scale fitting memory_cap_mb.
+    width, height are in decoded coordinates, scale maps them back to the original image.
+    """
+    def __init__(self, path: str, memory_cap_mb: int = 1024, band_rows: int = 256):
+        self.path = path
+        self.memory_cap = memory_cap_mb * 1024 * 1024
+        self.band_rows = band_rows
+        self.png_header = self._read_png_header()
+        if self.png_header is not None:
+            self.width, self.height = self.png_header['width'], self.png_header['height']
+            self.original_size = (self.width, self.height)
+            self.scale = 1.0
+            return
+        with Image.open(path) as image:
+            self.original_size = image.size
+            width, height = image.size
+            if image.format == 'JPEG' and width * height * 3 > self.memory_cap:
+                factor = int(np.ceil(np.sqrt(width * height * 3 / self.memory_cap)))
+                image.draft('RGB', (width // factor, height // factor))
+                logging.error(f'{path} decoded at reduced scale {image.size} to stay under memory cap')
+            self.width, self.height = image.size
+        self.scale = self.original_size[0] / self.width
+
+    def _read_png_header(self) -> Optional[dict]:
+        with open(self.path, 'rb') as f:
+            if f.read(8) != PNG_SIGNATURE:
+                return None
+            length, chunk_type = struct.unpack('>I4s', f.read(8))
+            if chunk_type != b'IHDR':
+                return None
+            width, height, bit_depth, color_type, _, _, interlace = struct.unpack('>IIBBBBB', f.read(length))
+        if bit_depth != 8 or interlace or color_type not in PNG_CHANNELS:
+            return None
+        return {'width': width, 'height': height, 'color_type': color_type}
+
+    def bands(self) -> Iterator[Tuple[int, np.ndarray]]:
+        """
+        Yields (y0, RGB rows) covering the image top to bottom without overlap.
+        """
+        if self.png_header is None:
+            with Image.open(self.path) as image:
+                if image.format == 'JPEG' and (self.width, self.height) != image.size:
+                    image.draft('RGB', (self.width, self.height))
+                pixels = np.asarray(image.convert('RGB'))
+            for y0 in range(0, self.height, self.band_rows):
+                yield y0, pixels[y0:y0 + self.band_rows]
+            return
+        yield from self._png_bands()
+
+    def _png_bands(self) -> Iterator[Tuple[int, np.ndarray]]:
+        width, color_type = self.png_header['width'], self.png_header['color_type']
+        row_bytes = width * PNG_CHANNELS[color_type] + 1 # filter byte + samples
+        band_bytes = row_bytes * self.band_rows
+        header_chunks = []
+        inflater = zlib.decompressobj()
+        buffer = bytearray()
+        previous_row = None
+        y0 = 0
+        with open(self.path, 'rb') as f:
+            f.seek(8)
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    break
+                length, chunk_type = struct.unpack('>I4s', header)
+                data = f.read(length)
+                f.seek(4, 1) # crc
+                if chunk_type in (b'PLTE', b'tRNS'):
+                    header_chunks.append(_png_chunk(chunk_type, data))
+                elif chunk_type == b'IDAT':
+                    # inflate at most one band at a time, a small IDAT may expand to gigabytes
+                    while data and y0 < self.height:
+                        buffer += inflater.decompress(data, band_bytes)
+                        data = inflater.unconsumed_tail
+                        while len(buffer) >= band_bytes and y0 < self.height:
+                            size = min(self.band_rows, self.height - y0) * row_bytes
+                            rows = bytes(buffer[:size])
+                            del buffer[:size]
+                            band, previous_row = self._decode_band(rows, previous_row, header_chunks)
+                            yield y0, band
+                            y0 += len(band)
+                elif chunk_type == b'IEND':
+                    break
+        usable = max(0, min(len(buffer) // row_bytes, self.height - y0)) * row_bytes
+        if usable:
+            band, previous_row = self._decode_band(bytes(buffer[:usable]), previous_row, header_chunks)
+            yield y0, band
+
+    def _decode_band(self, rows: bytes, previous_row: Optional[bytes], header_chunks: List[bytes]):
+        """
+        Decodes filtered rows with PIL, returns (RGB rows, last row raw samples).
+        """
+        width, color_type = self.png_header['width'], self.png_header['color_type']
+        if previous_row is not None:
+            rows = b'\x00' + previous_row + rows # filter type None
+        row_count = len(rows) // (width * PNG_CHANNELS[color_type] + 1)
+        ihdr = struct.pack('>IIBBBBB', width, row_count, 8, color_type, 0, 0, 0)
+        png = PNG_SIGNATURE + _png_chunk(b'IHDR', ihdr) + b''.join(header_chunks) + _png_chunk(b'IDAT', zlib.compress(rows, 0)) + _png_chunk(b'IEND', b'')
+        with Image.open(io.BytesIO(png)) as image:
+            image.load()
+            last_row = image.crop((0, row_count - 1, width, row_count)).tobytes()
+            band = np.asarray(image.convert('RGB'))
+        if previous_row is not None:
+            band = band[1:]
+        return band, last_row
+
+def _positions(total: int, tile: int, step: int) -> List[int]:
+    """
+    Tile origins covering total, last tile is aligned to the end.
+    """
+    if total <= tile:
+        return [0]
+    positions = list(range(0, total - tile + 1, step))
+    if positions[-1] + tile < total:
+        positions.append(total - tile)
+    return positions
+
+def iter_tiles(reader: StripReader, tile_size: int, overlap: int, thumbnail_size: int = 0):
+    """
+    Yields (x0, y0, RGB tile) of overlapping tiles, a rolling window of tile_size rows is kept from the bands.
+    If thumbnail_size, the downscaled whole image is built from the same bands and yielded last as (None, None, thumbnail).
+    """
+    step = max(1, tile_size - overlap)
+    tile_height = min(tile_size, reader.height)
+    y_positions = _positions(reader.height, tile_size, step)
+    x_positions = _positions(reader.width, tile_size, step)
+    ratio = thumbnail_size / max(reader.width, reader.height) if thumbnail_size else 0
+    thumbnail = np.zeros((max(1, round(reader.height * ratio)), max(1, round(reader.width * ratio)), 3), dtype=np.uint8) if ratio else None
+    window = np.zeros((0, reader.width, 3), dtype=np.uint8)
+    window_y0 = 0
+    bands = reader.bands()
+    for y0 in y_positions:
+        while window_y0 + len(window) < y0 + tile_height:
+            band_y0, band = next(bands, (None, None))
+            if band is None:
+                logging.error(f'{reader.path} ended before {reader.height} rows')
+                return
+            if thumbnail is not None:
+                top, bottom = round(band_y0 * ratio), round((band_y0 + len(band)) * ratio)
+                if bottom > top:
+                    thumbnail[top:bottom] = np.asarray(Image.fromarray(band).resize((thumbnail.shape[1], bottom - top), Image.BILINEAR))
+            window = np.concatenate([window, band]) if len(window) else band
+        # drop rows above the tile
+        window = window[y0 - window_y0:]
+        window_y0 = y0
+        for x0 in x_positions:
+            yield x0, y0, window[:tile_height, x0:x0 + tile_size]
+    if thumbnail is not None:
+        # rest of the bands only feed the thumbnail
+        for band_y0, band in bands:
+            top, bottom = round(band_y0 * ratio), round((band_y0 + len(band)) * ratio)
+            if bottom > top:
+                thumbnail[top:bottom] = np.asarray(Image.fromarray(band).resize((thumbnail.shape[1], bottom - top), Image.BILINEAR))
+        yield None, None, thumbnail
+
+def merge_boxes(xyxy: np.ndarray, scores: np.ndarray, classes: np.ndarray, ios_threshold: float = 0.6):
+    """
+    Greedy merge across tiles: boxes of the same class whose intersection over the smaller box exceeds ios_threshold
+    are merged into the higher scored box (union), so pieces of a figure cut by tile borders become one box.
+    """
+    order = scores.argsort()[::-1]
+    xyxy, scores, classes = xyxy[order].copy(), scores[order], classes[order]
+    areas = (xyxy[:, 2] - xyxy[:, 0]) * (xyxy[:, 3] - xyxy[:, 1])
+    alive = np.ones(len(xyxy), dtype=bool)
+    for i in range(len(xyxy)):
+        if not alive[i]:
+            continue
+        rest = np.where(alive & (classes == classes[i]))[0]
+        rest = rest[rest > i]
+        if not len(rest):
+            continue
+        x1 = np.maximum(xyxy[i, 0], xyxy[rest, 0])
+        y1 = np.maximum(xyxy[i, 1], xyxy[rest, 1])
+        x2 = np.minimum(xyxy[i, 2], xyxy[rest, 2])
+        y2 = np.minimum(xyxy[i, 3], xyxy[rest, 3])
+        intersection = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+        merged = rest[intersection / (np.minimum(areas[i], areas[rest]) + 1e-9) > ios_threshold]
+        if len(merged):
+            xyxy[i, :2] = np.minimum(xyxy[i, :2], xyxy[merged, :2].min(axis=0))
+            xyxy[i, 2:] = np.maximum(xyxy[i, 2:], xyxy[merged, 2:].max(axis=0))
+            areas[i] = (xyxy[i, 2] - xyxy[i, 0]) * (xyxy[i, 3] - xyxy[i, 1])
+            alive[merged] = False
+    return xyxy[alive], scores[alive], classes[alive]
+
+def detect_tiled(path: str, detector, tile_size: int = 640, overlap: int = 128, memory_cap_mb: int = 1024,
+                 ios_threshold: float = 0.6, global_pass: bool = True, **predict_kwargs) -> Tuple[Result, Tuple[int, int]]:
+    """
+    Detects over overlapping tiles of the image, tiles are batched as memory_cap_mb allows.
+    Returns (Result in original image coordinates, original (width, height)).
+    """
+    reader = StripReader(path, memory_cap_mb, band_rows=min(256, tile_size))
+    window_bytes = (tile_size + reader.band_rows) * reader.width * 3
+    tile_bytes = tile_size * tile_size * 3 * 5 # tile, letterboxed float input
+    batch_size = int(max(1, min(32, (reader.memory_cap - window_bytes) // tile_bytes)))
+    fits_one_tile = reader.width <= tile_size and reader.height <= tile_size
+    predict_kwargs.setdefault('imgsz', tile_size)
+    all_xyxy, all_scores, all_classes = [], [], []
+    batch = []
+
+    def run(batch):
+        results = detector([Image.fromarray(np.ascontiguousarray(tile)) for _, _, _, tile in batch], verbose=False, **predict_kwargs)
+        for (x0, y0, factor, _), r in zip(batch, results):
+            xyxy = r.boxes.xyxy.cpu().numpy() * factor + np.array([x0, y0, x0, y0], dtype=np.float32)
+            all_xyxy.append(xyxy)
+            all_scores.append(r.boxes.conf.cpu().numpy())
+            all_classes.append(r.boxes.cls.cpu().numpy())
+
+    thumbnail_size = predict_kwargs['imgsz'] if global_pass and not fits_one_tile else 0
+    for x0, y0, tile in iter_tiles(reader, tile_size, overlap, thumbnail_size):
+        if x0 is None:
+            # whole image pass, boxes scaled back from thumbnail
+            batch.append((0, 0, reader.width / tile.shape[1], tile))
+        else:
+            batch.append((x0, y0, 1.0, tile.copy()))
+        if len(batch) >= batch_size:
+            run(batch)
+            batch = []
+    if batch:
+        run(batch)
+    xyxy = np.concatenate(all_xyxy) if all_xyxy else np.zeros((0, 4), dtype=np.float32)
+    scores = np.concatenate(all_scores) if all_scores else np.zeros(0, dtype=np.float32)
+    classes = np.concatenate(all_classes) if all_classes else np.zeros(0, dtype=np.float32)
+    xyxy, scores, classes = merge_boxes(xyxy, scores, classes, ios_threshold)
+    xyxy = np.clip(xyxy * reader.scale, 0, [*reader.original_size, *reader.original_size])
+    width, height = reader.original_size
+    return Result(Boxes(xyxy, scores, classes), (height, width)), reader.original_size
+
+class TiledImage:
+    """
+    Stand-in for decoded image in tiled mode: size, and crops assembled from bands without holding the whole image.
+    """
+    def __init__(self, path: str, memory_cap_mb: int = 1024):
+        self.path = path
+        self.memory_cap_mb = memory_cap_mb
+        with Image.open(path) as image:
+            self.size = image.size
+
+    def crop_many(self, boxes) -> List[Image.Image]:
+        reader = StripReader(self.path, self.memory_cap_mb)
+        regions = []
+        for box in boxes:
+            x1, y1, x2, y2 = [int(round(v / reader.scale)) for v in box]
+            x1, y1 = max(0, x1), max(0, y1)
+            x2, y2 = min(reader.width, max(x2, x1 + 1)), min(reader.height, max(y2, y1 + 1))
+            regions.append((x1, y1, x2, y2, np.zeros((y2 - y1, x2 - x1, 3), dtype=np.uint8)))
+        if not regions:
+            return []
+        last_row = max(y2 for _, _, _, y2, _ in regions)
+        for band_y0, band in reader.bands():
+            band_y1 = band_y0 + len(band)
+            for x1, y1, x2, y2, crop in regions:
+                top, bottom = max(y1, band_y0), min(y2, band_y1)
+                if bottom > top:
+                    crop[top - y1:bottom - y1] = band[top - band_y0:bottom - band_y0, x1:x2]
+            if band_y1 >= last_row:
+                break
+        return [Image.fromarray(crop) for _, _, _, _, crop in regions]
+
+    def crop(self, box) -> Image.Image:
+        return self.crop_many([box])[0]
@@ -0,0 +1,106 @@
+"""
+Embeds captions from sidecars (<img>_gemini.txt, else <img>_annotated.txt) into the images as stealth pnginfo,
+so captions travel with the file. Existing stealth payload (NovelAI json) and text chunks are kept, caption is added as "Caption".
+Images are rewritten in place through temp file and rename, PNG and lossless WebP only, lossy WebP would grow many times over.
+
+Usage:
+    python embed_stealth.py --path dataset --recursive --workers 16
+    python embed_stealth.py --path dataset --mode rgb --no-compress
+"""
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Optional
+from PIL import Image, PngImagePlugin
+from tqdm import tqdm
+from extract_exif import embed_stealth_info, is_lossless_webp, probe_stealth, read_info_from_image_stealth, read_metadata_chunks
+from transcode import collect_images
+from utils.captions import read_result
+
+def build_payload(image:Image.Image, caption:str, metadata:Dict[str, str]) -> str:
+    """
+    Returns json payload: existing stealth json (or text chunks) with Caption added.
+    """
+    payload = {}
+    existing = read_info_from_image_stealth(image)
+    if existing:
+        try:
+            payload = json.loads(existing)
+        except json.JSONDecodeError:
+            payload = {'parameters': existing}
+        if not isinstance(payload, dict):
+            payload = {'parameters': existing}
+    else:
+        payload = {key: value for key, value in metadata.items() if key != 'XMP'}
+    payload['Caption'] = caption
+    return json.dumps(payload, ensure_ascii=False)
+
+def embed_caption_file(path:str, mode:str = 'alpha', compressed:bool = True, compress_level:int = 6) -> Optional[str]:
+    """
+    Embeds caption of single image. Returns None on success, 'skipped' without caption, error message otherwise.
+    """
+    caption = read_result(path)
+    if caption is None:
+        return 'skipped'
+    temp_path = path + '.tmp'
+    try:
+        metadata = read_metadata_chunks(path)
+        with Image.open(path) as image:
+            if image.format not in ('PNG', 'WEBP'):
+                return f'{image.format} cannot hold stealth payload'
+            if image.format == 'WEBP' and not is_lossless_webp(path):
+                return 'lossy WEBP cannot hold stealth payload'
+            image_format = image.format
+            if mode == 'alpha' and probe_stealth(image)[0] == 'rgb':
+                mode = 'rgb' # existing rgb signature would shadow the new alpha payload
+            embedded = embed_stealth_info(image, build_payload(image, caption, metadata), mode, compressed)
+            exif = image.info.get('exif')
+        if image_format == 'PNG':
+            pnginfo = PngImagePlugin.PngInfo()
+            for key, value in metadata.items():
+                pnginfo.add_itxt(key, value)
+            embedded.save(temp_path, 'PNG', pnginfo=pnginfo, compress_level=compress_level)
+        else:
+            # exact keeps RGB under transparent pixels
+            embedded.save(temp_path, 'WEBP', lossless=True, exact=True, exif=exif or b'')
+        os.replace(temp_path, path)
+    except Exception as exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return f'{type(exception).__name__}: {exception}'
+    return None
+
+def _embed_job(job) -> Optional[str]:
+    return embed_caption_file(*job)
+
+def embed_captions(path:str, recursive:bool = False, mode:str = 'alpha', compressed:bool = True, compress_level:int = 6,
+                   workers:int = 8) -> Dict[str, int]:
+    """
+    Embeds captions of all PNG / WebP images under path in process pool. Returns counters.
+    """
+    files = collect_images(path, ('.png', '.webp'), recursive)
+    counters = {'embedded': 0, 'skipped': 0, 'errors': 0}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        jobs = [(file, mode, compressed, compress_level) for file in files]
+        for file, result in zip(files, tqdm(executor.map(_embed_job, jobs, chunksize=16), total=len(files))):
+            if result is None:
+                counters['embedded'] += 1
+            elif result == 'skipped':
+                counters['skipped'] += 1
+            else:
+                counters['errors'] += 1
+                print("Error embedding", file, result)
+    print(f"Embedded {counters['embedded']} captions, {counters['skipped']} images without caption, {counters['errors']} errors")
+    return counters
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path', type=str, required=True, help='Folder with images and caption sidecars')
+    parser.add_argument('--recursive', action='store_true', help='Recursive')
+    parser.add_argument('--mode', type=str, default='alpha', choices=['alpha', 'rgb'], help='Channels holding the payload')
+    parser.add_argument('--no-compress', action='store_true', help='Store payload without gzip')
+    parser.add_argument('--compress-level', type=int, default=6, help='PNG zlib level, lower is faster')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Worker processes')
+    args = parser.parse_args()
+    embed_captions(args.path, args.recursive, args.mode, not args.no_compress, args.compress_level, args.workers)
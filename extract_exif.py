@@ -1,5 +1,6 @@
 from PIL import Image
 import gzip
+import numpy as np
 import os
 try:
     from tqdm import tqdm
@@ -9,199 +10,535 @@ except:
 import glob
 import json
 import re
+import struct
 import sys
-def convert_png_to_webp(path, remove_original=False, recursive=False):
+import zlib
+def convert_png_to_webp(path, remove_original=False, recursive=False, quality=90, effort=4, lossless=None, workers=None):
     """
-    Convert all png files to webp in given path.
+    Convert all png files to webp in given path. See transcode.transcode_files.
     """
-    images = []
-    if recursive:
-        for root, dirs, files in os.walk(path):
-            for file in files:
-                if not file.endswith('.png'):
-                    continue
-                images.append(os.path.join(root, file))
-    else:
-        images = glob.glob(os.path.join(path, '*.png'))
-    pbar = tqdm(total=len(images))
-    before_compress_sum = 0
-    after_compress_sum = 0
-    for image in images:
-        if not os.path.exists(image) or os.path.exists(image.replace('.png', '.webp')):
-            pbar.total -= 1
-            pbar.update(0)
-            continue
-        path_image = image
-        before_compress_sum += os.path.getsize(path_image)
-        try:
-            image = Image.open(path_image)
-            image.save(path_image.replace('.png', '.webp'), 'webp', optimize=True)
-            after_compress_sum += os.path.getsize(path_image.replace('.png', '.webp'))
-            pbar.update(1)
-            pbar.set_description(f"Before: {before_compress_sum / 1024 / 1024:.2f} MB, After: {after_compress_sum / 1024 / 1024:.2f} MB, compress ratio: {after_compress_sum / before_compress_sum * 100:.2f}%")
-            if remove_original:
-                os.remove(path_image)
-        except:
-            print("Error converting", path_image)
-            pbar.update(1)
+    from transcode import collect_images, transcode_files
+    return transcode_files(collect_images(path, ('.png',), recursive), 'webp', quality, effort, lossless, remove_original, workers or os.cpu_count())
 
-def convert_jpg_to_webp(path, remove_original=False, recursive=False):
+def convert_jpg_to_webp(path, remove_original=False, recursive=False, quality=90, effort=4, lossless=None, workers=None):
     """
-    Convert all jpg files to webp in given path.
+    Convert all jpg files to webp in given path. See transcode.transcode_files.
     """
-    images = []
-    if recursive:
-        for root, dirs, files in os.walk(path):
-            for file in files:
-                if not file.endswith('.jpg'):
-                    continue
-                images.append(os.path.join(root, file))
+    from transcode import collect_images, transcode_files
+    return transcode_files(collect_images(path, ('.jpg', '.jpeg'), recursive), 'webp', quality, effort, lossless, remove_original, workers or os.cpu_count())
+
+STEALTH_SIGNATURE_BITS = len('stealth_pnginfo') * 8 # 120
+STEALTH_HEADER_BITS = STEALTH_SIGNATURE_BITS + 32 # signature + payload length in bits
+STEALTH_CHANNELS = {
+    'alpha': slice(3, 4),
+    'rgb': slice(0, 3),
+}
+
+def _lsb_bits(pixels: np.ndarray, mode: str, count: int) -> np.ndarray:
+    """
+    Returns first count LSBs of the mode's channels, in column-major pixel order (x outer, y inner).
+    Only the columns which hold these bits are touched.
+    """
+    height = pixels.shape[0]
+    channels = STEALTH_CHANNELS[mode]
+    bits_per_column = height * (channels.stop - channels.start)
+    columns = -(-count // bits_per_column)
+    block = pixels[:, :columns, channels]
+    return (block.transpose(1, 0, 2).reshape(-1) & 1)[:count]
+
+def _bits_to_bytes(bits: np.ndarray) -> bytes:
+    """
+    Packs bits MSB first. Trailing partial byte is read as integer of remaining bits, same as int(bits, 2).
+    """
+    full = len(bits) // 8 * 8
+    data = np.packbits(bits[:full]).tobytes()
+    if full != len(bits):
+        data += bytes([int(''.join(map(str, bits[full:])), 2)])
+    return data
+
+def _read_stealth_signature(pixels: np.ndarray, pixel_count: int = None):
+    """
+    Returns (mode, compressed) of stealth signature, or (None, False).
+    pixels may be only the first columns of the image, pixel_count is the size of the whole image.
+    RGB signature completes at pixel 40, before alpha signature at pixel 120, so it takes precedence.
+    """
+    if pixel_count is None:
+        pixel_count = pixels.shape[0] * pixels.shape[1]
+    if pixel_count >= STEALTH_SIGNATURE_BITS // 3:
+        signature = _bits_to_bytes(_lsb_bits(pixels, 'rgb', STEALTH_SIGNATURE_BITS)).decode('utf-8', errors='ignore')
+        if signature in {'stealth_rgbinfo', 'stealth_rgbcomp'}:
+            return 'rgb', signature == 'stealth_rgbcomp'
+    if pixels.shape[2] == 4 and pixel_count >= STEALTH_SIGNATURE_BITS:
+        signature = _bits_to_bytes(_lsb_bits(pixels, 'alpha', STEALTH_SIGNATURE_BITS)).decode('utf-8', errors='ignore')
+        if signature in {'stealth_pnginfo', 'stealth_pngcomp'}:
+            return 'alpha', signature == 'stealth_pngcomp'
+    return None, False
+
+def _available_bits(mode: str, pixel_count: int) -> int:
+    channels = STEALTH_CHANNELS[mode]
+    return pixel_count * (channels.stop - channels.start)
+
+def _read_stealth_length(pixels: np.ndarray, mode: str, pixel_count: int = None) -> int:
+    """
+    Returns payload length in bits, or -1 if the image is too small to hold the header.
+    """
+    if pixel_count is None:
+        pixel_count = pixels.shape[0] * pixels.shape[1]
+    if _available_bits(mode, pixel_count) < STEALTH_HEADER_BITS:
+        return -1
+    length_bits = _lsb_bits(pixels, mode, STEALTH_HEADER_BITS)[STEALTH_SIGNATURE_BITS:]
+    return int.from_bytes(np.packbits(length_bits).tobytes(), 'big')
+
+def _is_valid_stealth_length(mode: str, length: int, pixel_count: int) -> bool:
+    """
+    Returns True if the payload of length bits fits in the image.
+    """
+    available = _available_bits(mode, pixel_count) - STEALTH_HEADER_BITS
+    # rgb payload is only checked after at least one more pixel (3 bits + 1 bit left from the header pixel)
+    return 0 < length <= available and not (mode == 'rgb' and available < 4)
+
+def _decode_stealth_payload(pixels: np.ndarray, mode: str, compressed: bool, length: int) -> str:
+    """
+    Reads and decodes payload of length bits after the header. Returns '' if invalid.
+    """
+    byte_data = _bits_to_bytes(_lsb_bits(pixels, mode, STEALTH_HEADER_BITS + length)[STEALTH_HEADER_BITS:])
+    try:
+        if compressed:
+            return gzip.decompress(byte_data).decode('utf-8')
+        return byte_data.decode('utf-8', errors='ignore')
+    except:
+        return ''
+
+def _stealth_columns(mode: str, bits: int, height: int) -> int:
+    """
+    Returns number of leading columns which hold the first bits of mode.
+    """
+    channels = STEALTH_CHANNELS[mode]
+    return -(-bits // (height * (channels.stop - channels.start)))
+
+def read_stealth_from_array(pixels: np.ndarray) -> str:
+    """
+    Reads stealth pnginfo from uint8 array of shape (H, W, 3) or (H, W, 4).
+    """
+    pixel_count = pixels.shape[0] * pixels.shape[1]
+    mode, compressed = _read_stealth_signature(pixels)
+    if mode is None:
+        return ''
+    length = _read_stealth_length(pixels, mode)
+    if not _is_valid_stealth_length(mode, length, pixel_count):
+        return ''
+    return _decode_stealth_payload(pixels, mode, compressed, length)
+
+def _open_leading_rows(path: str, rows: int):
+    """
+    Opens image, only the first rows are decoded on load when the format allows it (non-interlaced PNG).
+    Returns (image, width, height) with the original size.
+    """
+    image = Image.open(path)
+    width, height = image.size
+    if image.format == 'PNG' and not image.info.get('interlace') and len(image.tile) == 1 and rows < height:
+        codec, _, offset, args = image.tile[0]
+        image.tile = [(codec, (0, 0, width, rows), offset, args)]
+        image._size = (width, rows)
+    return image, width, height
+
+def probe_stealth(image):
+    """
+    Reads only the stealth header, without the payload.
+    Returns (mode, compressed, length in bits), mode is 'alpha', 'rgb' or None if there is no valid payload.
+    If image is a path, only the first 152 rows are decoded for PNG files.
+    """
+    if isinstance(image, str):
+        image, width, height = _open_leading_rows(image, STEALTH_HEADER_BITS)
     else:
-        images = glob.glob(os.path.join(path, '*.jpg'))
-    pbar = tqdm(total=len(images))
-    before_compress_sum = 0
-    after_compress_sum = 0
-    for image in images:
-        if not os.path.exists(image) or os.path.exists(image.replace('.jpg', '.webp')):
-            pbar.total -= 1
-            pbar.update(0)
+        width, height = image.size
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'A' in image.mode or 'transparency' in image.info else 'RGB')
+    pixel_count = width * height
+    # first 152 pixels in column-major order, either a single column or all rows of the leading columns
+    rows = min(height, STEALTH_HEADER_BITS)
+    columns = min(width, _stealth_columns('alpha', STEALTH_HEADER_BITS, height))
+    header = np.asarray(image.crop((0, 0, columns, rows)))
+    mode, compressed = _read_stealth_signature(header, pixel_count)
+    if mode is None:
+        return None, False, -1
+    length = _read_stealth_length(header, mode, pixel_count)
+    if not _is_valid_stealth_length(mode, length, pixel_count):
+        return None, False, length
+    return mode, compressed, length
+
+def has_stealth_info(path: str) -> bool:
+    """
+    Returns True if the image has stealth payload, decodes only the header region.
+    """
+    return probe_stealth(path)[0] is not None
+
+STEALTH_SIGNATURES = {
+    ('alpha', False): b'stealth_pnginfo',
+    ('alpha', True): b'stealth_pngcomp',
+    ('rgb', False): b'stealth_rgbinfo',
+    ('rgb', True): b'stealth_rgbcomp',
+}
+
+def _batch_to_array(images) -> np.ndarray:
+    """
+    Converts tensor batch to numpy, single image [H, W, C] gets batch axis.
+    """
+    if hasattr(images, 'cpu'):
+        images = images.cpu().numpy()
+    images = np.asarray(images)
+    return images[None] if images.ndim == 3 else images
+
+def _batch_to_uint8(images: np.ndarray, columns: int, scale: bool) -> np.ndarray:
+    """
+    Converts leading columns of batch to uint8, only these hold stealth bits.
+    Float images in 0..1 (ComfyUI IMAGE) are scaled the same way SaveImage does, so bits match the saved file.
+    """
+    block = images[:, :, :columns]
+    if block.dtype == np.uint8:
+        return block
+    if scale:
+        block = block * 255.0
+    return np.clip(block, 0, 255).astype(np.uint8)
+
+def _batch_lsb_bits(images: np.ndarray, mode: str, count: int) -> np.ndarray:
+    """
+    Batched _lsb_bits, returns (B, count) bits of each image.
+    """
+    height = images.shape[1]
+    channels = STEALTH_CHANNELS[mode]
+    columns = _stealth_columns(mode, count, height)
+    block = images[:, :, :columns, channels]
+    return (block.transpose(0, 2, 1, 3).reshape(len(images), -1) & 1)[:, :count]
+
+def read_info_from_image_stealth_batch(images) -> list:
+    """
+    Reads stealth pnginfo of every image of batch [B, H, W, C], torch tensor or numpy array.
+    Signatures and lengths are read for the whole batch at once, payloads are sliced per image.
+    Returns list of B strings, '' for images without valid payload.
+    """
+    images = _batch_to_array(images)
+    batch, height, width, channel_count = images.shape
+    pixel_count = height * width
+    results = [''] * batch
+    if channel_count not in (3, 4):
+        return results
+    modes = np.full(batch, None, dtype=object)
+    compressed = np.zeros(batch, dtype=bool)
+    lengths = np.zeros(batch, dtype=np.int64)
+    scale = images.dtype.kind == 'f' and images.size > 0 and images.max() <= 1.0
+    header_images = _batch_to_uint8(images, _stealth_columns('alpha', STEALTH_HEADER_BITS, height), scale)
+    # rgb last, it overrides alpha as in _read_stealth_signature
+    for mode in ('alpha', 'rgb'):
+        if mode == 'alpha' and channel_count != 4:
             continue
-        path_image = image
-        before_compress_sum += os.path.getsize(path_image)
-        try:
-            image = Image.open(path_image)
-            image.save(path_image.replace('.jpg', '.webp'), 'webp', optimize=True)
-            after_compress_sum += os.path.getsize(path_image.replace('.jpg', '.webp'))
-            pbar.update(1)
-            pbar.set_description(f"Before: {before_compress_sum / 1024 / 1024:.2f} MB, After: {after_compress_sum / 1024 / 1024:.2f} MB, compress ratio: {after_compress_sum / before_compress_sum * 100:.2f}%")
-            if remove_original:
-                os.remove(path_image)
-        except:
-            print("Error converting", path_image)
-            pbar.update(1)
+        if _available_bits(mode, pixel_count) < STEALTH_HEADER_BITS:
+            continue
+        header = np.packbits(_batch_lsb_bits(header_images, mode, STEALTH_HEADER_BITS), axis=1)
+        signatures = header[:, :STEALTH_SIGNATURE_BITS // 8]
+        for is_compressed in (False, True):
+            expected = np.frombuffer(STEALTH_SIGNATURES[(mode, is_compressed)], dtype=np.uint8)
+            found = (signatures == expected).all(axis=1)
+            modes[found] = mode
+            compressed[found] = is_compressed
+        lengths_of_mode = header[:, STEALTH_SIGNATURE_BITS // 8:].copy().view('>u4')[:, 0].astype(np.int64)
+        lengths = np.where(modes == mode, lengths_of_mode, lengths)
+    for mode in ('alpha', 'rgb'):
+        indices = [i for i in range(batch) if modes[i] == mode and _is_valid_stealth_length(mode, int(lengths[i]), pixel_count)]
+        if not indices:
+            continue
+        bit_count = STEALTH_HEADER_BITS + int(lengths[indices].max())
+        bits = _batch_lsb_bits(_batch_to_uint8(images[indices], _stealth_columns(mode, bit_count, height), scale), mode, bit_count)
+        for row, i in enumerate(indices):
+            payload = _bits_to_bytes(bits[row, STEALTH_HEADER_BITS:STEALTH_HEADER_BITS + int(lengths[i])])
+            try:
+                results[i] = gzip.decompress(payload).decode('utf-8') if compressed[i] else payload.decode('utf-8', errors='ignore')
+            except:
+                results[i] = ''
+    return results
 
 def read_info_from_image_stealth(image):
-    # if tensor, convert to PIL image
+    # if tensor, decode first image of the batch
     if hasattr(image, 'cpu'):
-        image = image.cpu().numpy() #((1, 1, 1280, 3), '<f4')
-        image = image[0].astype('uint8') #((1, 1280, 3), 'uint8')
-        image = Image.fromarray(image)
+        return read_info_from_image_stealth_batch(image[:1])[0]
     # trying to read stealth pnginfo
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'A' in image.mode or 'transparency' in image.info else 'RGB')
     width, height = image.size
-    pixels = image.load()
-
-    has_alpha = True if image.mode == 'RGBA' else False
-    mode = None
-    compressed = False
-    binary_data = ''
-    buffer_a = ''
-    buffer_rgb = ''
-    index_a = 0
-    index_rgb = 0
-    sig_confirmed = False
-    confirming_signature = True
-    reading_param_len = False
-    reading_param = False
-    read_end = False
-    never_confirmed = True
-    for x in range(width):
-        for y in range(height):
-            if has_alpha:
-                r, g, b, a = pixels[x, y]
-                buffer_a += str(a & 1)
-                index_a += 1
+    pixel_count = width * height
+    # only the leading columns are converted to array, header needs at most 152 pixels
+    header = np.asarray(image.crop((0, 0, min(width, _stealth_columns('alpha', STEALTH_HEADER_BITS, height)), height)))
+    mode, compressed = _read_stealth_signature(header, pixel_count)
+    if mode is None:
+        return ''
+    length = _read_stealth_length(header, mode, pixel_count)
+    if not _is_valid_stealth_length(mode, length, pixel_count):
+        return ''
+    pixels = np.asarray(image.crop((0, 0, min(width, _stealth_columns(mode, STEALTH_HEADER_BITS + length, height)), height)))
+    return _decode_stealth_payload(pixels, mode, compressed, length)
+
+def _stealth_payload_bits(text: str, mode: str, compressed: bool) -> np.ndarray:
+    """
+    Returns signature, 32 bit payload length and payload as bit array, MSB first.
+    """
+    data = text.encode('utf-8')
+    if compressed:
+        data = gzip.compress(data)
+    header = STEALTH_SIGNATURES[(mode, compressed)] + (len(data) * 8).to_bytes(4, 'big')
+    return np.unpackbits(np.frombuffer(header + data, dtype=np.uint8))
+
+def write_stealth_to_array(pixels: np.ndarray, text: str, mode: str = 'alpha', compressed: bool = True) -> np.ndarray:
+    """
+    Embeds text as stealth pnginfo into uint8 array of shape (H, W, 3) or (H, W, 4), returns new array.
+    alpha mode adds opaque alpha channel to RGB arrays. Only the leading columns which hold the bits are rewritten.
+    """
+    if mode == 'alpha' and pixels.shape[2] == 3:
+        pixels = np.concatenate([pixels, np.full(pixels.shape[:2] + (1,), 255, dtype=np.uint8)], axis=2)
+    else:
+        pixels = pixels.copy()
+    height, width = pixels.shape[:2]
+    bits = _stealth_payload_bits(text, mode, compressed)
+    if len(bits) > _available_bits(mode, height * width):
+        raise ValueError(f'payload of {len(bits)} bits does not fit into {width}x{height} image ({mode})')
+    channels = STEALTH_CHANNELS[mode]
+    columns = _stealth_columns(mode, len(bits), height)
+    # column-major order: x outer, y inner, channels innermost
+    block = pixels[:, :columns, channels].transpose(1, 0, 2).reshape(-1)
+    block[:len(bits)] = (block[:len(bits)] & 0xFE) | bits
+    pixels[:, :columns, channels] = block.reshape(columns, height, -1).transpose(1, 0, 2)
+    return pixels
+
+def embed_stealth_info(image, text: str, mode: str = 'alpha', compressed: bool = True):
+    """
+    Returns copy of PIL image with text embedded as stealth pnginfo. Must be saved lossless (PNG, lossless WebP with exact).
+    """
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'A' in image.mode or 'transparency' in image.info else 'RGB')
+    embedded = Image.fromarray(write_stealth_to_array(np.asarray(image), text, mode, compressed))
+    embedded.info = dict(image.info)
+    return embedded
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+EXIF_TAGS = {
+    0x010E: 'ImageDescription',
+    0x010F: 'Make',
+    0x0110: 'Model',
+    0x0131: 'Software',
+    0x013B: 'Artist',
+    0x9286: 'UserComment',
+}
+EXIF_IFD_POINTER = 0x8769
+
+def _read_png_chunks(f) -> dict:
+    """
+    Reads tEXt, zTXt and iTXt chunks, image data chunks are skipped with seek, never decompressed.
+    """
+    metadata = {}
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            break
+        length, chunk_type = struct.unpack('>I4s', header)
+        if chunk_type == b'IEND':
+            break
+        if chunk_type not in (b'tEXt', b'zTXt', b'iTXt'):
+            f.seek(length + 4, os.SEEK_CUR) # data + crc
+            continue
+        data = f.read(length)
+        f.seek(4, os.SEEK_CUR)
+        keyword, _, rest = data.partition(b'\x00')
+        keyword = keyword.decode('latin-1')
+        try:
+            if chunk_type == b'tEXt':
+                metadata[keyword] = rest.decode('latin-1')
+            elif chunk_type == b'zTXt':
+                metadata[keyword] = zlib.decompress(rest[1:]).decode('latin-1')
             else:
-                r, g, b = pixels[x, y]
-            buffer_rgb += str(r & 1)
-            buffer_rgb += str(g & 1)
-            buffer_rgb += str(b & 1)
-            index_rgb += 3
-            if confirming_signature:
-                if x * height + y > 120 and never_confirmed:
-                    return ''
-                if index_a == len('stealth_pnginfo') * 8:
-                    decoded_sig = bytearray(int(buffer_a[i:i + 8], 2) for i in
-                                            range(0, len(buffer_a), 8)).decode('utf-8', errors='ignore')
-                    if decoded_sig in {'stealth_pnginfo', 'stealth_pngcomp'}:
-                        #print(f"Found signature at {x}, {y}")
-                        confirming_signature = False
-                        sig_confirmed = True
-                        reading_param_len = True
-                        mode = 'alpha'
-                        if decoded_sig == 'stealth_pngcomp':
-                            compressed = True
-                        buffer_a = ''
-                        index_a = 0
-                        never_confirmed = False
-                    else:
-                        read_end = True
-                        break
-                elif index_rgb == len('stealth_pnginfo') * 8:
-                    decoded_sig = bytearray(int(buffer_rgb[i:i + 8], 2) for i in
-                                            range(0, len(buffer_rgb), 8)).decode('utf-8', errors='ignore')
-                    if decoded_sig in {'stealth_rgbinfo', 'stealth_rgbcomp'}:
-                        #print(f"Found signature at {x}, {y}")
-                        confirming_signature = False
-                        sig_confirmed = True
-                        reading_param_len = True
-                        mode = 'rgb'
-                        if decoded_sig == 'stealth_rgbcomp':
-                            compressed = True
-                        buffer_rgb = ''
-                        index_rgb = 0
-                        never_confirmed = False
-            elif reading_param_len:
-                if mode == 'alpha':
-                    if index_a == 32:
-                        param_len = int(buffer_a, 2)
-                        reading_param_len = False
-                        reading_param = True
-                        buffer_a = ''
-                        index_a = 0
-                else:
-                    if index_rgb == 33:
-                        pop = buffer_rgb[-1]
-                        buffer_rgb = buffer_rgb[:-1]
-                        param_len = int(buffer_rgb, 2)
-                        reading_param_len = False
-                        reading_param = True
-                        buffer_rgb = pop
-                        index_rgb = 1
-            elif reading_param:
-                if mode == 'alpha':
-                    if index_a == param_len:
-                        binary_data = buffer_a
-                        read_end = True
-                        break
+                compressed = rest[0] == 1
+                _, _, rest = rest[2:].partition(b'\x00') # language tag
+                _, _, text = rest.partition(b'\x00') # translated keyword
+                metadata[keyword] = (zlib.decompress(text) if compressed else text).decode('utf-8')
+        except (zlib.error, UnicodeDecodeError, IndexError):
+            continue
+    return metadata
+
+def _read_tiff_exif(data: bytes) -> dict:
+    """
+    Reads text tags of TIFF structured EXIF data, including the Exif sub IFD (UserComment).
+    """
+    metadata = {}
+    if len(data) < 8 or data[:2] not in (b'II', b'MM'):
+        return metadata
+    endian = '<' if data[:2] == b'II' else '>'
+    offsets = [struct.unpack(endian + 'I', data[4:8])[0]]
+    visited = set()
+    while offsets:
+        offset = offsets.pop()
+        if offset in visited or offset + 2 > len(data):
+            continue
+        visited.add(offset)
+        count = struct.unpack(endian + 'H', data[offset:offset + 2])[0]
+        for i in range(count):
+            entry = data[offset + 2 + i * 12:offset + 14 + i * 12]
+            if len(entry) < 12:
+                break
+            tag, field_type, value_count = struct.unpack(endian + 'HHI', entry[:8])
+            if tag == EXIF_IFD_POINTER:
+                offsets.append(struct.unpack(endian + 'I', entry[8:12])[0])
+                continue
+            if tag not in EXIF_TAGS or field_type not in (1, 2, 7): # BYTE, ASCII, UNDEFINED
+                continue
+            value = entry[8:8 + value_count] if value_count <= 4 else data[struct.unpack(endian + 'I', entry[8:12])[0]:][:value_count]
+            if tag == 0x9286:
+                # 8 byte charset prefix, writers disagree on UNICODE byte order, guessed from first character
+                prefix, value = value[:8], value[8:]
+                if prefix.startswith(b'UNICODE'):
+                    big_endian = value[:1] == b'\x00' if len(value) > 1 and (value[0] == 0) != (value[1] == 0) else endian == '>'
+                    text = value.decode('utf-16-be' if big_endian else 'utf-16-le', errors='ignore')
                 else:
-                    if index_rgb >= param_len:
-                        diff = param_len - index_rgb
-                        if diff < 0:
-                            buffer_rgb = buffer_rgb[:diff]
-                        binary_data = buffer_rgb
-                        read_end = True
-                        break
+                    text = value.decode('utf-8', errors='ignore')
             else:
-                # impossible
-                read_end = True
-                break
-        if read_end:
+                text = value.decode('utf-8', errors='ignore')
+            text = text.rstrip('\x00')
+            if text:
+                metadata[EXIF_TAGS[tag]] = text
+    return metadata
+
+def _read_webp_chunks(f) -> dict:
+    """
+    Reads EXIF and XMP chunks of RIFF WebP, image chunks are skipped with seek.
+    """
+    metadata = {}
+    riff = f.read(12)
+    if len(riff) < 12 or riff[8:12] != b'WEBP':
+        return metadata
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
             break
-    geninfo = ''
-    if sig_confirmed and binary_data != '':
-        # Convert binary string to UTF-8 encoded text
-        byte_data = bytearray(int(binary_data[i:i + 8], 2) for i in range(0, len(binary_data), 8))
-        try:
-            if compressed:
-                decoded_data = gzip.decompress(bytes(byte_data)).decode('utf-8')
-            else:
-                decoded_data = byte_data.decode('utf-8', errors='ignore')
-            geninfo = decoded_data
-        except:
-            pass
-    return str(geninfo)
+        chunk_type, length = struct.unpack('<4sI', header)
+        padded_length = length + (length & 1)
+        if chunk_type == b'EXIF':
+            data = f.read(length)
+            f.seek(padded_length - length, os.SEEK_CUR)
+            if data.startswith(b'Exif\x00\x00'):
+                data = data[6:]
+            metadata.update(_read_tiff_exif(data))
+        elif chunk_type == b'XMP ':
+            metadata['XMP'] = f.read(length).decode('utf-8', errors='ignore')
+            f.seek(padded_length - length, os.SEEK_CUR)
+        else:
+            f.seek(padded_length, os.SEEK_CUR)
+    return metadata
+
+def is_lossless_webp(path: str) -> bool:
+    """
+    True if the WebP file is a lossless (VP8L) still image. PIL does not report it, the RIFF chunks are walked instead.
+    """
+    with open(path, 'rb') as f:
+        riff = f.read(12)
+        if len(riff) < 12 or riff[:4] != b'RIFF' or riff[8:12] != b'WEBP':
+            return False
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return False
+            chunk_type, length = struct.unpack('<4sI', header)
+            if chunk_type in (b'VP8L', b'VP8 ', b'ANMF'):
+                return chunk_type == b'VP8L'
+            f.seek(length + (length & 1), os.SEEK_CUR)
+
+def _read_jpeg_segments(f) -> dict:
+    """
+    Reads EXIF (APP1), XMP (APP1) and comment segments of JPEG, stops at start of scan.
+    """
+    metadata = {}
+    if f.read(2) != b'\xff\xd8':
+        return metadata
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            break
+        if marker[1] in (0xD9, 0xDA): # end of image, start of scan
+            break
+        if 0xD0 <= marker[1] <= 0xD7 or marker[1] == 0x01: # no payload
+            continue
+        length = struct.unpack('>H', f.read(2))[0] - 2
+        if marker[1] == 0xE1 or marker[1] == 0xFE:
+            data = f.read(length)
+            if marker[1] == 0xFE:
+                metadata['Comment'] = data.decode('utf-8', errors='ignore')
+            elif data.startswith(b'Exif\x00\x00'):
+                metadata.update(_read_tiff_exif(data[6:]))
+            elif data.startswith(b'http://ns.adobe.com/xap/1.0/\x00'):
+                metadata['XMP'] = data[29:].decode('utf-8', errors='ignore')
+        else:
+            f.seek(length, os.SEEK_CUR)
+    return metadata
+
+def read_metadata_chunks(path: str) -> dict:
+    """
+    Reads standard text metadata from container chunks without decoding image data.
+    PNG: tEXt, zTXt, iTXt. WebP: EXIF, XMP. JPEG: EXIF, XMP, comment.
+    Returns keyword -> text, empty if none.
+    """
+    with open(path, 'rb', buffering=65536) as f:
+        head = f.read(12)
+        f.seek(0)
+        if head.startswith(PNG_SIGNATURE):
+            f.seek(len(PNG_SIGNATURE))
+            return _read_png_chunks(f)
+        if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+            return _read_webp_chunks(f)
+        if head[:2] == b'\xff\xd8':
+            return _read_jpeg_segments(f)
+    # other containers (AVIF, TIFF...), PIL parses the header without decoding pixels
+    try:
+        with Image.open(path) as image:
+            exif = image.info.get('exif', b'')
+    except Exception:
+        return {}
+    return _read_tiff_exif(exif[6:] if exif.startswith(b'Exif\x00\x00') else exif)
+
+GENERATION_KEYS = ('parameters', 'Comment', 'Description', 'UserComment')
 
+def has_generation_metadata(metadata: dict) -> bool:
+    """
+    True if chunk metadata holds generation info (webui, NovelAI, EXIF UserComment).
+    XMP, Software or camera EXIF alone do not count, such files may still carry stealth payload.
+    """
+    return any(key in metadata for key in GENERATION_KEYS)
+
+def format_metadata_chunks(metadata: dict) -> str:
+    """
+    Formats chunk metadata as single string.
+    webui 'parameters' is returned as is, others as json object, same as NovelAI stealth payload.
+    """
+    if 'parameters' in metadata:
+        return metadata['parameters']
+    if list(metadata) == ['UserComment']:
+        return metadata['UserComment']
+    return json.dumps(metadata, ensure_ascii=False)
+
+def read_metadata(path: str):
+    """
+    Reads generation metadata of the file, chunk metadata first, stealth pnginfo only if chunks hold no generation info.
+    Returns (source, text), source is 'chunk', 'alpha', 'rgb' or None.
+    """
+    metadata = read_metadata_chunks(path)
+    if has_generation_metadata(metadata):
+        return 'chunk', format_metadata_chunks(metadata)
+    mode, _, _ = probe_stealth(path)
+    if mode is None:
+        return None, ''
+    with Image.open(path) as image:
+        return mode, read_info_from_image_stealth(image)
 
+def has_metadata(path: str) -> bool:
+    """
+    Returns True if the file has generation chunk metadata or stealth payload. Pixels are decoded only for the stealth header.
+    """
+    return has_generation_metadata(read_metadata_chunks(path)) or has_stealth_info(path)
 
 PATH = r"F:\comfyui\ComfyUI\output\NAI_1215"
 def extract_exif(path):
@@ -214,29 +551,50 @@ def extract_exif(path):
         data = data["Description"]
         with open(file.replace('.png', '.txt'), 'w') as f:
             f.write(data)
+def plan_moves(files, target_path):
+    """
+    Plans moves of files into target_path, name collisions get _<i> suffix.
+    Target folder is listed once instead of probing each candidate name.
+    Returns list of (source, target).
+    """
+    taken = set(os.listdir(target_path)) if os.path.isdir(target_path) else set()
+    next_index = {}
+    plan = []
+    for file in files:
+        name = os.path.basename(file)
+        if name in taken:
+            filename_without_ext, ext = os.path.splitext(name)
+            i = next_index.get(filename_without_ext, 1)
+            while f"{filename_without_ext}_{i}{ext}" in taken:
+                i += 1
+            next_index[filename_without_ext] = i + 1
+            name = f"{filename_without_ext}_{i}{ext}"
+        taken.add(name)
+        plan.append((file, os.path.join(target_path, name)))
+    return plan
+
+def apply_moves(plan):
+    """
+    Applies moves from plan_moves.
+    """
+    for target_dir in {os.path.dirname(target) for _, target in plan}:
+        os.makedirs(target_dir, exist_ok=True)
+    for source, target in tqdm(plan):
+        os.rename(source, target)
+
 def extract_exif_classify(path):
     # instead of writing, if not exists, move to path / without_exif folder
+    without_exif = []
     for file in tqdm(glob.glob(os.path.join(path, '*.png'))):
         try:
-            image = Image.open(file)
-            data = (read_info_from_image_stealth(image))
+            # chunk metadata and header probe, payload is not needed to classify
+            has_info = has_metadata(file)
         except:
             continue
-        if not data:
-            # move to path / without_exif folder
-            target_path = os.path.join(path, 'without_exif')
-            if not os.path.exists(target_path):
-                os.makedirs(target_path)
-            #print("Moving to", target_path)
-            if os.path.exists(os.path.join(target_path, os.path.basename(file))):
-                i = 1
-                filename_without_ext = os.path.splitext(os.path.basename(file))[0]
-                while os.path.exists(os.path.join(target_path, f"{filename_without_ext}_{i}.png")):
-                    i += 1
-                os.rename(file, os.path.join(target_path, f"{filename_without_ext}_{i}.png"))
-            else:
-                os.rename(file, os.path.join(target_path, os.path.basename(file)))
-            continue
+        if not has_info:
+            without_exif.append(file)
+    # move to path / without_exif folder
+    apply_moves(plan_moves(without_exif, os.path.join(path, 'without_exif')))
 def extract_exif_classify_text(path, text, output_path=None, recursive=False):
     # validate output path is not inside input path
     if output_path and os.path.abspath(output_path).startswith(os.path.abspath(path)):
@@ -255,98 +613,95 @@ def extract_exif_classify_text(path, text, output_path=None, recursive=False):
                 lists.append(os.path.join(root, file))
     else:
         lists = glob.glob(os.path.join(path, '*.png'))
+    # files without payload can be skipped with header probe, unless the pattern matches empty text
+    matches_empty = re.search(text, '', re.IGNORECASE) is not None
+    matched = []
     for file in tqdm(lists):
-        image = Image.open(file)
-        data = (read_info_from_image_stealth(image))
+        source, data = read_metadata(file)
+        if source is None and not matches_empty:
+            continue
         # match regex
         if re.search(text, data, re.IGNORECASE):
-            # move to path / without_exif folder
-            target_path = os.path.join(output_path or path, 'matched')
-            if not os.path.exists(target_path):
-                os.makedirs(target_path)
-            #print("Moving to", target_path)
-            # if file already exists, add number
-            if os.path.exists(os.path.join(target_path, os.path.basename(file))):
-                i = 1
-                filename_without_ext = os.path.splitext(os.path.basename(file))[0]
-                while os.path.exists(os.path.join(target_path, f"{filename_without_ext}_{i}.png")):
-                    i += 1
-                os.rename(file, os.path.join(target_path, f"{filename_without_ext}_{i}.png"))
-            else:
-                os.rename(file, os.path.join(target_path, os.path.basename(file)))
-            continue
-import gradio as gr
+            matched.append(file)
+    # move to path / matched folder, if file already exists, add number
+    apply_moves(plan_moves(matched, os.path.join(output_path or path, 'matched')))
 
 def classify_image(img):
-    img = Image.open(img)
     print("Handling image")
-    return read_info_from_image_stealth(img) #returns string
+    return read_metadata(img)[1] #returns string
 
 def read_and_extract(img:str):
     return read_info_from_image_stealth(img)
-with gr.Blocks(analytics_enabled=False) as block:
-    with gr.Tab("Extract Text"):
-        #inputs = gr.Image(type="pil", label="Original Image", source="upload")
-        input_path = gr.Textbox(label="Path to Image")
-        outputs = gr.Textbox(label="Extracted Text")
-        
-        button = gr.Button(value="Extract")
-        button.click(
-            fn=classify_image,
-            inputs=[input_path],
-            outputs=[outputs],
-        )
-    with gr.Tab("Extract text from image(file)"):
-        input = gr.Image(label="source", sources="upload", type="pil",interactive=True,image_mode="RGBA")
-        outputs = gr.Textbox(label="Extracted Text")
-        button = gr.Button(value="Extract")
-        button.click(
-            fn=read_and_extract,
-            inputs=[input],
-            outputs=[outputs],
-        )
-    with gr.Tab("Classify Folder"):
-        inputs = gr.Textbox(label="Folder with Images")
-        button = gr.Button(value="Extract")
-        button.click(
-            fn=extract_exif_classify,
-            inputs=[inputs],
-        )
-    with gr.Tab("Classify Folder with matching prompt"):
-        inputs = gr.Textbox(label="Folder with Images")
-        text = gr.Textbox(label="Prompt")
-        output_path = gr.Textbox(label="Output Path")
-        recursive = gr.Checkbox(label="Recursive")
-        button = gr.Button(value="Extract")
-        button.click(
-            fn=extract_exif_classify_text,
-            inputs=[inputs, text, output_path, recursive],
-        )
-    with gr.Tab("Extract Text from Folder"):
-        inputs = gr.Textbox(label="Folder with Images")
-        button = gr.Button(value="Extract")
-        button.click(
-            fn=extract_exif,
-            inputs=[inputs],
-        )
-    with gr.Tab("Convert PNG to WebP"):
-        inputs = gr.Textbox(label="Folder with Images")
-        button = gr.Button(value="Extract")
-        remove_original = gr.Checkbox(label="Remove original")
-        recursive = gr.Checkbox(label="Recursive")
-        button.click(
-            fn=convert_png_to_webp,
-            inputs=[inputs, remove_original, recursive],
-        )
-    with gr.Tab("Convert JPG to WebP"):
-        inputs = gr.Textbox(label="Folder with Images")
-        button = gr.Button(value="Extract")
-        remove_original = gr.Checkbox(label="Remove original")
-        recursive = gr.Checkbox(label="Recursive")
-        button.click(
-            fn=convert_jpg_to_webp,
-            inputs=[inputs, remove_original, recursive],
-        )
+def create_block():
+    import gradio as gr
+    with gr.Blocks(analytics_enabled=False) as block:
+        with gr.Tab("Extract Text"):
+            #inputs = gr.Image(type="pil", label="Original Image", source="upload")
+            input_path = gr.Textbox(label="Path to Image")
+            outputs = gr.Textbox(label="Extracted Text")
         
+            button = gr.Button(value="Extract")
+            button.click(
+                fn=classify_image,
+                inputs=[input_path],
+                outputs=[outputs],
+            )
+        with gr.Tab("Extract text from image(file)"):
+            input = gr.Image(label="source", sources="upload", type="pil",interactive=True,image_mode="RGBA")
+            outputs = gr.Textbox(label="Extracted Text")
+            button = gr.Button(value="Extract")
+            button.click(
+                fn=read_and_extract,
+                inputs=[input],
+                outputs=[outputs],
+            )
+        with gr.Tab("Classify Folder"):
+            inputs = gr.Textbox(label="Folder with Images")
+            button = gr.Button(value="Extract")
+            button.click(
+                fn=extract_exif_classify,
+                inputs=[inputs],
+            )
+        with gr.Tab("Classify Folder with matching prompt"):
+            inputs = gr.Textbox(label="Folder with Images")
+            text = gr.Textbox(label="Prompt")
+            output_path = gr.Textbox(label="Output Path")
+            recursive = gr.Checkbox(label="Recursive")
+            button = gr.Button(value="Extract")
+            button.click(
+                fn=extract_exif_classify_text,
+                inputs=[inputs, text, output_path, recursive],
+            )
+        with gr.Tab("Extract Text from Folder"):
+            inputs = gr.Textbox(label="Folder with Images")
+            button = gr.Button(value="Extract")
+            button.click(
+                fn=extract_exif,
+                inputs=[inputs],
+            )
+        with gr.Tab("Convert PNG to WebP"):
+            inputs = gr.Textbox(label="Folder with Images")
+            button = gr.Button(value="Extract")
+            remove_original = gr.Checkbox(label="Remove original")
+            recursive = gr.Checkbox(label="Recursive")
+            lossless = gr.Checkbox(label="Lossless (larger files, stealth payloads are always kept lossless)")
+            button.click(
+                # unchecked keeps the default: lossy, lossless only for stealth payloads
+                fn=lambda path, remove, recursive, lossless: convert_png_to_webp(path, remove, recursive, lossless=lossless or None),
+                inputs=[inputs, remove_original, recursive, lossless],
+            )
+        with gr.Tab("Convert JPG to WebP"):
+            inputs = gr.Textbox(label="Folder with Images")
+            button = gr.Button(value="Extract")
+            remove_original = gr.Checkbox(label="Remove original")
+            recursive = gr.Checkbox(label="Recursive")
+            lossless = gr.Checkbox(label="Lossless (larger files, stealth payloads are always kept lossless)")
+            button.click(
+                # unchecked keeps the default: lossy, lossless only for stealth payloads
+                fn=lambda path, remove, recursive, lossless: convert_jpg_to_webp(path, remove, recursive, lossless=lossless or None),
+                inputs=[inputs, remove_original, recursive, lossless],
+            )
+    return block
 
-block.launch()
+if __name__ == "__main__":
+    create_block().launch()
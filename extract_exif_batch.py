@@ -0,0 +1,188 @@
+"""
+Headless batch extraction of text chunk metadata and stealth pnginfo, for archives too large for the Gradio demo.
+Extraction runs in a process pool over chunks of files, results are written as sharded JSONL or SQLite.
+Records: path, mode, compressed, length (bits), payload, description, error.
+
+Usage:
+    python extract_exif_batch.py --path outputs --recursive --output extracted --workers 16
+    python extract_exif_batch.py --path outputs --output extracted.sqlite --format sqlite
+    python extract_exif_batch.py --path outputs --output extracted --move-without-exif outputs/without_exif
+    python extract_exif_batch.py --path outputs --output extracted --match "1girl" --move-matched outputs/matched
+"""
+import argparse
+import json
+import os
+import re
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List
+from PIL import Image
+from tqdm import tqdm
+from extract_exif import probe_stealth, read_info_from_image_stealth, read_metadata_chunks, has_generation_metadata, format_metadata_chunks, plan_moves, apply_moves
+
+def collect_files(path:str, recursive:bool = False, extensions=('.png',)) -> List[str]:
+    """
+    Collects image files, sorted for deterministic chunks.
+    """
+    files = []
+    if recursive:
+        for root, dirs, filenames in os.walk(path):
+            files.extend(os.path.join(root, file) for file in filenames if file.lower().endswith(extensions))
+    else:
+        with os.scandir(path) as entries:
+            files.extend(entry.path for entry in entries if entry.is_file() and entry.name.lower().endswith(extensions))
+    files.sort()
+    return files
+
+def extract_record(path:str) -> Dict:
+    """
+    Extracts metadata of single file. Text chunks are read first (mode 'chunk'), then stealth pnginfo.
+    Files without either are not fully decoded. Non-json payloads are kept as plain text, error is only set when reading fails.
+    """
+    record = {'path': path, 'mode': None, 'compressed': False, 'length': -1, 'payload': '', 'description': None, 'error': None}
+    try:
+        metadata = read_metadata_chunks(path)
+        if has_generation_metadata(metadata):
+            record.update(mode='chunk', payload=format_metadata_chunks(metadata), description=metadata.get('ImageDescription'))
+            if 'parameters' in metadata or 'Description' not in metadata.get('Comment', ''):
+                return record
+            # NovelAI keeps json in Comment chunk, description is parsed from it
+            record['payload'] = metadata['Comment']
+        else:
+            mode, compressed, length = probe_stealth(path)
+            record.update(mode=mode, compressed=compressed, length=length)
+            if mode is None:
+                return record
+            with Image.open(path) as image:
+                record['payload'] = read_info_from_image_stealth(image)
+    except Exception as exception:
+        record['error'] = f'{type(exception).__name__}: {exception}'
+        return record
+    if not record['payload']:
+        record['error'] = 'payload could not be decoded'
+        return record
+    try:
+        parsed = json.loads(record['payload'])
+    except json.JSONDecodeError:
+        return record # plain text payload, as webui writes it
+    if isinstance(parsed, dict):
+        record['description'] = parsed.get('Description')
+    return record
+
+def extract_chunk(paths:List[str]) -> List[Dict]:
+    """
+    Worker entry, extracts a chunk of files.
+    """
+    return [extract_record(path) for path in paths]
+
+class JsonlShardWriter:
+    """
+    Writes records into <output>/extract-<i>.jsonl, new shard every shard_size records.
+    """
+    def __init__(self, output:str, shard_size:int = 100000):
+        os.makedirs(output, exist_ok=True)
+        self.output = output
+        self.shard_size = shard_size
+        self.shard_index = 0
+        self.count = 0
+        self.file = None
+
+    def write(self, records:List[Dict]):
+        for record in records:
+            if self.file is None or self.count >= self.shard_size:
+                self.close()
+                self.file = open(os.path.join(self.output, f'extract-{self.shard_index:05d}.jsonl'), 'w', encoding='utf-8')
+                self.shard_index += 1
+                self.count = 0
+            self.file.write(json.dumps(record, ensure_ascii=False) + '\n')
+            self.count += 1
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+class SqliteWriter:
+    """
+    Writes records into sqlite table 'extract', keyed by path.
+    """
+    COLUMNS = ('path', 'mode', 'compressed', 'length', 'payload', 'description', 'error')
+
+    def __init__(self, output:str):
+        self.connection = sqlite3.connect(output)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS extract (path TEXT PRIMARY KEY, mode TEXT, compressed INTEGER, length INTEGER, payload TEXT, description TEXT, error TEXT)')
+
+    def write(self, records:List[Dict]):
+        with self.connection:
+            self.connection.executemany(
+                f'INSERT OR REPLACE INTO extract VALUES ({",".join("?" * len(self.COLUMNS))})',
+                [tuple(record[column] for column in self.COLUMNS) for record in records])
+
+    def close(self):
+        self.connection.close()
+
+def batch_extract(files:List[str], writer, workers:int = 8, chunk_size:int = 256, on_records=None) -> Dict[str, int]:
+    """
+    Extracts files in process pool with chunked work assignment and writes records with writer.
+    on_records is called with every finished chunk. Returns counters.
+    """
+    chunks = [files[i:i + chunk_size] for i in range(0, len(files), chunk_size)]
+    counters = {'files': 0, 'with_payload': 0, 'errors': 0}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(extract_chunk, chunk) for chunk in chunks]
+        with tqdm(total=len(files)) as pbar:
+            for future in as_completed(futures):
+                records = future.result()
+                writer.write(records)
+                if on_records is not None:
+                    on_records(records)
+                counters['files'] += len(records)
+                counters['with_payload'] += sum(1 for record in records if record['mode'] is not None)
+                counters['errors'] += sum(1 for record in records if record['error'])
+                pbar.update(len(records))
+    return counters
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path', type=str, required=True, help='Folder with images')
+    parser.add_argument('--recursive', action='store_true', help='Recursive')
+    parser.add_argument('--ext', type=str, nargs='+', default=['.png'], help='Image extensions')
+    parser.add_argument('--output', type=str, required=True, help='Output folder (jsonl) or database file (sqlite)')
+    parser.add_argument('--format', type=str, default='jsonl', choices=['jsonl', 'sqlite'], help='Output format')
+    parser.add_argument('--shard-size', type=int, default=100000, help='Records per jsonl shard')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Worker processes')
+    parser.add_argument('--chunk-size', type=int, default=256, help='Files per work chunk')
+    parser.add_argument('--move-without-exif', type=str, default=None, help='Move files without payload into this folder')
+    parser.add_argument('--match', type=str, default=None, help='Regex, case insensitive, matched against payload')
+    parser.add_argument('--move-matched', type=str, default=None, help='Move files matching --match into this folder')
+    args = parser.parse_args()
+    files = collect_files(args.path, args.recursive, tuple(ext.lower() for ext in args.ext))
+    print(f"Found {len(files)} files")
+    writer = JsonlShardWriter(args.output, args.shard_size) if args.format == 'jsonl' else SqliteWriter(args.output)
+    without_exif, matched = [], []
+    pattern = re.compile(args.match, re.IGNORECASE) if args.match else None
+    def collect_moves(records):
+        for record in records:
+            if record['mode'] is None and not record['error']:
+                without_exif.append(record['path'])
+            if pattern is not None and pattern.search(record['payload']):
+                matched.append(record['path'])
+    try:
+        counters = batch_extract(files, writer, args.workers, args.chunk_size, on_records=collect_moves)
+    finally:
+        writer.close()
+    print(f"Extracted {counters['files']} files, {counters['with_payload']} with payload, {counters['errors']} errors")
+    # moves are planned once from all results, then applied
+    plan = []
+    if args.move_without_exif:
+        plan += plan_moves(sorted(without_exif), args.move_without_exif)
+    if args.move_matched and pattern is not None:
+        plan += plan_moves(sorted(set(matched) - {source for source, _ in plan}), args.move_matched)
+    if plan:
+        plan_path = os.path.join(args.output, 'moves.jsonl') if args.format == 'jsonl' else args.output + '.moves.jsonl'
+        with open(plan_path, 'w', encoding='utf-8') as f:
+            for source, target in plan:
+                f.write(json.dumps({'source': source, 'target': target}, ensure_ascii=False) + '\n')
+        print(f"Moving {len(plan)} files, plan written to {plan_path}")
+        apply_moves(plan)
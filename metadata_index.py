@@ -0,0 +1,219 @@
+"""
+Persistent searchable index of extracted generation metadata (SQLite FTS5).
+Files are keyed by path, size and mtime, re-scans only extract new or changed files.
+Prompt searches and classification run as queries against the index, without decoding images again.
+
+Usage:
+    python metadata_index.py --index archive.sqlite scan --path outputs --recursive
+    python metadata_index.py --index archive.sqlite search --keyword "1girl solo"
+    python metadata_index.py --index archive.sqlite search --regex "steps\\W+28"
+    python metadata_index.py --index archive.sqlite classify --regex "yuri" --output matched
+"""
+import argparse
+import os
+import re
+import sqlite3
+from typing import Dict, Iterator, List, Optional, Tuple
+from extract_exif import plan_moves, apply_moves
+from extract_exif_batch import batch_extract
+
+class MetadataIndex:
+    """
+    SQLite index of extraction records, with FTS5 table over payload and description.
+    FTS rows use the id of their files row as rowid, so updates and deletes are rowid lookups instead of FTS scans.
+    id is an INTEGER PRIMARY KEY, which VACUUM keeps, unlike an implicit rowid.
+    Paths are stored absolute.
+    """
+    def __init__(self, index_path:str):
+        self.connection = sqlite3.connect(index_path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.create_function('REGEXP', 2, _regexp, deterministic=True)
+        with self.connection:
+            file_columns = [row[1] for row in self.connection.execute('PRAGMA table_info(files)')]
+            migrating = bool(file_columns) and 'id' not in file_columns
+            if migrating:
+                # older indexes keyed files by path with an implicit rowid, copy into the id schema
+                self.connection.execute('ALTER TABLE files RENAME TO files_old')
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS files (
+                id INTEGER PRIMARY KEY, path TEXT UNIQUE, size INTEGER, mtime_ns INTEGER, mode TEXT, compressed INTEGER,
+                length INTEGER, payload TEXT, description TEXT, error TEXT)''')
+            columns = [row[1] for row in self.connection.execute('PRAGMA table_info(files_fts)')]
+            if migrating:
+                self.connection.execute(f'INSERT INTO files ({_COLUMNS}) SELECT {_COLUMNS} FROM files_old')
+                self.connection.execute('DROP TABLE files_old')
+                self.connection.execute('DROP TABLE IF EXISTS files_fts')
+                columns = []
+            elif 'path' in columns:
+                # older indexes keyed fts rows by an unindexed path column, rebuild keyed by id
+                self.connection.execute('DROP TABLE files_fts')
+                columns = []
+            if not columns:
+                self.connection.execute('CREATE VIRTUAL TABLE files_fts USING fts5(payload, description)')
+                self.connection.execute("INSERT INTO files_fts (rowid, payload, description) SELECT id, payload, description FROM files WHERE payload != ''")
+        self.stats: Dict[str, Tuple[int, int]] = {}
+
+    def indexed_stats(self) -> Dict[str, Tuple[int, int]]:
+        """
+        Returns path -> (size, mtime_ns) of indexed files.
+        """
+        return {path: (size, mtime_ns) for path, size, mtime_ns in self.connection.execute('SELECT path, size, mtime_ns FROM files')}
+
+    def write(self, records:List[Dict]):
+        """
+        Upserts extraction records, size and mtime are taken from self.stats captured at scan time.
+        """
+        rows = []
+        for record in records:
+            size, mtime_ns = self.stats.get(record['path'], (None, None))
+            rows.append((record['path'], size, mtime_ns, record['mode'], record['compressed'], record['length'],
+                         record['payload'], record['description'], record['error']))
+        with self.connection:
+            # upsert keeps the id of existing rows, only their fts row is replaced
+            self.connection.executemany(_DELETE_FTS, [(row[0],) for row in rows])
+            self.connection.executemany(f'''INSERT INTO files ({_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(path) DO UPDATE SET size = excluded.size, mtime_ns = excluded.mtime_ns, mode = excluded.mode,
+                compressed = excluded.compressed, length = excluded.length, payload = excluded.payload,
+                description = excluded.description, error = excluded.error''', rows)
+            self.connection.executemany('INSERT INTO files_fts (rowid, payload, description) SELECT id, ?, ? FROM files WHERE path = ?',
+                                        [(row[6], row[7], row[0]) for row in rows if row[6]])
+
+    def remove(self, paths:List[str]):
+        with self.connection:
+            self.connection.executemany(_DELETE_FTS, [(path,) for path in paths])
+            self.connection.executemany('DELETE FROM files WHERE path = ?', [(path,) for path in paths])
+
+    def rename(self, moves:List[Tuple[str, str]]):
+        """
+        Updates paths after files were moved, ids and so fts rows stay.
+        """
+        with self.connection:
+            self.connection.executemany('UPDATE files SET path = ? WHERE path = ?',
+                                        [(os.path.abspath(target), os.path.abspath(source)) for source, target in moves])
+
+    def scan(self, path:str, recursive:bool = False, extensions=('.png',), workers:int = 8, chunk_size:int = 256, prune:bool = False) -> Dict[str, int]:
+        """
+        Extracts new or changed files under path. Unchanged files (same size and mtime) are skipped.
+        If prune, indexed files which no longer exist are removed, only in the folders that were scanned.
+        """
+        path = os.path.abspath(path)
+        current = dict(_stat_files(path, recursive, extensions))
+        indexed = self.indexed_stats()
+        changed = sorted(file for file, stat in current.items() if indexed.get(file) != stat)
+        self.stats = {file: current[file] for file in changed}
+        print(f"Found {len(current)} files, {len(changed)} new or changed")
+        counters = batch_extract(changed, self, workers, chunk_size) if changed else {'files': 0, 'with_payload': 0, 'errors': 0}
+        if prune:
+            if recursive:
+                removed = [file for file in indexed if file.startswith(path + os.sep) and file not in current]
+            else:
+                removed = [file for file in indexed if os.path.dirname(file) == path and file not in current]
+            self.remove(removed)
+            counters['removed'] = len(removed)
+        return counters
+
+    def search(self, keyword:Optional[str] = None, regex:Optional[str] = None, prefix:Optional[str] = None) -> Iterator[Tuple[str, str]]:
+        """
+        Yields (path, payload) of files matching FTS5 keyword query and / or case insensitive regex.
+        prefix limits results to paths starting with it.
+        """
+        if keyword:
+            query = 'SELECT files.path, files.payload FROM files_fts JOIN files ON files.id = files_fts.rowid WHERE files_fts MATCH ?'
+            params = [keyword]
+        else:
+            query = "SELECT path, payload FROM files WHERE payload != ''"
+            params = []
+        if regex:
+            query += ' AND files.payload REGEXP ?' if keyword else ' AND payload REGEXP ?'
+            params.append(regex)
+        if prefix:
+            query += ' AND instr(files.path, ?) = 1' if keyword else ' AND instr(path, ?) = 1'
+            params.append(prefix)
+        yield from self.connection.execute(query, params)
+
+    def without_payload(self, prefix:Optional[str] = None) -> List[str]:
+        """
+        Returns paths of files without payload, prefix limits them like in search.
+        """
+        query = 'SELECT path FROM files WHERE mode IS NULL AND error IS NULL'
+        params = []
+        if prefix:
+            query += ' AND instr(path, ?) = 1'
+            params.append(prefix)
+        return [path for path, in self.connection.execute(query, params)]
+
+    def close(self):
+        self.connection.close()
+
+_COLUMNS = 'path, size, mtime_ns, mode, compressed, length, payload, description, error'
+_DELETE_FTS = 'DELETE FROM files_fts WHERE rowid IN (SELECT id FROM files WHERE path = ?)'
+
+def _regexp(pattern, value) -> bool:
+    if value is None:
+        return False
+    return _compile(pattern).search(value) is not None
+
+_compiled = {}
+def _compile(pattern):
+    if pattern not in _compiled:
+        _compiled[pattern] = re.compile(pattern, re.IGNORECASE)
+    return _compiled[pattern]
+
+def _stat_files(path:str, recursive:bool, extensions) -> Iterator[Tuple[str, Tuple[int, int]]]:
+    """
+    Yields (path, (size, mtime_ns)) using scandir entries, no extra stat calls on most platforms.
+    """
+    stack = [path]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    if recursive:
+                        stack.append(entry.path)
+                elif entry.name.lower().endswith(extensions):
+                    stat = entry.stat()
+                    yield entry.path, (stat.st_size, stat.st_mtime_ns)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--index', type=str, required=True, help='Index database file')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    scan_parser = subparsers.add_parser('scan', help='Extract new or changed files into the index')
+    scan_parser.add_argument('--path', type=str, required=True, help='Folder with images')
+    scan_parser.add_argument('--recursive', action='store_true', help='Recursive')
+    scan_parser.add_argument('--ext', type=str, nargs='+', default=['.png'], help='Image extensions')
+    scan_parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Worker processes')
+    scan_parser.add_argument('--chunk-size', type=int, default=256, help='Files per work chunk')
+    scan_parser.add_argument('--prune', action='store_true', help='Remove deleted files from index')
+    for name, help_text in [('search', 'Print paths matching query'), ('classify', 'Move files matching query')]:
+        query_parser = subparsers.add_parser(name, help=help_text)
+        query_parser.add_argument('--keyword', type=str, default=None, help='FTS5 query, e.g. "1girl AND solo"')
+        query_parser.add_argument('--regex', type=str, default=None, help='Case insensitive regex over payload')
+        query_parser.add_argument('--prefix', type=str, default=None, help='Only paths starting with prefix')
+        if name == 'search':
+            query_parser.add_argument('--show-payload', action='store_true', help='Print payload too')
+        else:
+            query_parser.add_argument('--output', type=str, required=True, help='Folder to move matched files into')
+            query_parser.add_argument('--without-payload', action='store_true', help='Move files without payload instead')
+    args = parser.parse_args()
+    index = MetadataIndex(args.index)
+    # paths are stored absolute
+    prefix = None
+    if getattr(args, 'prefix', None):
+        prefix = os.path.abspath(args.prefix) + (os.sep if args.prefix.endswith(('/', os.sep)) else '')
+    try:
+        if args.command == 'scan':
+            print(index.scan(args.path, args.recursive, tuple(ext.lower() for ext in args.ext), args.workers, args.chunk_size, args.prune))
+        elif args.command == 'search':
+            for path, payload in index.search(args.keyword, args.regex, prefix):
+                print(f"{path}\t{payload}" if args.show_payload else path)
+        else:
+            if args.without_payload:
+                paths = index.without_payload(prefix)
+            else:
+                paths = [path for path, _ in index.search(args.keyword, args.regex, prefix)]
+            plan = plan_moves(sorted(path for path in paths if os.path.exists(path)), os.path.abspath(args.output))
+            apply_moves(plan)
+            index.rename(plan)
+            print(f"Moved {len(plan)} files")
+    finally:
+        index.close()
@@ -2,7 +2,6 @@ import pathlib
 import os
 import sys
 import json
-import glob
 import argparse
 from typing import List, Optional, Union
 import time
@@ -13,9 +12,13 @@ from concurrent.futures import ThreadPoolExecutor, as_completed
 from converter import generate_request, analyze_model_response
 from utils.proxyhandler import ProxyHandler, SingleProxyHandler
 from utils.apihandler import APIKeyIterator, SingleAPIkey, AbstractAPIIterator
+from utils.dedup import DedupIndex
+from utils.storage import list_files, register_path
+from utils.captions import get_tags_list, read_result, sanity_check
 
 POLICY = 'default' # default, skip_existing
 SLEEP_TIME = 1.1
+DEDUP_INDEX:Optional[DedupIndex] = None # if set, captions are reused from already captioned duplicates
 
 proxies = None
 api_keys = None
@@ -78,44 +81,36 @@ def tags_formatted(image_path):
         tags = f.read()
     return tags
 
-def get_tags_list(tags:str) -> List[str]:
+def reuse_duplicate_caption(image_path, dedup_index:Optional[DedupIndex] = None) -> bool:
     """
-    Removes <x>: types from the tags.
+    Copies the result of an already captioned duplicate image, if any. An existing own caption is never replaced.
+    Returns True if the caption was reused.
     """
-    tags = tags.split()
-    return tags
-
-
-def read_result(image_path):
-    """
-    Reads Generated or Annotated text from the given image path.
-    """
-    extension = pathlib.Path(image_path).suffix
-    if os.path.exists(image_path.replace(extension, '_gemini.txt')):
-        with open(image_path.replace(extension, '_gemini.txt'), 'r',encoding='utf-8') as f:
-            result = f.read()
-    elif os.path.exists(image_path.replace(extension, '_annotated.txt')):
-        with open(image_path.replace(extension, '_annotated.txt'), 'r',encoding='utf-8') as f:
-            result = f.read()
-    else:
-        result = None
-    return result
-
-def sanity_check(tags, result):
-    """
-    Checks if all tags are in the caption.
-    """
-    excluded_tags = ['original', 'error']
-    tags = get_tags_list(tags)
-    tags = [t.replace('_', ' ').replace('-', ' ') for ts in tags for t in ts.split(' ')]
-    if result is None:
-        return tags
-    else:
-        result = result.replace('_', ' ').replace('-', ' ')
-        tags_not_in_caption = [t for t in tags if t.lower() not in result.lower() and t not in excluded_tags] 
-        # if tags_not_in_caption:
-        #     return " ".join(tags_not_in_caption)
-        return tags_not_in_caption
+    dedup_index = dedup_index or DEDUP_INDEX
+    target = image_path.replace(pathlib.Path(image_path).suffix, '_gemini.txt')
+    if dedup_index is None or os.path.exists(target):
+        return False
+    try:
+        duplicates = dedup_index.find_duplicates(image_path)
+    except Exception as e:
+        print(f"Error occured while searching duplicates for {image_path}! {e}")
+        return False
+    for distance, duplicate_path in duplicates:
+        if os.path.abspath(duplicate_path) == os.path.abspath(image_path):
+            continue
+        result = read_result(duplicate_path)
+        if result is None:
+            continue
+        try:
+            # exclusive create, a caption written meanwhile by another thread wins
+            with open(target, 'x', encoding='utf-8') as f:
+                f.write(result)
+        except FileExistsError:
+            return False
+        register_path(target)
+        print(f"Reused caption of {duplicate_path} for {image_path}, distance {distance}")
+        return True
+    return False
 
 def merge_strings(strings_or_images:List[Union[str, Image.Image]]) -> str:
     """
@@ -223,6 +218,7 @@ def generate_text(image_path, return_input=False, previous_result=None, api_key=
                 if response:
                     with open(image_path.replace(extension, '_gemini_error.txt'), 'w', encoding='utf-8') as f:
                         f.write(str(response))
+                    register_path(image_path.replace(extension, '_gemini_error.txt'))
             return previous_result
         
         else:
@@ -289,6 +285,10 @@ def query_gemini_file(image_path:str, optional_progress_bar:tqdm.tqdm = None, ma
     least_sanity_count = float('inf')
     best_text = None
     sanity_count_list = []
+    if reuse_duplicate_caption(image_path):
+        if optional_progress_bar is not None:
+            optional_progress_bar.update(1)
+        return
     # if exists, skip by policy
     for attempt in range (max_retries + 1):
         all_generated_texts = []
@@ -304,12 +304,14 @@ def query_gemini_file(image_path:str, optional_progress_bar:tqdm.tqdm = None, ma
             if best_text is not None:
                 with open(image_path.replace(extension, '_gemini.txt'), 'w', encoding='utf-8') as f:
                     f.write(best_text)
+                register_path(image_path.replace(extension, '_gemini.txt'))
                 # write other texts
                 for i, text in enumerate(texts):
                     if i == sanity_count_list.index(least_sanity_count):
                         continue
                     with open(image_path.replace(extension, f'_gemini_{i}.txt'), 'w', encoding='utf-8') as f:
                         f.write(text)
+                    register_path(image_path.replace(extension, f'_gemini_{i}.txt'))
             return
         except Exception as e:
             if isinstance(e, FileExistsError):
@@ -375,7 +377,7 @@ def load_paths(string:str, extension:str=".png") -> List[str]:
             with open(string, 'r',encoding='utf-8') as f:
                 paths = json.load(f)
     else:
-        paths = glob.glob(os.path.join(string, f'*{extension}'))
+        paths = list_files(string, f'*{extension}')
     # filter out txt and json
     paths = [path for path in paths if not path.endswith('.txt') and not path.endswith('.json')]
     return paths
@@ -399,9 +401,12 @@ if __name__ == '__main__':
     parser.add_argument('--max_retries', type=int, default=5, help='Max retries to use')
     # policy, skip_existing, default
     parser.add_argument('--policy', type=str, default='default', help='Policy to use, skip_existing, default')
+    parser.add_argument('--dedup_index', type=str, default=None, help='Dedup index file (utils/dedup.py), reuses captions of duplicates')
     args = parser.parse_args()
     api_arg = args.api_key
     POLICY = args.policy
+    if args.dedup_index:
+        DEDUP_INDEX = DedupIndex.load(args.dedup_index)
     api_arg = load_secret(api_arg)
     if args.api_key_file:
         api_keys = APIKeyIterator(args.api_key_file, rate_limit=args.sleep_time)
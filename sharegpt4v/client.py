@@ -0,0 +1,86 @@
+"""
+Client of server.py, stdlib only.
+
+Usage:
+    from client import CaptionClient
+    client = CaptionClient('http://127.0.0.1:8765')   # or 'unix:///tmp/sharecaptioner.sock'
+    caption = client.caption('/data/images/1.png', tags='1girl, solo')
+    captions = client.caption_many(['/data/images/1.png', '/data/images/2.png'])
+
+    python client.py --server http://127.0.0.1:8765 /data/images/1.png /data/images/2.png
+"""
+import argparse
+import http.client
+import json
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+from urllib.parse import urlparse
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path:str, timeout:float = None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+class CaptionClient:
+    """
+    :param server: http://host:port or unix:///path/to/socket
+    :param timeout: seconds per request, captions of a busy server may take long
+    """
+    def __init__(self, server:str = 'http://127.0.0.1:8765', timeout:float = 600.0):
+        self.server = urlparse(server)
+        self.timeout = timeout
+
+    def _connection(self) -> http.client.HTTPConnection:
+        if self.server.scheme == 'unix':
+            return UnixHTTPConnection(self.server.path, self.timeout)
+        return http.client.HTTPConnection(self.server.hostname, self.server.port or 80, timeout=self.timeout)
+
+    def _request(self, method:str, path:str, payload:dict = None) -> dict:
+        connection = self._connection()
+        try:
+            body = json.dumps(payload).encode('utf-8') if payload is not None else None
+            connection.request(method, path, body=body, headers={'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            result = json.loads(response.read())
+        finally:
+            connection.close()
+        if response.status != 200:
+            raise RuntimeError(f"Server returned {response.status}: {result.get('error')}")
+        return result
+
+    def caption(self, image:str, tags:Optional[str] = None) -> str:
+        """
+        Caption of one image path or url, as seen by the server.
+        """
+        return self._request('POST', '/caption', {'image': image, 'tags': tags})['caption']
+
+    def caption_many(self, images:List[str], tags:List[Optional[str]] = None) -> List[str]:
+        """
+        Captions in input order, sent in one request so the server can batch them.
+        """
+        return self._request('POST', '/caption', {'images': images, 'tags': tags})['captions']
+
+    def health(self) -> dict:
+        return self._request('GET', '/health')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('images', nargs='+', help='image paths or urls')
+    parser.add_argument('--server', type=str, default='http://127.0.0.1:8765', help='http://host:port or unix:///path/to/socket')
+    parser.add_argument('--tags', type=str, default=None, help='tags for all images')
+    parser.add_argument('--concurrency', type=int, default=1, help='parallel single image requests instead of one request')
+    args = parser.parse_args()
+    client = CaptionClient(args.server)
+    if args.concurrency > 1:
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            captions = list(executor.map(lambda image: client.caption(image, args.tags), args.images))
+    else:
+        captions = client.caption_many(args.images, [args.tags] * len(args.images))
+    for image, caption in zip(args.images, captions):
+        print(json.dumps({image: caption}, ensure_ascii=False))
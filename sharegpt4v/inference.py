@@ -1,5 +1,7 @@
 import argparse
 from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import glob
+import hashlib
 import json
 import io
 import os
@@ -11,6 +13,7 @@ from tqdm import tqdm
 from PIL import Image
 import logging
 
+import numpy as np
 import torch
 from torch.nn import DataParallel
 from transformers import AutoModelForCausalLM, AutoTokenizer
@@ -18,6 +21,16 @@ from transformers import AutoModelForCausalLM, AutoTokenizer
 log_file = 'inference.log'
 logging.basicConfig(filename=log_file, level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
+DEFAULT_GENERATION_PARAMS = {
+    "max_length": 500,
+    "num_beams": 3,
+    "min_length": 1,
+    "do_sample": True,
+    "repetition_penalty": 1.5,
+    "length_penalty": 1.0,
+    "temperature": 1.0,
+}
+
 def download_image_web(image_url:str) -> Image.Image:
     """
     Download image from web.
@@ -40,13 +53,14 @@ def parse_args():
     Parse input arguments.
     """
     parser = argparse.ArgumentParser()
-    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--batch-size", type=int, default=8, help="maximum batch size, halved on out of memory")
     parser.add_argument("--model-name", type=str,
                         default="Lin-Chen/ShareCaptioner")
     parser.add_argument("--images-file", type=str, default=None,
                         help="a list, each element is a string for image path")
     parser.add_argument("--single-image-url", type=str, default=None) # for demo-like
-    parser.add_argument("--save-path", type=str, default="captions.json")
+    parser.add_argument("--save-path", type=str, default="captions.json", help="jsonl, workers write <save-path>.shard-<i>.jsonl, merged at the end")
+    parser.add_argument("--no-resume", action="store_true", help="caption images already in save path or its shards again")
     # device
     parser.add_argument("--device", type=str, default="cuda:0")
     parser.add_argument("--reference-tags-file", type=str, default=None, help="a list of tags, to be references or reordered.")
@@ -60,6 +74,10 @@ def parse_args():
     #parser.add_argument("--data-parallel", action="store_true", help="use data parallel")
     # for debugging / test, limit number of images
     parser.add_argument("--images-limit", type=int, default=None)
+    # prompt prefix key/value cache
+    parser.add_argument("--no-prefix-cache", action="store_true", help="with --instruction-before-image, run the whole prompt for every batch")
+    parser.add_argument("--feature-cache-dir", type=str, default=None, help="cache vision embeddings here, reused by later runs")
+    parser.add_argument("--instruction-before-image", action="store_true", help="move the fixed instruction before the image and cache its keys and values once per worker")
     arguments = parser.parse_args()
     return arguments
 
@@ -72,67 +90,287 @@ def format_text(text, tags:str=None):
     else:
         return text.replace("%tags", tags)
 
-def inference(model, imgs:Generator, tags:List[Optional[str]], seg2, seg_emb1, batch_size=4, stream=False, generation_params=None, dtype="float32"):
+def prompt_order(model, tags:List[Optional[str]], seg2:str) -> List[int]:
     """
-    Inference.
-    if stream is True, yield each result.
-    """
-    captions = []
-    part_len = len(tags)
-    chunk_size = part_len//batch_size
-    if part_len % batch_size != 0:
-        chunk_size += 1
-    _i = 0
-    with tqdm(range(chunk_size),total=part_len, desc='BATCH') as pbar:
-        for i in pbar:
-            print(f'{i}/{chunk_size}')
-            subs = []
-            logging.info(f"Processing batch {i}")
-            pbar.set_postfix_str(f'Preparing items...')
-            for j in range(batch_size):
-                if i*batch_size+j < part_len:
+    Returns item indices sorted by tokenized prompt length, longest first.
+    Neighbouring items have similar lengths so padding stays small, and an out of memory shows up in the first batch.
+    """
+    lengths = [len(model.tokenizer(format_text(seg2, tag), add_special_tokens=False).input_ids) for tag in tags]
+    return sorted(range(len(tags)), key=lambda i: -lengths[i])
+
+def pad_left(embeddings:List[torch.Tensor]):
+    """
+    Left pads [1, length, dim] embeddings to [batch, max length, dim], returns (embeddings, attention mask).
+    Left padding keeps the last prompt token next to the generated ones.
+    """
+    max_length = max(embedding.shape[1] for embedding in embeddings)
+    padded = embeddings[0].new_zeros(len(embeddings), max_length, embeddings[0].shape[-1])
+    attention_mask = torch.zeros(len(embeddings), max_length, dtype=torch.long, device=embeddings[0].device)
+    for i, embedding in enumerate(embeddings):
+        padded[i, max_length - embedding.shape[1]:] = embedding[0]
+        attention_mask[i, max_length - embedding.shape[1]:] = 1
+    return padded, attention_mask
+
+def expand_cache(past_key_values, repeats:int):
+    """
+    Repeats each batch row of a legacy (key, value) per layer cache, as generate expands input ids for beams.
+    """
+    if hasattr(past_key_values, 'to_legacy_cache'):
+        past_key_values = past_key_values.to_legacy_cache()
+    return tuple(tuple(tensor.repeat_interleave(repeats, dim=0) for tensor in layer) for layer in past_key_values)
+
+class PrefixCache:
+    """
+    Key/value cache of the constant prompt prefix, computed once per worker.
+    Batches run only image embeddings and prompt tokens over the expanded cache.
+    """
+    def __init__(self, model, prefix_emb, dtype="float32"):
+        with torch.cuda.amp.autocast():
+            with torch.no_grad():
+                output = model.internlm_model(inputs_embeds=prefix_emb.to(dtype=dtype), use_cache=True)
+        self.past_key_values = expand_cache(output.past_key_values, 1)
+        self.length = prefix_emb.shape[1]
+
+    def generate(self, model, image_embeds, prompts:List[str], generation_params=None, dtype="float32"):
+        """
+        Runs image embeddings and all prompt tokens but the last over the cache, generate continues from the last prompt token.
+        Padding sits between prefix and image, masked out. Returns generated token ids.
+        """
+        generation_params = generation_params or DEFAULT_GENERATION_PARAMS
+        last_ids = torch.cat([model.tokenizer(prompt, return_tensors='pt', add_special_tokens=False).input_ids[:, -1:] for prompt in prompts]).cuda()
+        sequences = [torch.cat([image_embeds[j:j+1], model.encode_text(prompt, add_special_tokens=False)[:, :-1]], dim=1)
+                     for j, prompt in enumerate(prompts)]
+        suffix_emb, suffix_mask = pad_left(sequences)
+        batch_size = len(prompts)
+        attention_mask = torch.cat([suffix_mask.new_ones(batch_size, self.length), suffix_mask, suffix_mask.new_ones(batch_size, 1)], dim=1)
+        # positions continue over the padding gap, as generate derives them from the mask
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)[:, self.length:-1]
+        output = model.internlm_model(inputs_embeds=suffix_emb.to(dtype=dtype),
+                                      past_key_values=expand_cache(self.past_key_values, batch_size),
+                                      attention_mask=attention_mask[:, :-1],
+                                      position_ids=position_ids,
+                                      use_cache=True)
+        out = model.internlm_model.generate(input_ids=last_ids,
+                                            attention_mask=attention_mask,
+                                            past_key_values=expand_cache(output.past_key_values, generation_params.get("num_beams", 1)),
+                                            eos_token_id=model.tokenizer.eos_token_id,
+                                            num_return_sequences=1,
+                                            **generation_params
+                                            )
+        # drop the last prompt token
+        return out[:, 1:]
+
+class FeatureCache:
+    """
+    On-disk cache of vision encoder embeddings, keyed by image hash, one folder per model.
+    Each worker appends float16 rows to its own features-<worker>.bin and {key: [file, row]} lines to index-<worker>.jsonl,
+    rows are read back through memory maps. Data is flushed before its index line, so the index never points past the data.
+    """
+    def __init__(self, cache_dir:str, model_name:str, worker:str = "0"):
+        self.path = os.path.join(cache_dir, model_name.replace("/", "__"))
+        os.makedirs(self.path, exist_ok=True)
+        self.meta_path = os.path.join(self.path, "meta.json")
+        self.shape = None
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, 'r', encoding='utf-8') as f:
+                self.shape = tuple(json.load(f)["shape"])
+        self.index = {}
+        for index_path in sorted(glob.glob(os.path.join(self.path, "index-*.jsonl"))):
+            with open(index_path, 'r', encoding='utf-8') as f:
+                for line in f:
                     try:
-                        image = next(imgs)
-                    except StopIteration:
-                        break
-                    subs.append(model.vis_processor(image).unsqueeze(0))
-            if len(subs) == 0:
-                break
-            logging.info(f"Batch {i} prepared")
+                        self.index.update(json.loads(line))
+                    except json.JSONDecodeError:
+                        continue # cut by a crash
+        self.data_name = f"features-{worker}.bin"
+        self.index_name = f"index-{worker}.jsonl"
+        self.data_file = None
+        self.index_file = None
+        self.rows = 0
+        self.maps = {}
+
+    def key(self, image_path:str) -> str:
+        """
+        sha1 of file content (of the url if not a local file), without decoding.
+        """
+        digest = hashlib.sha1()
+        if os.path.exists(image_path):
+            with open(image_path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(block)
+        else:
+            digest.update(image_path.encode('utf-8'))
+        return digest.hexdigest()
+
+    def keys(self, image_paths:List[str], max_workers:int = 8) -> List[str]:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(self.key, image_paths))
+
+    def __contains__(self, key:str) -> bool:
+        return key in self.index
+
+    def get(self, key:str) -> np.ndarray:
+        data_name, row = self.index[key]
+        features = self.maps.get(data_name)
+        if features is None or row >= len(features):
+            # own file grows while running, map again
+            data_path = os.path.join(self.path, data_name)
+            rows = os.path.getsize(data_path) // (int(np.prod(self.shape)) * 2)
+            features = self.maps[data_name] = np.memmap(data_path, dtype=np.float16, mode='r', shape=(rows, *self.shape))
+        return features[row]
+
+    def _open(self, shape):
+        if self.shape is None:
+            self.shape = tuple(shape)
+            with open(self.meta_path, 'w', encoding='utf-8') as f:
+                json.dump({"shape": list(self.shape), "dtype": "float16"}, f)
+        elif tuple(shape) != self.shape:
+            raise ValueError(f"Feature shape {tuple(shape)} does not match cache shape {self.shape} in {self.path}")
+        data_path = os.path.join(self.path, self.data_name)
+        row_bytes = int(np.prod(self.shape)) * 2
+        self.data_file = open(data_path, 'ab')
+        # drop a row cut by a crash, so appended rows stay aligned
+        self.rows = os.path.getsize(data_path) // row_bytes
+        self.data_file.truncate(self.rows * row_bytes)
+        self.index_file = open(os.path.join(self.path, self.index_name), 'a', encoding='utf-8')
+
+    def put(self, keys:List[str], features:np.ndarray):
+        """
+        Appends [batch, tokens, dim] features of keys, keys already cached (or repeated in the batch) are skipped.
+        """
+        rows = {}
+        for i, key in enumerate(keys):
+            if key not in self.index and key not in rows:
+                rows[key] = i
+        if not rows:
+            return
+        keys, features = list(rows), features[list(rows.values())]
+        if self.data_file is None:
+            self._open(features.shape[1:])
+        self.data_file.write(np.ascontiguousarray(features, dtype=np.float16).tobytes())
+        self.data_file.flush()
+        for key in keys:
+            self.index[key] = [self.data_name, self.rows]
+            self.index_file.write(json.dumps({key: [self.data_name, self.rows]}) + '\n')
+            self.rows += 1
+        self.index_file.flush()
+
+    def close(self):
+        for file in (self.data_file, self.index_file):
+            if file is not None:
+                file.close()
+
+def encode_images(model, images:List[Optional[Image.Image]], keys:List[str]=None, feature_cache:FeatureCache=None, dtype="float32"):
+    """
+    Image embeddings of a batch. Images given as None, or cached meanwhile (halves of a batch split on out of memory),
+    are read from feature_cache by key, encoded ones are stored in it.
+    """
+    encoded = None
+    new = [j for j, image in enumerate(images) if image is not None and (feature_cache is None or keys[j] not in feature_cache)]
+    if new:
+        subs = torch.cat([model.vis_processor(images[j]).unsqueeze(0) for j in new], dim=0).cuda()
+        encoded = model.encode_img(subs)
+        if feature_cache is not None:
+            feature_cache.put([keys[j] for j in new], encoded.float().cpu().numpy())
+        if len(new) == len(images):
+            return encoded
+    embeds = []
+    for j in range(len(images)):
+        if j not in new:
+            embeds.append(torch.from_numpy(np.array(feature_cache.get(keys[j]))).unsqueeze(0).cuda().to(dtype=dtype))
+        else:
+            embeds.append(encoded[new.index(j)].unsqueeze(0).to(dtype=dtype))
+    return torch.cat(embeds, dim=0)
+
+def generate_batch(model, images:List[Optional[Image.Image]], prompts:List[str], seg_emb1, generation_params=None, dtype="float32",
+                   keys:List[str]=None, feature_cache:FeatureCache=None) -> List[str]:
+    """
+    Generates captions of one batch, prompts may differ in length.
+    seg_emb1 is the prefix embedding or its PrefixCache, None images are taken from feature_cache.
+    """
+    with torch.cuda.amp.autocast():
+        with torch.no_grad():
+            subs = encode_images(model, images, keys, feature_cache, dtype)
+            if isinstance(seg_emb1, PrefixCache):
+                out_embeds = seg_emb1.generate(model, subs, prompts, generation_params, dtype)
+            else:
+                sequences = [torch.cat([seg_emb1, subs[j:j+1], model.encode_text(prompt, add_special_tokens=False)], dim=1)
+                             for j, prompt in enumerate(prompts)]
+                input_emb, attention_mask = pad_left(sequences)
+                out_embeds = model.internlm_model.generate(inputs_embeds=input_emb.to(dtype=dtype),
+                                                           attention_mask=attention_mask,
+                                                           eos_token_id=model.tokenizer.eos_token_id,
+                                                           num_return_sequences=1,
+                                                           **generation_params
+                                                           )
+    responses = []
+    for out in out_embeds:
+        out[out == -1] = 2
+        responses.append(model.decode_text([out]))
+    return responses
+
+def generate_fitting(model, images:List[Optional[Image.Image]], prompts:List[str], seg_emb1, generation_params=None, dtype="float32",
+                     keys:List[str]=None, feature_cache:FeatureCache=None):
+    """
+    Generates batch, halving it on CUDA out of memory. Returns (captions, largest batch size that fitted).
+    """
+    try:
+        return generate_batch(model, images, prompts, seg_emb1, generation_params, dtype, keys, feature_cache), len(images)
+    except torch.cuda.OutOfMemoryError:
+        if len(images) == 1:
+            raise
+    # retry outside of except, so the traceback does not keep the failed batch tensors alive
+    torch.cuda.empty_cache()
+    half = len(images) // 2
+    logging.warning(f"Out of memory at batch size {len(images)}, retrying with {half}")
+    keys = keys or [None] * len(images)
+    first, first_fitted = generate_fitting(model, images[:half], prompts[:half], seg_emb1, generation_params, dtype, keys[:half], feature_cache)
+    second, second_fitted = generate_fitting(model, images[half:], prompts[half:], seg_emb1, generation_params, dtype, keys[half:], feature_cache)
+    return first + second, min(first_fitted, second_fitted)
+
+def _inference_iter(model, image_paths:List[str], tags:List[Optional[str]], seg2, seg_emb1, batch_size=4, generation_params=None, dtype="float32",
+                    feature_cache:FeatureCache=None):
+    order = prompt_order(model, tags, seg2)
+    keys = [None] * len(order)
+    cached = [False] * len(order)
+    if feature_cache is not None:
+        keys = feature_cache.keys([image_paths[i] for i in order])
+        cached = [key in feature_cache for key in keys]
+        logging.info(f"{sum(cached)} of {len(order)} image features cached")
+    # only images without cached features are loaded, in batch order
+    imgs = active_yield_images([image_paths[i] for i, hit in zip(order, cached) if not hit])
+    position = 0
+    with tqdm(total=len(order), desc='BATCH') as pbar:
+        while position < len(order):
+            indices = order[position:position + batch_size]
+            logging.info(f"Processing items {position}-{position + len(indices)} of {len(order)}")
+            pbar.set_postfix_str(f'Preparing items...')
+            images = [None if hit else next(imgs) for hit in cached[position:position + len(indices)]]
             pbar.set_postfix_str(f'Inference...')
-            subs = torch.cat(subs, dim=0).cuda()
-            tmp_bs = subs.shape[0]
-            tmp_seg_emb1 = seg_emb1.repeat(tmp_bs, 1, 1)
-            emb2_list = []
-            max_length = 0
-            for j in range(tmp_bs):
-                # pad with eoh to match length
-                encoded = model.encode_text(format_text(seg2, tags[i*batch_size+j]), add_special_tokens=False)
-                # get max length
-                max_length = max(max_length, encoded.shape[1])
-                emb2_list.append(encoded)
-            # to dim 3
-            tmp_seg_emb2 = torch.stack(emb2_list, dim=0).squeeze(-1).cuda() #[1, 1, 160, 4096]
-            tmp_seg_emb2 = tmp_seg_emb2.squeeze(1)
-            with torch.cuda.amp.autocast():
-                with torch.no_grad():
-                    subs = model.encode_img(subs)
-                    # validate number of dims
-                    input_emb = torch.cat(
-                        [tmp_seg_emb1, subs, tmp_seg_emb2], dim=1).to(dtype=dtype)
-                    out_embeds = model.internlm_model.generate(inputs_embeds=input_emb,
-                                                            eos_token_id=model.tokenizer.eos_token_id,
-                                                            num_return_sequences=1,
-                                                            **generation_params
-                                                            )
-            pbar.set_postfix_str(f'Ended batch...')
-            logging.info(f"Batch {i} ended")
-            for j, out in enumerate(out_embeds):
-                out[out == -1] = 2
-                response = model.decode_text([out])
-                if stream:
-                    yield response
-                captions.append(response)
+            responses, fitted = generate_fitting(model, images, [format_text(seg2, tags[i]) for i in indices], seg_emb1, generation_params, dtype,
+                                                 keys[position:position + len(indices)], feature_cache)
+            if fitted < batch_size:
+                logging.info(f"Batch size reduced from {batch_size} to {fitted}")
+                batch_size = fitted
+            position += len(indices)
+            pbar.update(len(indices))
+            for index, response in zip(indices, responses):
+                yield index, response
+
+def inference(model, image_paths:List[str], tags:List[Optional[str]], seg2, seg_emb1, batch_size=4, stream=False, generation_params=None, dtype="float32",
+              feature_cache:FeatureCache=None):
+    """
+    Inference in batches of similar prompt length, padded with attention masks.
+    batch_size is the upper bound, it is halved on out of memory and kept for the next batches.
+    if stream is True, returns generator of (index, caption) in completion order, else list of captions in input order.
+    With feature_cache, images with cached embeddings are neither loaded nor encoded.
+    """
+    results = _inference_iter(model, image_paths, tags, seg2, seg_emb1, batch_size, generation_params, dtype, feature_cache)
+    if stream:
+        return results
+    captions = [None] * len(tags)
+    for index, caption in results:
+        captions[index] = caption
     return captions
 
 def active_yield_images(image_path:List[str], max_workers = 4) -> Image.Image:
@@ -150,19 +388,108 @@ def active_yield_images(image_path:List[str], max_workers = 4) -> Image.Image:
             yield future.result()
 
 
+def shard_path(save_path:str, index:int) -> str:
+    """
+    Result shard of worker index, next to save_path.
+    """
+    return f"{save_path}.shard-{index}.jsonl"
+
+def read_results(path:str) -> dict:
+    """
+    Reads {image path: caption} jsonl, lines cut by a crash are skipped, later results of a path replace earlier ones.
+    """
+    results = {}
+    if not os.path.exists(path):
+        return results
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if isinstance(record, dict):
+                results.update(record)
+    return results
+
+def captioned_paths(save_path:str) -> set:
+    """
+    Resume index: image paths already in save_path or in any of its shards.
+    """
+    done = set(read_results(save_path))
+    for path in glob.glob(glob.escape(save_path) + '.shard-*.jsonl'):
+        done.update(read_results(path))
+    return done
+
+def merge_shards(save_path:str) -> int:
+    """
+    Merges save_path and its shards into save_path (one {path: caption} per line), through temp file and rename,
+    then removes the shards. Shards are newer than save_path, their captions replace existing ones (--no-resume re-runs).
+    Returns number of results.
+    """
+    shards = sorted(glob.glob(glob.escape(save_path) + '.shard-*.jsonl'))
+    results = read_results(save_path)
+    for shard in shards:
+        results.update(read_results(shard))
+    temp_path = save_path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        for path, caption in results.items():
+            json.dump({path: caption}, f, ensure_ascii=False)
+            f.write('\n')
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, save_path)
+    for shard in shards:
+        os.remove(shard)
+    return len(results)
+
+class ShardWriter:
+    """
+    Buffered jsonl writer of one worker, flushed and fsynced every flush_every results or flush_seconds.
+    A crash loses at most the unflushed buffer, the resume index picks up everything before.
+    """
+    def __init__(self, path:str, flush_every:int = 16, flush_seconds:float = 30.0):
+        self.path = path
+        self.flush_every = flush_every
+        self.flush_seconds = flush_seconds
+        self.buffer = []
+        self.last_flush = time.time()
+        cut = False
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            with open(path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                cut = f.read(1) != b'\n'
+        self.file = open(path, 'a', encoding='utf-8')
+        # terminate a line cut by a previous crash, so it does not swallow the next record
+        if cut:
+            self.file.write('\n')
+
+    def write(self, image_path:str, caption:str):
+        self.buffer.append(json.dumps({image_path: caption}, ensure_ascii=False) + '\n')
+        if len(self.buffer) >= self.flush_every or time.time() - self.last_flush >= self.flush_seconds:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.file.write(''.join(self.buffer))
+            self.buffer = []
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.last_flush = time.time()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
 def main(args):
     """
     Inference.
     """
-    default_generation_params = {
-        "max_length": 500,
-        "num_beams": 3,
-        "min_length": 1,
-        "do_sample": True,
-        "repetition_penalty": 1.5,
-        "length_penalty": 1.0,
-        "temperature": 1.0,
-    }
     device = args.device
     precision = args.precision
     cache_dir = args.cache_dir
@@ -179,6 +506,8 @@ def main(args):
         image = download_image_web(imgs[0])
         image.save('tmp.jpg')
         imgs = ['tmp.jpg']
+        # results and resume are keyed by the url, tmp.jpg is reused by every demo run
+        image_paths = [args.single_image_url]
     elif args.images_file:
         with open(args.images_file, 'r', encoding="utf-8") as f:
             imgs = json.load(f)
@@ -215,12 +544,24 @@ def main(args):
                 tags.append(f.read())
     else:
         tags = [None,] * len(imgs)
+    if not image_paths:
+        image_paths = imgs
     # limit number of images if specified
     if images_limit is not None:
         logging.info(f"Limiting number of images to {images_limit}")
         imgs = imgs[:images_limit]
         tags = tags[:images_limit]
         image_paths = image_paths[:images_limit]
+    # skip images captioned by previous runs, before any image is loaded
+    if not args.no_resume:
+        done = captioned_paths(save_path)
+        keep = [i for i, path in enumerate(image_paths) if path not in done]
+        if len(keep) < len(image_paths):
+            logging.info(f"Resuming, {len(image_paths) - len(keep)} images already captioned")
+            print(f"Skipping {len(image_paths) - len(keep)} images already captioned")
+        imgs = [imgs[i] for i in keep]
+        tags = [tags[i] for i in keep]
+        image_paths = [image_paths[i] for i in keep]
     # Now image_paths and tags are ready
     if "," in device:
         device = device.split(",")
@@ -239,24 +580,27 @@ def main(args):
     assert len(device) > 0, "No device is specified"
     chunk_size = len(tags)//len(device)
     tags_chunks = [list() for _ in range(len(device))]
+    imgs_chunks = [list() for _ in range(len(device))]
     image_paths_chunks = [list() for _ in range(len(device))]
     for i in range(len(device)):
         tags_chunks[i] = tags[i*chunk_size:(i+1)*chunk_size]
+        imgs_chunks[i] = imgs[i*chunk_size:(i+1)*chunk_size]
         image_paths_chunks[i] = image_paths[i*chunk_size:(i+1)*chunk_size]
     if len(tags) % len(device) != 0:
         # add leftover to first device
         tags_chunks[0].extend(tags[len(device)*chunk_size:])
+        imgs_chunks[0].extend(imgs[len(device)*chunk_size:])
         image_paths_chunks[0].extend(image_paths[len(device)*chunk_size:])
     assert sum([len(i) for i in tags_chunks]) == len(tags), "Tags chunks are not correct"
     assert sum([len(i) for i in image_paths_chunks]) == len(image_paths), "Image paths chunks are not correct"
     # inference
-    generation_params = default_generation_params
+    generation_params = dict(DEFAULT_GENERATION_PARAMS)
     events = []
     futures = []
     with ProcessPoolExecutor(max_workers=len(device), initializer=torch.multiprocessing.set_sharing_strategy('file_system'), mp_context=torch.multiprocessing.get_context('spawn')) as executor:
         for i in range(len(device)):
             logging.info(f"Starting process {i} for device {device[i]}")
-            futures.append(executor.submit(log_infer_tags, model_name, cache_dir, precision, device[i], image_paths_chunks[i], batch_size, generation_params, tags_chunks[i], image_paths_chunks[i], save_path))
+            futures.append(executor.submit(log_infer_tags, model_name, cache_dir, precision, device[i], imgs_chunks[i], batch_size, generation_params, tags_chunks[i], image_paths_chunks[i], shard_path(save_path, i), not args.no_prefix_cache, args.instruction_before_image, args.feature_cache_dir))
     try:
         for future in futures:
             future.result()
@@ -264,6 +608,8 @@ def main(args):
         logging.info(f"KeyboardInterrupt, stopping...")
         for event in events:
             event.set()
+    # shards are kept on failure, the next run resumes from them
+    print(f"Merged {merge_shards(save_path)} captions into {save_path}")
 
 def log_infer_tags(*args, **kwargs):
     """
@@ -296,11 +642,10 @@ class WrappedDataParallel(DataParallel):
         except AttributeError:
             return getattr(self.module, name)
 
-def infer_tags(model_name:str, cache_dir:str, precision:str, device:str, imgs:Generator, batch_size=4, generation_params=None, tags:List[Optional[str]]=None, image_paths:List[str]=None, save_path:str=None):
+def load_model(model_name:str, cache_dir:str, precision:str, device):
     """
-    Inference.
+    Loads model and tokenizer on device (list of devices for data parallel). Returns (model, torch dtype).
     """
-    # load model
     if isinstance(device, list):
         os.environ["CUDA_VISIBLE_DEVICES"] = ",".join([i.split(":")[-1] for i in device])
         data_parallel = True
@@ -320,31 +665,56 @@ def infer_tags(model_name:str, cache_dir:str, precision:str, device:str, imgs:Ge
     model = AutoModelForCausalLM.from_pretrained(
         model_name, device_map="cuda:0", trust_remote_code=True, cache_dir=cache_dir,
         torch_dtype=precision).eval()
-    eoh = model.eoh
     model.tokenizer = tokenizer
     model.cuda()
     if data_parallel:
         model.internlm_model = WrappedDataParallel(model.internlm_model, device_ids=[int(i.split(":")[-1]) for i in device], output_device=int(device[0].split(":")[-1]))
         model.internlm_model.to("cuda")
     logging.info(f"Model {model_name} loaded on device {device}")
+    return model, precision
+
+def build_prompt(model, prefix_cache:bool=True, instruction_first:bool=False, dtype="float32"):
+    """
+    Returns (seg2, seg_emb1): tag prompt template and prefix embedding.
+    The prefix is cached (PrefixCache) only if prefix_cache and instruction_first: with the default prompt it is
+    just BOS and <|User|>:, too short to pay for the cached generate path, so the single generate call is kept.
+    """
     seg1 = '<|User|>:'
-    seg2 = fr'''Analyze the image in a comprehensive and detailed manner.
+    instruction = '''Analyze the image in a comprehensive and detailed manner.
 Reorder the following tags according to the image content.
 DO NOT ignore any tags.
-TAGS: 
+'''
+    tag_prompt = fr'''TAGS: 
 %tags
-{eoh}\n<|Bot|>:'''
-    # use inference
+{model.eoh}\n<|Bot|>:'''
     seg_emb1 = model.encode_text(seg1, add_special_tokens=True)
-    imgs = active_yield_images(imgs) # generator
-    infer_results = inference(model, imgs, tags, seg2, seg_emb1, batch_size=batch_size, stream=True, generation_params=generation_params, dtype=precision)
-    _i = 0
-    for responses in infer_results:
-        logging.info(f"Writing result {_i}")
-        with open(save_path, 'a+', encoding='utf-8') as f:
-            json.dump({f"{image_paths[_i]}": responses}, f, ensure_ascii=False)
-            f.write('\n')
-        _i += 1
+    if instruction_first:
+        seg_emb1 = torch.cat([seg_emb1, model.encode_text(instruction, add_special_tokens=False)], dim=1)
+        seg2 = tag_prompt
+    else:
+        seg2 = instruction + tag_prompt
+    if prefix_cache and instruction_first:
+        logging.info(f"Caching {seg_emb1.shape[1]} prefix tokens")
+        seg_emb1 = PrefixCache(model, seg_emb1, dtype)
+    return seg2, seg_emb1
+
+def infer_tags(model_name:str, cache_dir:str, precision:str, device:str, imgs:Generator, batch_size=4, generation_params=None, tags:List[Optional[str]]=None, image_paths:List[str]=None, save_path:str=None, prefix_cache:bool=True, instruction_first:bool=False, feature_cache_dir:str=None):
+    """
+    Inference.
+    """
+    model, precision = load_model(model_name, cache_dir, precision, device)
+    # use inference
+    seg2, seg_emb1 = build_prompt(model, prefix_cache, instruction_first, precision)
+    # pid in the worker name, concurrent runs or a server on the same device never share row counters
+    feature_cache = FeatureCache(feature_cache_dir, model_name, f"{device.replace(':', '')}-{os.getpid()}") if feature_cache_dir else None
+    infer_results = inference(model, imgs, tags, seg2, seg_emb1, batch_size=batch_size, stream=True, generation_params=generation_params, dtype=precision,
+                              feature_cache=feature_cache)
+    with ShardWriter(save_path) as writer:
+        for index, responses in infer_results:
+            logging.info(f"Writing result {index}")
+            writer.write(image_paths[index], responses)
+    if feature_cache is not None:
+        feature_cache.close()
     print('Done')
 
 if __name__ == "__main__":
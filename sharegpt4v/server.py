@@ -0,0 +1,351 @@
+"""
+Persistent ShareCaptioner server: the model is loaded once per device and concurrent caption requests are batched dynamically.
+Each device runs in its own process, pulls the first waiting request and gathers more for up to --max-wait-ms or --max-batch-size,
+then captions them in one batch (length bucketing, out of memory backoff and optional prefix cache from inference.py).
+
+Usage:
+    python server.py --device 0,1 --port 8765
+    python server.py --device 0 --unix-socket /tmp/sharecaptioner.sock
+    python server.py --stand-in --device 0,1 --port 8765   # CPU stand-in model, to test batching and queueing
+
+API (json):
+    POST /caption {"image": path or url, "tags": str or null} -> {"caption": str}
+    POST /caption {"images": [...], "tags": [...]} -> {"captions": [...]}
+    GET /health -> {"devices": [...], "ready": [...], "pending": int}
+Images are read by the server, paths must be visible to it. See client.py.
+"""
+import argparse
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional
+
+def setup_logging(log_file:str):
+    logging.basicConfig(filename=log_file, level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+class StandInBackend:
+    """
+    CPU stand-in for the captioner: sleeps like a batched forward pass (fixed cost plus per item cost) and echoes its inputs.
+    Images named broken* fail the whole batch, as an undecodable image does in inference().
+    """
+    def __init__(self, batch_delay:float = 0.2, item_delay:float = 0.01):
+        self.batch_delay = batch_delay
+        self.item_delay = item_delay
+
+    def caption(self, image_paths:List[str], tags:List[Optional[str]]) -> List[str]:
+        time.sleep(self.batch_delay + self.item_delay * len(image_paths))
+        broken = [path for path in image_paths if os.path.basename(path).startswith('broken')]
+        if broken:
+            raise OSError(f"cannot identify image file {broken[0]}")
+        return [f"caption of {os.path.basename(path)} (tags: {tag}, batch of {len(image_paths)})" for path, tag in zip(image_paths, tags)]
+
+class ShareCaptionerBackend:
+    """
+    ShareCaptioner on one device, model and prompt prefix are prepared once.
+    """
+    def __init__(self, model_name:str, cache_dir:str, precision:str, device:str, generation_params:dict = None,
+                 prefix_cache:bool = True, instruction_first:bool = False, feature_cache_dir:str = None):
+        # torch and transformers only in device processes, the front end and stand-in run without them
+        from inference import DEFAULT_GENERATION_PARAMS, FeatureCache, build_prompt, load_model
+        self.model, self.dtype = load_model(model_name, cache_dir, precision, device)
+        self.seg2, self.seg_emb1 = build_prompt(self.model, prefix_cache, instruction_first, self.dtype)
+        self.generation_params = generation_params or dict(DEFAULT_GENERATION_PARAMS)
+        # own worker name, batch runs on the same device append to their own files
+        self.feature_cache = FeatureCache(feature_cache_dir, model_name, f"server-{device.replace(':', '')}-{os.getpid()}") if feature_cache_dir else None
+
+    def caption(self, image_paths:List[str], tags:List[Optional[str]]) -> List[str]:
+        from inference import inference
+        return inference(self.model, image_paths, tags, self.seg2, self.seg_emb1, batch_size=len(image_paths),
+                         generation_params=self.generation_params, dtype=self.dtype, feature_cache=self.feature_cache)
+
+def collect_batch(requests, max_batch_size:int, max_wait:float) -> list:
+    """
+    Blocks for the first request, then gathers more until max_batch_size or max_wait seconds after the first one.
+    A None (stop) request ends the batch and is returned last.
+    """
+    batch = [requests.get()]
+    deadline = time.time() + max_wait
+    while batch[-1] is not None and len(batch) < max_batch_size:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(requests.get(timeout=remaining))
+        except queue.Empty:
+            break
+    return batch
+
+def check_image(image) -> Optional[str]:
+    """
+    Returns error of an image reference the server cannot read (not a url or existing file), None if it looks readable.
+    """
+    if not isinstance(image, str):
+        return f"image must be a path or url, got {type(image).__name__}"
+    if image.startswith(('http://', 'https://')) or os.path.isfile(image):
+        return None
+    return f"image not found: {image}"
+
+def caption_batch(backend, batch:list, check_images:bool = True) -> list:
+    """
+    Captions (id, image, tags) requests, returns (id, caption, error) per request.
+    Unreadable references fail alone, if the batch still fails its requests are retried one at a time,
+    so one broken image does not fail the requests of other clients.
+    """
+    results = {}
+    valid = []
+    for request_id, image, tags in batch:
+        error = check_image(image) if check_images else None
+        if error is not None:
+            results[request_id] = (request_id, None, error)
+        else:
+            valid.append((request_id, image, tags))
+    if valid:
+        try:
+            captions = backend.caption([image for _, image, _ in valid], [tags for _, _, tags in valid])
+            for (request_id, _, _), caption in zip(valid, captions):
+                results[request_id] = (request_id, caption, None)
+        except Exception as exception:
+            if len(valid) == 1:
+                request_id = valid[0][0]
+                results[request_id] = (request_id, None, f'{type(exception).__name__}: {exception}')
+            else:
+                logging.warning(f"Batch of {len(valid)} failed ({exception}), retrying requests one at a time")
+                for request in valid:
+                    results[request[0]] = caption_batch(backend, [request], False)[0]
+    return [results[request_id] for request_id, _, _ in batch]
+
+def device_worker(device:str, backend_args:dict, requests, results, max_batch_size:int, max_wait:float, log_file:Optional[str] = None):
+    """
+    Device process: loads the backend, then captions batches of (id, image, tags) requests until a None request.
+    Puts ('ready', device), then (id, caption, error) per request on results.
+    Spawned processes do not inherit logging configuration, log_file sets it up again.
+    """
+    if log_file:
+        setup_logging(log_file)
+    if backend_args.get('stand_in'):
+        backend = StandInBackend(backend_args.get('batch_delay', 0.2), backend_args.get('item_delay', 0.01))
+    else:
+        backend = ShareCaptionerBackend(device=device, **{key: value for key, value in backend_args.items() if key != 'stand_in'})
+    results.put(('ready', device, None))
+    while True:
+        batch = collect_batch(requests, max_batch_size, max_wait)
+        stop = batch[-1] is None
+        batch = [request for request in batch if request is not None]
+        if batch:
+            logging.info(f"Device {device} captioning batch of {len(batch)}")
+            # the stand-in takes any name, only real images are checked
+            for result in caption_batch(backend, batch, not backend_args.get('stand_in')):
+                if result[2] is not None:
+                    logging.error(f"Device {device} request {result[0]} failed: {result[2]}")
+                results.put(result)
+        if stop:
+            break
+
+class CaptionService:
+    """
+    Front end of the device processes: submits requests to the shared queue and waits for their results.
+    """
+    def __init__(self, devices:List[str], backend_args:dict, max_batch_size:int = 8, max_wait:float = 0.05, log_file:Optional[str] = None):
+        context = multiprocessing.get_context('spawn')
+        self.devices = devices
+        self.requests = context.Queue()
+        self.results = context.Queue()
+        self.ready = []
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.ids = itertools.count()
+        self.processes = [context.Process(target=device_worker, args=(device, backend_args, self.requests, self.results, max_batch_size, max_wait, log_file), daemon=True)
+                          for device in devices]
+        for process in self.processes:
+            process.start()
+        self.dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self.dispatcher.start()
+
+    def _dispatch(self):
+        while True:
+            request_id, caption, error = self.results.get()
+            if request_id is None:
+                break
+            if request_id == 'ready':
+                self.ready.append(caption)
+                print(f"Device {caption} ready")
+                continue
+            with self.lock:
+                slot = self.pending.pop(request_id, None)
+            if slot is not None: # None if the client timed out
+                slot['result'] = (caption, error)
+                slot['event'].set()
+
+    def submit(self, image:str, tags:Optional[str] = None) -> dict:
+        request_id = next(self.ids)
+        slot = {'event': threading.Event()}
+        with self.lock:
+            self.pending[request_id] = slot
+        self.requests.put((request_id, image, tags))
+        return {'id': request_id, 'slot': slot}
+
+    def wait(self, ticket:dict, timeout:float = None) -> str:
+        if not ticket['slot']['event'].wait(timeout):
+            with self.lock:
+                self.pending.pop(ticket['id'], None)
+            raise TimeoutError(f"No caption within {timeout} seconds")
+        caption, error = ticket['slot']['result']
+        if error is not None:
+            raise RuntimeError(error)
+        return caption
+
+    def caption_many(self, images:List[str], tags:List[Optional[str]] = None, timeout:float = None) -> List[str]:
+        """
+        Submits all images first, so they can share batches, then waits in order.
+        """
+        tags = tags or [None] * len(images)
+        if len(tags) != len(images):
+            raise ValueError(f"{len(tags)} tags for {len(images)} images")
+        tickets = [self.submit(image, tag) for image, tag in zip(images, tags)]
+        return [self.wait(ticket, timeout) for ticket in tickets]
+
+    def health(self) -> dict:
+        with self.lock:
+            pending = len(self.pending)
+        return {'devices': self.devices, 'ready': list(self.ready), 'pending': pending}
+
+    def close(self):
+        for _ in self.processes:
+            self.requests.put(None)
+        for process in self.processes:
+            process.join(timeout=30)
+        self.results.put((None, None, None))
+
+def validate_request(request) -> Optional[str]:
+    """
+    Returns error message of a malformed /caption body, None if valid.
+    """
+    if not isinstance(request, dict):
+        return 'body must be a json object'
+    if 'images' in request:
+        if not isinstance(request['images'], list) or not all(isinstance(image, str) for image in request['images']):
+            return '"images" must be a list of paths or urls'
+        tags = request.get('tags')
+        if tags is not None and (not isinstance(tags, list) or len(tags) != len(request['images'])):
+            return '"tags" must be a list with one entry per image'
+        if tags is not None and not all(tag is None or isinstance(tag, str) for tag in tags):
+            return '"tags" entries must be strings or null'
+    elif 'image' in request:
+        if not isinstance(request['image'], str):
+            return '"image" must be a path or url'
+        if request.get('tags') is not None and not isinstance(request['tags'], str):
+            return '"tags" must be a string or null'
+    else:
+        return 'expected "image" or "images"'
+    return None
+
+class CaptionHandler(BaseHTTPRequestHandler):
+    service: CaptionService = None
+    timeout_seconds: float = 600.0
+
+    def _send(self, status:int, payload:dict):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._send(200, self.service.health())
+        else:
+            self._send(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if self.path != '/caption':
+            self._send(404, {'error': 'not found'})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        except (json.JSONDecodeError, UnicodeDecodeError, ValueError) as exception:
+            self._send(400, {'error': f'invalid json: {exception}'})
+            return
+        error = validate_request(request)
+        if error is not None:
+            self._send(400, {'error': error})
+            return
+        try:
+            if 'images' in request:
+                self._send(200, {'captions': self.service.caption_many(request['images'], request.get('tags'), self.timeout_seconds)})
+            else:
+                self._send(200, {'caption': self.service.wait(self.service.submit(request['image'], request.get('tags')), self.timeout_seconds)})
+        except TimeoutError as exception:
+            self._send(504, {'error': str(exception)})
+        except RuntimeError as exception:
+            self._send(500, {'error': str(exception)})
+
+    def address_string(self):
+        # unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        logging.info("%s - %s" % (self.address_string(), format % args))
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        socketserver.UnixStreamServer.server_bind(self)
+        self.server_name, self.server_port = 'localhost', 0
+
+def serve(service:CaptionService, host:str = '127.0.0.1', port:int = 8765, unix_socket:str = None, timeout:float = 600.0):
+    """
+    Serves service over HTTP on host:port, or on unix_socket, until interrupted.
+    """
+    handler = type('Handler', (CaptionHandler,), {'service': service, 'timeout_seconds': timeout})
+    server = ThreadingUnixHTTPServer(unix_socket, handler) if unix_socket else ThreadingHTTPServer((host, port), handler)
+    print(f"Serving on {unix_socket or f'http://{host}:{port}'}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        if unix_socket and os.path.exists(unix_socket):
+            os.remove(unix_socket)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', type=str, default='0', help='comma separated cuda devices, one model process each')
+    parser.add_argument('--model-name', type=str, default='Lin-Chen/ShareCaptioner')
+    parser.add_argument('--cache-dir', type=str, default=None)
+    parser.add_argument('--precision', type=str, default='bf16')
+    parser.add_argument('--no-prefix-cache', action='store_true', help='with --instruction-before-image, run the whole prompt for every batch')
+    parser.add_argument('--instruction-before-image', action='store_true', help='move the fixed instruction before the image and cache its keys and values once per device')
+    parser.add_argument('--feature-cache-dir', type=str, default=None, help='cache vision embeddings here')
+    parser.add_argument('--max-batch-size', type=int, default=8, help='maximum requests per batch')
+    parser.add_argument('--max-wait-ms', type=float, default=50, help='how long a batch waits for more requests after its first one')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix-socket', type=str, default=None, help='serve on this unix socket instead of host:port')
+    parser.add_argument('--timeout', type=float, default=600, help='seconds a request waits for its caption')
+    parser.add_argument('--stand-in', action='store_true', help='CPU stand-in model instead of ShareCaptioner')
+    parser.add_argument('--stand-in-delay', type=float, default=0.2, help='stand-in seconds per batch')
+    parser.add_argument('--log-file', type=str, default='server.log')
+    args = parser.parse_args()
+    setup_logging(args.log_file)
+    devices = [device if device.startswith('cuda:') or args.stand_in else f'cuda:{device}' for device in args.device.split(',')]
+    if args.stand_in:
+        backend_args = {'stand_in': True, 'batch_delay': args.stand_in_delay}
+    else:
+        backend_args = {'model_name': args.model_name, 'cache_dir': args.cache_dir, 'precision': args.precision,
+                        'prefix_cache': not args.no_prefix_cache, 'instruction_first': args.instruction_before_image,
+                        'feature_cache_dir': args.feature_cache_dir}
+    service = CaptionService(devices, backend_args, args.max_batch_size, args.max_wait_ms / 1000, args.log_file)
+    serve(service, args.host, args.port, args.unix_socket, args.timeout)
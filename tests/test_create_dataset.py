@@ -0,0 +1,37 @@
+"""
+create_subset of create_dataset.py on flat and sharded folders.
+"""
+import json
+import os
+import sys
+
+import pytest
+
+pytest.importorskip('aiohttp')
+pytest.importorskip('aiodanbooru')
+pytest.importorskip('requests')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from create_dataset import create_subset
+from utils.storage import ShardedStorage, list_files
+
+MD5S = [f'{i:032x}' for i in range(4)]
+
+def write_posts(root, sharded):
+    storage = ShardedStorage(root) if sharded else None
+    for md5 in MD5S:
+        for filename, content in ((f'{md5}.json', json.dumps({'md5': md5})), (f'{md5}.png', 'png')):
+            path = storage.resolve(filename) if sharded else os.path.join(root, filename)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(content)
+            if sharded:
+                storage.register(path)
+
+@pytest.mark.parametrize('sharded', [False, True])
+def test_create_subset_moves_json_and_image(tmp_path, sharded):
+    source, subset = str(tmp_path / 'posts'), str(tmp_path / 'subset')
+    os.makedirs(source)
+    write_posts(source, sharded)
+    create_subset(source, subset, filter=lambda post: post['md5'] != MD5S[0], subset_size=10)
+    assert sorted(os.listdir(subset)) == sorted(f'{md5}.{ext}' for md5 in MD5S[1:] for ext in ('json', 'png'))
+    assert sorted(os.path.basename(p) for p in list_files(source)) == [f'{MD5S[0]}.json', f'{MD5S[0]}.png']
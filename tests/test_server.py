@@ -0,0 +1,101 @@
+"""
+Batching and queueing of sharegpt4v/server.py with the CPU stand-in model.
+"""
+import os
+import queue
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'sharegpt4v'))
+from server import CaptionService, StandInBackend, caption_batch, collect_batch, validate_request
+
+def test_collect_batch_stops_at_max_batch_size():
+    requests = queue.Queue()
+    for i in range(10):
+        requests.put(i)
+    assert collect_batch(requests, 4, 1.0) == [0, 1, 2, 3]
+    assert collect_batch(requests, 4, 1.0) == [4, 5, 6, 7]
+
+def test_collect_batch_waits_for_late_requests():
+    requests = queue.Queue()
+    requests.put(0)
+    threading.Timer(0.05, requests.put, (1,)).start()
+    assert collect_batch(requests, 8, 0.5) == [0, 1]
+
+def test_collect_batch_returns_after_max_wait():
+    requests = queue.Queue()
+    requests.put(0)
+    start = time.time()
+    assert collect_batch(requests, 8, 0.1) == [0]
+    assert time.time() - start < 0.5
+
+def test_collect_batch_ends_at_stop():
+    requests = queue.Queue()
+    for request in (0, None, 1):
+        requests.put(request)
+    assert collect_batch(requests, 8, 1.0) == [0, None]
+
+def test_caption_batch_isolates_broken_image():
+    backend = StandInBackend(0, 0)
+    batch = [(0, 'a.png', None), (1, 'broken.png', None), (2, 'b.png', 'tag')]
+    results = caption_batch(backend, batch, check_images=False)
+    assert [request_id for request_id, _, _ in results] == [0, 1, 2]
+    assert results[0][1].startswith('caption of a.png') and results[0][2] is None
+    assert results[1][1] is None and 'broken.png' in results[1][2]
+    assert 'tags: tag' in results[2][1] and results[2][2] is None
+
+def test_caption_batch_checks_missing_files(tmp_path):
+    image = tmp_path / 'a.png'
+    image.write_bytes(b'')
+    results = caption_batch(StandInBackend(0, 0), [(0, str(image), None), (1, str(tmp_path / 'missing.png'), None)])
+    assert results[0][2] is None
+    assert 'not found' in results[1][2]
+
+@pytest.mark.parametrize('request_body, valid', [
+    ({'image': 'a.png'}, True),
+    ({'image': 'a.png', 'tags': 'solo'}, True),
+    ({'images': ['a.png', 'b.png'], 'tags': ['solo', None]}, True),
+    ({'images': ['a.png', 'b.png', 'c.png'], 'tags': ['solo']}, False),
+    ({'images': 'a.png'}, False),
+    ({'image': 3}, False),
+    ({}, False),
+    (5, False),
+    ([1], False),
+])
+def test_validate_request(request_body, valid):
+    assert (validate_request(request_body) is None) == valid
+
+@pytest.fixture(scope='module')
+def service():
+    service = CaptionService(['0', '1'], {'stand_in': True, 'batch_delay': 0.2, 'item_delay': 0.0}, max_batch_size=4, max_wait=0.1)
+    deadline = time.time() + 60
+    while len(service.ready) < 2 and time.time() < deadline:
+        time.sleep(0.05)
+    yield service
+    service.close()
+
+def test_service_batches_concurrent_requests(service):
+    images = [f'/x/{i}.png' for i in range(8)]
+    captions = service.caption_many(images, timeout=30)
+    assert [caption.split()[2] for caption in captions] == [f'{i}.png' for i in range(8)]
+    # 8 queued requests over 2 devices with max batch 4 end up in batches larger than one
+    assert max(int(caption.rsplit('batch of ', 1)[1].rstrip(')')) for caption in captions) > 1
+
+def test_service_error_only_fails_its_request(service):
+    tickets = [service.submit(image) for image in ('/x/a.png', '/x/broken.png', '/x/b.png')]
+    assert service.wait(tickets[0], 30).startswith('caption of a.png')
+    with pytest.raises(RuntimeError):
+        service.wait(tickets[1], 30)
+    assert service.wait(tickets[2], 30).startswith('caption of b.png')
+
+def test_service_rejects_mismatched_tags(service):
+    with pytest.raises(ValueError):
+        service.caption_many(['/x/a.png', '/x/b.png'], ['solo'])
+
+def test_service_health(service):
+    health = service.health()
+    assert sorted(health['ready']) == ['0', '1']
+    assert health['pending'] == 0
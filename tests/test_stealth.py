@@ -0,0 +1,125 @@
+"""
+Round trips of write_stealth_to_array / embed_stealth_info against read_info_from_image_stealth,
+caption embedding into an existing payload (embed_stealth.py) and chunk / stealth precedence of read_metadata.
+"""
+import json
+import os
+import sys
+
+import numpy as np
+import pytest
+from PIL import Image, PngImagePlugin
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from extract_exif import embed_stealth_info, has_metadata, probe_stealth, read_metadata, read_info_from_image_stealth, write_stealth_to_array
+from embed_stealth import embed_caption_file
+from extract_exif_batch import extract_record
+
+TEXT = json.dumps({'Description': '1girl, solo, 日本語', 'Comment': '{"steps": 28}'}, ensure_ascii=False)
+
+def random_pixels(channels, height=64, width=48, seed=0):
+    return np.random.default_rng(seed).integers(0, 256, (height, width, channels), dtype=np.uint8)
+
+@pytest.mark.parametrize('mode', ['alpha', 'rgb'])
+@pytest.mark.parametrize('compressed', [False, True])
+@pytest.mark.parametrize('channels', [3, 4])
+def test_array_round_trip(mode, compressed, channels):
+    pixels = write_stealth_to_array(random_pixels(channels), TEXT, mode, compressed)
+    image = Image.fromarray(pixels)
+    assert read_info_from_image_stealth(image) == TEXT
+    assert probe_stealth(image)[:2] == (mode, compressed)
+
+@pytest.mark.parametrize('mode', ['alpha', 'rgb'])
+@pytest.mark.parametrize('compressed', [False, True])
+def test_png_file_round_trip(tmp_path, mode, compressed):
+    path = str(tmp_path / 'image.png')
+    embed_stealth_info(Image.fromarray(random_pixels(3)), TEXT, mode, compressed).save(path)
+    with Image.open(path) as image:
+        assert read_info_from_image_stealth(image) == TEXT
+    assert probe_stealth(path)[:2] == (mode, compressed)
+
+def test_only_payload_bits_change():
+    pixels = random_pixels(4)
+    embedded = write_stealth_to_array(pixels, TEXT, 'alpha', True)
+    assert np.array_equal(embedded[..., :3], pixels[..., :3])
+    assert np.array_equal(embedded >> 1, pixels >> 1)
+
+def test_payload_too_large():
+    with pytest.raises(ValueError):
+        write_stealth_to_array(random_pixels(3, 8, 8), 'x' * 1000, 'alpha', False)
+
+def test_embed_caption_merges_existing_payload(tmp_path):
+    path = str(tmp_path / 'image.png')
+    existing = {'Description': 'original prompt', 'Software': 'NovelAI'}
+    embed_stealth_info(Image.fromarray(random_pixels(4)), json.dumps(existing), 'alpha', True).save(path)
+    with open(str(tmp_path / 'image_gemini.txt'), 'w', encoding='utf-8') as f:
+        f.write('A girl standing in a field.')
+    assert embed_caption_file(path) is None
+    with Image.open(path) as image:
+        payload = json.loads(read_info_from_image_stealth(image))
+    assert payload == dict(existing, Caption='A girl standing in a field.')
+
+def test_embed_caption_keeps_rgb_mode(tmp_path):
+    path = str(tmp_path / 'image.png')
+    embed_stealth_info(Image.fromarray(random_pixels(4)), json.dumps({'Description': 'prompt'}), 'rgb', False).save(path)
+    with open(str(tmp_path / 'image_gemini.txt'), 'w', encoding='utf-8') as f:
+        f.write('caption')
+    assert embed_caption_file(path) is None
+    assert probe_stealth(path)[0] == 'rgb'
+    with Image.open(path) as image:
+        assert json.loads(read_info_from_image_stealth(image))['Caption'] == 'caption'
+
+def test_embed_caption_skips_without_sidecar(tmp_path):
+    path = str(tmp_path / 'image.png')
+    Image.fromarray(random_pixels(3)).save(path)
+    assert embed_caption_file(path) == 'skipped'
+
+def test_non_generation_chunks_fall_through_to_stealth(tmp_path):
+    path = str(tmp_path / 'image.png')
+    info = PngImagePlugin.PngInfo()
+    info.add_text('Software', 'GIMP')
+    embed_stealth_info(Image.fromarray(random_pixels(4)), TEXT, 'alpha', True).save(path, pnginfo=info)
+    assert read_metadata(path) == ('alpha', TEXT)
+    assert has_metadata(path)
+
+def test_generation_chunk_wins_over_stealth(tmp_path):
+    path = str(tmp_path / 'image.png')
+    info = PngImagePlugin.PngInfo()
+    info.add_text('parameters', 'a cat')
+    embed_stealth_info(Image.fromarray(random_pixels(4)), TEXT, 'alpha', True).save(path, pnginfo=info)
+    assert read_metadata(path) == ('chunk', 'a cat')
+
+def test_non_generation_chunks_only(tmp_path):
+    path = str(tmp_path / 'image.png')
+    info = PngImagePlugin.PngInfo()
+    info.add_text('Software', 'GIMP')
+    Image.fromarray(random_pixels(3)).save(path, pnginfo=info)
+    assert read_metadata(path) == (None, '')
+    assert not has_metadata(path)
+
+def test_embed_caption_rewrites_lossless_webp(tmp_path):
+    path = str(tmp_path / 'image.webp')
+    Image.fromarray(random_pixels(4)).save(path, lossless=True)
+    with open(str(tmp_path / 'image_gemini.txt'), 'w', encoding='utf-8') as f:
+        f.write('caption')
+    assert embed_caption_file(path) is None
+    with Image.open(path) as image:
+        assert json.loads(read_info_from_image_stealth(image))['Caption'] == 'caption'
+
+def test_embed_caption_leaves_lossy_webp(tmp_path):
+    path = str(tmp_path / 'image.webp')
+    Image.fromarray(random_pixels(3)).save(path, quality=80)
+    with open(path, 'rb') as f:
+        original = f.read()
+    with open(str(tmp_path / 'image_gemini.txt'), 'w', encoding='utf-8') as f:
+        f.write('caption')
+    assert 'lossy' in embed_caption_file(path)
+    with open(path, 'rb') as f:
+        assert f.read() == original
+
+@pytest.mark.parametrize('text, description', [(TEXT, '1girl, solo, 日本語'), ('a cat\nSteps: 28, Sampler: Euler a', None)])
+def test_extract_record_of_stealth_payload(tmp_path, text, description):
+    path = str(tmp_path / 'image.png')
+    embed_stealth_info(Image.fromarray(random_pixels(4)), text, 'alpha', True).save(path)
+    record = extract_record(path)
+    assert (record['mode'], record['payload'], record['description'], record['error']) == ('alpha', text, description, None)
@@ -0,0 +1,50 @@
+"""
+Layout marker, register / resolve and resumable migrate of utils/storage.py.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.storage import INDEX_FILE, ShardedStorage, find_root, is_sharded, list_files, migrate, register_path
+
+MD5 = '0123456789abcdef0123456789abcdef'
+
+def write(path, text=''):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(text)
+
+def index_lines(root):
+    with open(os.path.join(root, INDEX_FILE), 'r', encoding='utf-8') as f:
+        return [line.rstrip('\n') for line in f if not line.startswith('#')]
+
+def test_plain_index_txt_is_not_sharded(tmp_path):
+    root = str(tmp_path)
+    write(os.path.join(root, INDEX_FILE), 'image list\n')
+    write(os.path.join(root, 'a.png'))
+    assert not is_sharded(root)
+    assert sorted(os.path.basename(p) for p in list_files(root)) == ['a.png', INDEX_FILE]
+    register_path(os.path.join(root, 'a.png'))
+    assert open(os.path.join(root, INDEX_FILE), encoding='utf-8').read() == 'image list\n'
+
+def test_register_only_at_shard_depth(tmp_path):
+    root = str(tmp_path / 'storage')
+    storage = ShardedStorage(root)
+    sidecar = storage.resolve(f'{MD5}_gemini.txt')
+    write(sidecar)
+    assert find_root(sidecar) == root
+    register_path(sidecar)
+    assert index_lines(root) == [f'01/23/{MD5}_gemini.txt']
+    unrelated = os.path.join(root, 'exports', 'notes.txt')
+    write(unrelated)
+    assert find_root(unrelated) is None
+
+def test_migrate_rerun_does_not_duplicate(tmp_path):
+    source, target = str(tmp_path / 'flat'), str(tmp_path / 'sharded')
+    for i in range(5):
+        write(os.path.join(source, f'{i:032x}.png'))
+    assert migrate(source, target, move=False, batch_size=2) == 5
+    assert migrate(source, target, move=False, batch_size=2) == 0
+    lines = index_lines(target)
+    assert len(lines) == len(set(lines)) == 5
+    assert len(list_files(target, '*.png')) == 5
@@ -0,0 +1,162 @@
+"""
+Parallel image transcoding (PNG / JPEG -> WebP, AVIF, JPEG, PNG) with metadata preservation.
+Encoding is lossy by default (shrinks PNG archives), files with stealth pnginfo are encoded lossless when the codec can,
+otherwise the payload is kept as text metadata. --lossless / --lossy force either.
+Text metadata (parameters, Description, Comment...) is written as PNG text chunks or EXIF UserComment.
+Outputs are written through temp file and rename, originals are only removed after a successful write.
+
+Usage:
+    python transcode.py --path outputs --recursive --codec webp --workers 16
+    python transcode.py --path outputs --ext .jpg --codec webp --quality 85 --effort 6 --remove-original
+"""
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
+from PIL import Image, PngImagePlugin
+from tqdm import tqdm
+from extract_exif import read_metadata_chunks, format_metadata_chunks, probe_stealth, read_info_from_image_stealth
+
+CODEC_EXTENSIONS = {
+    'webp': '.webp',
+    'avif': '.avif',
+    'jpeg': '.jpg',
+    'png': '.png',
+}
+LOSSLESS_CODECS = {'webp', 'png'}
+
+def _user_comment_exif(metadata:Dict[str, str]) -> Image.Exif:
+    """
+    EXIF with ImageDescription and UserComment (UNICODE, utf-16-be like webui), readable by read_metadata_chunks.
+    """
+    exif = Image.Exif()
+    if 'ImageDescription' in metadata:
+        exif[0x010E] = metadata['ImageDescription']
+    comment = {key: value for key, value in metadata.items() if key not in ('ImageDescription', 'XMP')}
+    if comment:
+        text = next(iter(comment.values())) if len(comment) == 1 else format_metadata_chunks(comment)
+        exif.get_ifd(0x8769)[0x9286] = b'UNICODE\x00' + text.encode('utf-16-be')
+    return exif
+
+def _save_options(codec:str, quality:int, effort:int, lossless:bool, metadata:Dict[str, str]) -> Dict:
+    """
+    Returns PIL save kwargs of the codec. effort is 0 (fast) .. 6 (small), as webp method.
+    """
+    if codec == 'png':
+        pnginfo = PngImagePlugin.PngInfo()
+        for key, value in metadata.items():
+            pnginfo.add_itxt(key, value, zip=len(value) > 1024)
+        return {'compress_level': min(9, effort * 9 // 6), 'pnginfo': pnginfo}
+    options = {'quality': quality}
+    if metadata:
+        options['exif'] = _user_comment_exif(metadata).tobytes()
+        if 'XMP' in metadata and codec == 'webp':
+            options['xmp'] = metadata['XMP'].encode('utf-8')
+    if codec == 'webp':
+        # exact keeps RGB under transparent pixels, stealth bits live there too
+        options.update(method=effort, lossless=lossless, exact=lossless)
+    elif codec == 'avif':
+        options['speed'] = 10 - effort * 10 // 6
+    elif codec == 'jpeg':
+        options['optimize'] = effort >= 4
+    return options
+
+def transcode_file(source:str, target:str, codec:str = 'webp', quality:int = 90, effort:int = 4,
+                   lossless:Optional[bool] = None, remove_original:bool = False) -> Dict:
+    """
+    Transcodes single file. lossless None is lossy unless the file has a stealth payload.
+    Returns record with source, target, before, after (bytes), lossless, stealth and error.
+    """
+    record = {'source': source, 'target': target, 'before': os.path.getsize(source), 'after': 0,
+              'lossless': False, 'stealth': None, 'error': None}
+    temp_path = target + '.tmp'
+    try:
+        metadata = read_metadata_chunks(source)
+        stealth_mode, _, _ = probe_stealth(source)
+        record['stealth'] = stealth_mode
+        with Image.open(source) as image:
+            if lossless is None:
+                lossless = stealth_mode is not None
+            lossless = lossless and codec in LOSSLESS_CODECS
+            if stealth_mode is not None and not lossless:
+                # lossy encoding destroys the LSBs, payload travels as text metadata instead
+                metadata.setdefault('Comment', read_info_from_image_stealth(image))
+            if codec == 'jpeg' and image.mode != 'RGB':
+                image = image.convert('RGB')
+            elif image.mode not in ('RGB', 'RGBA'):
+                image = image.convert('RGBA' if 'A' in image.mode or 'transparency' in image.info else 'RGB')
+            image.save(temp_path, codec.upper(), **_save_options(codec, quality, effort, lossless, metadata))
+        if stealth_mode is not None and lossless and probe_stealth(temp_path)[0] != stealth_mode:
+            raise ValueError('stealth payload was not preserved')
+        os.replace(temp_path, target)
+    except Exception as exception:
+        record['error'] = f'{type(exception).__name__}: {exception}'
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return record
+    record['lossless'] = lossless
+    record['after'] = os.path.getsize(target)
+    if remove_original and os.path.abspath(source) != os.path.abspath(target):
+        os.remove(source)
+    return record
+
+def _transcode_job(job) -> Dict:
+    return transcode_file(*job)
+
+def transcode_files(files:List[str], codec:str = 'webp', quality:int = 90, effort:int = 4, lossless:Optional[bool] = None,
+                    remove_original:bool = False, workers:int = 8) -> Dict[str, int]:
+    """
+    Transcodes files in process pool, next to the source with the codec's extension. Existing targets are skipped.
+    Prints and returns report with files, skipped, errors, lossless, before and after bytes.
+    """
+    extension = CODEC_EXTENSIONS[codec]
+    jobs = []
+    report = {'files': 0, 'skipped': 0, 'errors': 0, 'lossless': 0, 'before': 0, 'after': 0}
+    for file in files:
+        target = os.path.splitext(file)[0] + extension
+        if os.path.exists(target):
+            report['skipped'] += 1
+            continue
+        jobs.append((file, target, codec, quality, effort, lossless, remove_original))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for record in tqdm(executor.map(_transcode_job, jobs, chunksize=16), total=len(jobs)):
+            if record['error']:
+                report['errors'] += 1
+                print("Error converting", record['source'], record['error'])
+                continue
+            report['files'] += 1
+            report['lossless'] += record['lossless']
+            report['before'] += record['before']
+            report['after'] += record['after']
+    ratio = report['after'] / report['before'] * 100 if report['before'] else 0
+    print(f"Converted {report['files']} files ({report['lossless']} lossless), skipped {report['skipped']}, errors {report['errors']}")
+    print(f"Before: {report['before'] / 1024 / 1024:.2f} MB, After: {report['after'] / 1024 / 1024:.2f} MB, compress ratio: {ratio:.2f}%")
+    return report
+
+def collect_images(path:str, extensions, recursive:bool = False) -> List[str]:
+    files = []
+    if recursive:
+        for root, dirs, filenames in os.walk(path):
+            files.extend(os.path.join(root, file) for file in filenames if file.lower().endswith(extensions))
+    else:
+        with os.scandir(path) as entries:
+            files.extend(entry.path for entry in entries if entry.is_file() and entry.name.lower().endswith(extensions))
+    files.sort()
+    return files
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path', type=str, required=True, help='Folder with images')
+    parser.add_argument('--recursive', action='store_true', help='Recursive')
+    parser.add_argument('--ext', type=str, nargs='+', default=['.png', '.jpg', '.jpeg'], help='Source extensions')
+    parser.add_argument('--codec', type=str, default='webp', choices=list(CODEC_EXTENSIONS), help='Target codec')
+    parser.add_argument('--quality', type=int, default=90, help='Quality of lossy encoding')
+    parser.add_argument('--effort', type=int, default=4, help='0 (fast) .. 6 (smallest)')
+    parser.add_argument('--lossless', dest='lossless', action='store_true', default=None, help='Always lossless, default is lossy except for stealth payloads')
+    parser.add_argument('--lossy', dest='lossless', action='store_false', help='Always lossy, stealth payloads become text metadata')
+    parser.add_argument('--remove-original', action='store_true', help='Remove source after successful conversion')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Worker processes')
+    args = parser.parse_args()
+    files = collect_images(args.path, tuple(ext.lower() for ext in args.ext), args.recursive)
+    print(f"Found {len(files)} files")
+    transcode_files(files, args.codec, args.quality, args.effort, args.lossless, args.remove_original, args.workers)
@@ -0,0 +1,81 @@
+"""
+Caption and tag sidecar conventions shared by the captioning scripts and dataset tools.
+<img>.txt : tags
+<img>_gemini.txt : best generated caption, <img>_gemini_<i>.txt : other generated captions
+<img>_annotated.txt : human refined caption
+"""
+import glob
+import os
+import pathlib
+from typing import List, Optional, Tuple
+
+def get_tags_list(tags:str) -> List[str]:
+    """
+    Removes <x>: types from the tags.
+    """
+    tags = tags.split()
+    return tags
+
+def read_tags(image_path) -> Optional[str]:
+    """
+    Reads .txt tag file of the given image path, None if not exists.
+    """
+    extension = pathlib.Path(image_path).suffix
+    tags_path = image_path.replace(extension, '.txt')
+    if not os.path.exists(tags_path):
+        return None
+    with open(tags_path, 'r',encoding='utf-8') as f:
+        return f.read()
+
+def read_result(image_path):
+    """
+    Reads Generated or Annotated text from the given image path.
+    """
+    extension = pathlib.Path(image_path).suffix
+    if os.path.exists(image_path.replace(extension, '_gemini.txt')):
+        with open(image_path.replace(extension, '_gemini.txt'), 'r',encoding='utf-8') as f:
+            result = f.read()
+    elif os.path.exists(image_path.replace(extension, '_annotated.txt')):
+        with open(image_path.replace(extension, '_annotated.txt'), 'r',encoding='utf-8') as f:
+            result = f.read()
+    else:
+        result = None
+    return result
+
+def sanity_check(tags, result):
+    """
+    Checks if all tags are in the caption.
+    """
+    excluded_tags = ['original', 'error']
+    tags = get_tags_list(tags)
+    tags = [t.replace('_', ' ').replace('-', ' ') for ts in tags for t in ts.split(' ')]
+    if result is None:
+        return tags
+    else:
+        result = result.replace('_', ' ').replace('-', ' ')
+        tags_not_in_caption = [t for t in tags if t.lower() not in result.lower() and t not in excluded_tags]
+        # if tags_not_in_caption:
+        #     return " ".join(tags_not_in_caption)
+        return tags_not_in_caption
+
+def read_best_result(image_path, tags:Optional[str] = None) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Returns (caption, source suffix) for the given image path.
+    read_result is preferred, otherwise the _gemini_<i>.txt with least missing tags is used.
+    """
+    extension = pathlib.Path(image_path).suffix
+    result = read_result(image_path)
+    if result is not None:
+        suffix = '_gemini.txt' if os.path.exists(image_path.replace(extension, '_gemini.txt')) else '_annotated.txt'
+        return result, suffix
+    best, best_suffix, best_count = None, None, float('inf')
+    for candidate_path in glob.glob(glob.escape(image_path[:-len(extension)]) + '_gemini_*.txt'):
+        suffix = candidate_path[len(image_path) - len(extension):]
+        if not suffix[len('_gemini_'):-len('.txt')].isdigit():
+            continue
+        with open(candidate_path, 'r',encoding='utf-8') as f:
+            candidate = f.read()
+        count = len(sanity_check(tags, candidate)) if tags is not None else 0
+        if count < best_count:
+            best, best_suffix, best_count = candidate, suffix, count
+    return best, best_suffix
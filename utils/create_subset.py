@@ -5,15 +5,241 @@ Dataset : Folder containing images and corresponding text files.
 Count : Number of images to be selected.
 Seed : Seed for random number generator.
 Path : Path to the new dataset.
+
+Usage:
+    python -m utils.create_subset --dataset aibooru --count 10000 --seed 42 --path aibooru_subset
 """
-from random import Random
+import errno
+import hashlib
+import heapq
 import os
+import re
 import pathlib
 import shutil
 import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Iterator, List, Optional, Tuple
+import numpy as np
 from tqdm import tqdm
+from utils.storage import is_sharded, ShardedStorage
+try:
+    import fcntl
+except ImportError:
+    fcntl = None # windows
+
+FICLONE = 0x40049409 # linux ioctl, reflink copy on btrfs / xfs
+# "copyright: a b", "general tags: c d", tags themselves may contain ':' (re:zero) but not ': '
+CATEGORY_PATTERN = re.compile(r'^([a-z][a-z ]*):(?:\s|$)(.*)$')
+
+def iter_dataset_files(dataset) -> Iterator[Tuple[str, str]]:
+    """
+    Streams (filename, path) of the dataset without listing everything into memory.
+    Sharded datasets are read from the index.
+    """
+    if is_sharded(dataset):
+        for file_path in ShardedStorage(dataset).list():
+            yield os.path.basename(file_path), file_path
+        return
+    with os.scandir(dataset) as entries:
+        for entry in entries:
+            if entry.is_file():
+                yield entry.name, entry.path
+
+def sample_priority(name:str, seed) -> int:
+    """
+    Seeded random priority of the file. Depends only on name and seed, so the sample does not depend on listing order.
+    """
+    return int.from_bytes(hashlib.blake2b(f'{seed}:{name}'.encode('utf-8'), digest_size=8).digest(), 'big')
+
+def reservoir_sample(files:Iterator[Tuple[str, str]], count:int, seed, filter_func: callable = None, exclude: set = None) -> List[Tuple[str, str]]:
+    """
+    Seeded bottom-k reservoir sampling, keeps count items with the lowest priority. Memory is O(count).
+    filter_func is only evaluated for files which would enter the reservoir.
+    Returns sampled (filename, path) in random order.
+    """
+    heap = [] # max heap by negated priority
+    for name, file_path in files:
+        if name.split('.')[-1] == 'txt':
+            continue
+        priority = sample_priority(name, seed)
+        if len(heap) >= count and -heap[0][0] <= priority:
+            continue
+        if exclude and name in exclude:
+            continue
+        if filter_func and not filter_func(os.path.abspath(file_path)):
+            continue
+        item = (-priority, name, file_path)
+        if len(heap) < count:
+            heapq.heappush(heap, item)
+        else:
+            heapq.heapreplace(heap, item)
+    return [(name, file_path) for _, name, file_path in sorted(heap, reverse=True)]
+
+def parse_tags(text:str) -> Dict[str, List[str]]:
+    """
+    Parses tag file into category -> tags. Lines without category are 'general tags'.
+    rating is kept as single tag, e.g. {'rating': ['general']}
+    """
+    categories = {}
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        match = CATEGORY_PATTERN.match(line)
+        category, tags = (match.group(1), match.group(2)) if match else ('general tags', line)
+        categories.setdefault(category, []).extend(tags.split())
+    return categories
+
+def _read_tag_file(tag_path) -> Optional[Dict[str, List[str]]]:
+    if not os.path.exists(tag_path):
+        return None
+    with open(tag_path, 'r', encoding='utf-8') as f:
+        return parse_tags(f.read())
+
+def read_tags_bulk(file_paths:List[str], dataset_tag_path=None, workers=16) -> List[Optional[Dict[str, List[str]]]]:
+    """
+    Reads tag files of all images in parallel. None if tag file does not exist.
+    """
+    tag_paths = [os.path.join(dataset_tag_path or os.path.dirname(file_path), os.path.basename(file_path).split('.')[0] + '.txt') for file_path in file_paths]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(tqdm(executor.map(_read_tag_file, tag_paths, chunksize=256), total=len(tag_paths), desc='Reading tags'))
+
+def build_tag_table(tag_dicts:List[Optional[Dict[str, List[str]]]], categories:Optional[List[str]] = None):
+    """
+    Builds (item index, tag index) incidence arrays, tag vocabulary and per-tag frequency.
+    Only tags of given categories are used, all categories if None.
+    Returns items, tag_ids, vocab (list of tag), frequency (array)
+    """
+    vocab = {}
+    items, tag_ids = [], []
+    for i, tag_dict in enumerate(tag_dicts):
+        if not tag_dict:
+            continue
+        for category, tags in tag_dict.items():
+            if categories is not None and category not in categories:
+                continue
+            for tag in tags:
+                items.append(i)
+                tag_ids.append(vocab.setdefault(tag, len(vocab)))
+    items = np.asarray(items, dtype=np.int64)
+    tag_ids = np.asarray(tag_ids, dtype=np.int64)
+    frequency = np.bincount(tag_ids, minlength=len(vocab))
+    return items, tag_ids, list(vocab), frequency
+
+def balanced_order(tag_dicts:List[Optional[Dict[str, List[str]]]], seed, categories:Optional[List[str]] = None,
+                   balance_tags:Optional[List[str]] = None, cap_per_stratum:Optional[int] = None) -> Tuple[np.ndarray, np.ndarray, List[str]]:
+    """
+    Assigns every item to the stratum of its rarest tag (among balance_tags if given), then orders items
+    round-robin over strata in seeded random order, so any prefix of the order is balanced and covers rare tags first.
+    Items without matching tag are excluded. Each stratum contributes at most cap_per_stratum items.
+    Returns (item order, stratum of each ordered item, vocab)
+    """
+    items, tag_ids, vocab, frequency = build_tag_table(tag_dicts, categories)
+    if balance_tags is not None:
+        allowed = np.isin(np.asarray(vocab, dtype=object), list(balance_tags))
+        mask = allowed[tag_ids]
+        items, tag_ids = items[mask], tag_ids[mask]
+    if not len(items):
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), vocab
+    # rarest tag of each item: sort pairs by (item, frequency, tag) and take the first pair of each item
+    pair_order = np.lexsort((tag_ids, frequency[tag_ids], items))
+    items, tag_ids = items[pair_order], tag_ids[pair_order]
+    unique_items, first = np.unique(items, return_index=True)
+    strata = tag_ids[first]
+    keys = np.random.default_rng(seed).random(len(tag_dicts))[unique_items]
+    # rank inside stratum, by random key
+    order = np.lexsort((keys, strata))
+    sorted_strata = strata[order]
+    stratum_start = np.r_[0, np.flatnonzero(np.diff(sorted_strata)) + 1]
+    ranks = np.arange(len(order)) - np.repeat(stratum_start, np.diff(np.r_[stratum_start, len(order)]))
+    if cap_per_stratum is not None:
+        keep = ranks < cap_per_stratum
+        order, ranks = order[keep], ranks[keep]
+    # round robin: all rank 0 first, then rank 1...
+    round_robin = np.lexsort((keys[order], ranks))
+    selected = order[round_robin]
+    return unique_items[selected], strata[selected], vocab
+
+def copy_file(source, target):
+    """
+    Copies file, prefers reflink, then copy_file_range, then falls back to regular copy.
+    """
+    if fcntl is not None and hasattr(os, 'copy_file_range'):
+        try:
+            with open(source, 'rb') as src, open(target, 'wb') as dst:
+                try:
+                    fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                    remaining = 0
+                except OSError:
+                    remaining = os.fstat(src.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(src.fileno(), dst.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+            if remaining == 0:
+                shutil.copymode(source, target)
+                return
+        except OSError as exception:
+            if exception.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+    shutil.copy(source, target)
+
+def hardlink_file(source, target):
+    """
+    Hardlinks file, falls back to copy across devices.
+    """
+    try:
+        os.link(source, target)
+    except OSError:
+        copy_file(source, target)
 
-def create_subset(dataset, count, seed, path, dataset_tag_path=None, filter_func: callable = None, behavior="copy"):
+def symlink_file(source, target):
+    os.symlink(os.path.abspath(source), target)
+
+TRANSFER_FUNCS = {
+    "copy": copy_file,
+    "hardlink": hardlink_file,
+    "symlink": symlink_file,
+    "move": shutil.move,
+}
+
+def transfer_sample(file_path, target_dir, transfer_func, dataset_tag_path=None):
+    """
+    Transfers image and its tag sidecar.
+    """
+    file = os.path.basename(file_path)
+    transfer_func(file_path, os.path.join(target_dir, file))
+    file_base = file.split('.')[0]
+    tag_path = os.path.join(dataset_tag_path or os.path.dirname(file_path), file_base + '.txt')
+    target_tag_path = os.path.join(target_dir, file_base + '.txt')
+    if os.path.exists(tag_path) and not os.path.exists(target_tag_path):
+        transfer_func(tag_path, target_tag_path)
+
+def create_balanced_subset_samples(dataset, count, seed, dataset_tag_path=None, filter_func: callable = None, exclude: set = None,
+                                   categories:Optional[List[str]] = None, balance_tags:Optional[List[str]] = None,
+                                   cap_per_stratum:Optional[int] = None, workers=16) -> List[Tuple[str, str]]:
+    """
+    Samples (filename, path) balanced over strata, see balanced_order.
+    filter_func is evaluated in selection order until count files are selected.
+    """
+    files = [(name, file_path) for name, file_path in iter_dataset_files(dataset)
+             if name.split('.')[-1] != 'txt' and not (exclude and name in exclude)]
+    tag_dicts = read_tags_bulk([file_path for _, file_path in files], dataset_tag_path, workers)
+    order, strata, vocab = balanced_order(tag_dicts, seed, categories, balance_tags, cap_per_stratum)
+    print("Strata : ", len(np.unique(strata)), ", candidates : ", len(order))
+    samples = []
+    for i in order:
+        if len(samples) >= count:
+            break
+        if filter_func and not filter_func(os.path.abspath(files[i][1])):
+            continue
+        samples.append(files[i])
+    return samples
+
+def create_subset(dataset, count, seed, path, dataset_tag_path=None, filter_func: callable = None, behavior="copy", workers=8,
+                  strategy="uniform", categories:Optional[List[str]] = None, balance_tags:Optional[List[str]] = None,
+                  cap_per_stratum:Optional[int] = None):
     """
     Creates subset from the original dataset.
     Dataset : Folder containing images and corresponding text files.
@@ -22,54 +248,42 @@ def create_subset(dataset, count, seed, path, dataset_tag_path=None, filter_func
     Path : Path to the new dataset.
     Dataset_tag_path : Path to the dataset tags.
     Filter_func : Function to filter the files. (filename) -> bool
+    Behavior : copy, hardlink, symlink, move
+    Workers : Number of parallel transfers.
+    Strategy : uniform, or balanced (over the rarest tag of each image, see balanced_order).
+    Categories : Tag categories used by balanced strategy, e.g. ['character'] or ['rating']. All if None.
+    Balance_tags : Only these tags define strata in balanced strategy.
+    Cap_per_stratum : Max images per stratum in balanced strategy.
     """
     # Create the folder if it doesn't exist.
-    # if exists and files are present, then it will throw an error.
-    if behavior == "copy":
-        copyfunc = shutil.copy
-    elif behavior == "symlink":
-        copyfunc = os.symlink
-    elif behavior == "move":
-        copyfunc = shutil.move
+    if behavior not in TRANSFER_FUNCS:
+        raise ValueError(f"Unknown behavior {behavior}, expected one of {list(TRANSFER_FUNCS)}")
+    transfer_func = TRANSFER_FUNCS[behavior]
     pathlib.Path(path).mkdir(parents=True, exist_ok=True)
     if count <= 0:
-        return
-    # count files in subset folder.
-    files = os.listdir(path)
-    print("Files in subset folder : ", len(files))
-    # Get all the files in the dataset.
-    files = os.listdir(dataset)
-    # exclude the text files.
-    files = [file for file in files if file.split('.')[-1] != 'txt']
-    print("Sampling from : ", len(files), " files.")
-    # Shuffle the files.
-    Random(seed).shuffle(files)
-    # Copy the first count files to the new dataset.
-    moved = 0
-    pbar = tqdm(total=count)
-    for file in files:
-        if moved >= count:
-            break
-        if filter_func and not filter_func(os.path.abspath(os.path.join(dataset, file))):
-            continue
-        #print(f"Copying {file} to {path}")
-        # if already exists, then skip.
-        if os.path.exists(os.path.join(path, file)):
-            continue
-        target_path = os.path.join(path, file)
-        copyfunc(os.path.join(dataset, file), target_path)
-        moved += 1
-        pbar.update(1)
-        # Copy the corresponding text file.
-        if os.path.exists(os.path.join(path, file.split('.')[0] + '.txt')):
-            continue
-        if dataset_tag_path:
-            file_base = file.split('.')[0]
-            if os.path.exists(os.path.join(dataset_tag_path, file_base + '.txt')):
-                copyfunc(os.path.join(dataset_tag_path, file_base + '.txt'), os.path.join(path, file_base + '.txt'))
-        else:
-            if os.path.exists(os.path.join(dataset, file.split('.')[0] + '.txt')):
-                copyfunc(os.path.join(dataset, file.split('.')[0] + '.txt'), os.path.join(path, file.split('.')[0] + '.txt'))
+        return []
+    # files already in subset folder are skipped.
+    with os.scandir(path) as entries:
+        existing = {entry.name for entry in entries}
+    print("Files in subset folder : ", len(existing))
+    if strategy == "uniform":
+        samples = reservoir_sample(iter_dataset_files(dataset), count, seed, filter_func, existing)
+    elif strategy == "balanced":
+        samples = create_balanced_subset_samples(dataset, count, seed, dataset_tag_path, filter_func, existing,
+                                                 categories, balance_tags, cap_per_stratum)
+    else:
+        raise ValueError(f"Unknown strategy {strategy}")
+    print("Sampled : ", len(samples), " files.")
+    transferred = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(transfer_sample, file_path, path, transfer_func, dataset_tag_path): file for file, file_path in samples}
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            try:
+                future.result()
+                transferred.append(futures[future])
+            except Exception as exception:
+                print(f"Failed to transfer {futures[future]} : {exception}")
+    return transferred
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -79,7 +293,14 @@ if __name__ == "__main__":
     parser.add_argument('--path', type=str, required=True, help='Path to the new dataset.')
     parser.add_argument('--dataset_tag_path', type=str, required=False, help='Path to the dataset tags.')
     # behavior
-    parser.add_argument('--behavior', type=str, required=False, default="copy", help='Behavior for copying files. copy, symlink, move')
+    parser.add_argument('--behavior', type=str, required=False, default="copy", help='Behavior for copying files. copy, hardlink, symlink, move')
+    parser.add_argument('--workers', type=int, required=False, default=8, help='Number of parallel transfers.')
+    # sampling strategy
+    parser.add_argument('--strategy', type=str, required=False, default="uniform", help='Sampling strategy. uniform, balanced')
+    parser.add_argument('--categories', type=str, nargs='*', required=False, default=None, help='Tag categories to balance over, e.g. character rating.')
+    parser.add_argument('--balance_tags', type=str, nargs='*', required=False, default=None, help='Only these tags define strata.')
+    parser.add_argument('--cap_per_stratum', type=int, required=False, default=None, help='Max images per stratum.')
     # include and exclude behavior
     args = parser.parse_args()
-    create_subset(args.dataset, args.count, args.seed, args.path, args.dataset_tag_path, behavior=args.behavior)
\ No newline at end of file
+    create_subset(args.dataset, args.count, args.seed, args.path, args.dataset_tag_path, behavior=args.behavior, workers=args.workers,
+                  strategy=args.strategy, categories=args.categories, balance_tags=args.balance_tags, cap_per_stratum=args.cap_per_stratum)
@@ -0,0 +1,252 @@
+"""
+Duplicate detection across dataset roots.
+Keeps an exact md5 set and a perceptual hash (dHash) index, searchable by Hamming distance with a BK-tree.
+
+Usage:
+    python -m utils.dedup --roots aibooru local_dataset --index dedup_index.json
+    python -m utils.dedup --roots aibooru --index dedup_index.json --report
+"""
+import argparse
+import hashlib
+import io
+import json
+import os
+import re
+from typing import Dict, List, Optional, Tuple, Union
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+IMAGE_EXTS = ('.jpg', '.jpeg', '.png', '.webp', '.gif')
+MD5_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+def md5_bytes(data: bytes) -> str:
+    """
+    Returns md5 hex digest of given bytes.
+    """
+    return hashlib.md5(data).hexdigest()
+
+def md5_file(path: str, chunk_size: int = 1 << 20) -> str:
+    """
+    Returns md5 hex digest of given file, read in chunks.
+    """
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+def perceptual_hash(image: Union[str, bytes, Image.Image], hash_size: int = 8) -> int:
+    """
+    Returns difference hash (dHash) of the image as integer of hash_size * hash_size bits.
+    Robust to re-encoding and resizing, which covers most reposts.
+    """
+    if isinstance(image, bytes):
+        image = Image.open(io.BytesIO(image))
+    elif isinstance(image, str):
+        image = Image.open(image)
+    # draft lets JPEG decoder downscale while decoding
+    image.draft('L', (hash_size * 8, hash_size * 8))
+    pixels = np.asarray(image.convert('L').resize((hash_size + 1, hash_size), Image.LANCZOS), dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+def hamming_distance(hash_a: int, hash_b: int) -> int:
+    """
+    Returns number of different bits between two hashes.
+    """
+    return bin(hash_a ^ hash_b).count('1')
+
+class BKTree:
+    """
+    BK-tree over integer hashes with Hamming distance.
+    Each node is [hash, items, children], children maps distance to node.
+    """
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, hash_value: int, item) -> None:
+        """
+        Adds item with given hash. Items with identical hash share the node.
+        """
+        self.size += 1
+        if self.root is None:
+            self.root = [hash_value, [item], {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming_distance(hash_value, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [hash_value, [item], {}]
+                return
+            node = child
+
+    def search(self, hash_value: int, max_distance: int) -> List[Tuple[int, object]]:
+        """
+        Returns (distance, item) for all items within max_distance, sorted by distance.
+        """
+        if self.root is None:
+            return []
+        results = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            distance = hamming_distance(hash_value, node[0])
+            if distance <= max_distance:
+                results.extend((distance, item) for item in node[1])
+            # triangle inequality, only children in [d - max, d + max] can match
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        results.sort(key=lambda x: x[0])
+        return results
+
+    def __len__(self):
+        return self.size
+
+class DedupIndex:
+    """
+    Exact (md5) and perceptual (dHash) duplicate index over one or more dataset roots.
+    """
+    def __init__(self, max_distance: int = 4, hash_size: int = 8):
+        self.max_distance = max_distance
+        self.hash_size = hash_size
+        self.md5s: Dict[str, str] = {} # md5 -> path
+        self.entries: Dict[str, Tuple[str, int]] = {} # path -> (md5, phash)
+        self.tree = BKTree()
+
+    def add(self, path: str, md5: Optional[str] = None, phash: Optional[int] = None) -> None:
+        """
+        Adds image to the index. md5 and phash are computed if not given.
+        """
+        path = os.path.abspath(path)
+        if path in self.entries:
+            return
+        if md5 is None:
+            md5 = md5_file(path)
+        if phash is None:
+            phash = perceptual_hash(path, self.hash_size)
+        self.entries[path] = (md5, phash)
+        self.md5s.setdefault(md5, path)
+        self.tree.add(phash, path)
+
+    def has_md5(self, md5: str) -> bool:
+        """
+        Returns True if exact duplicate exists.
+        """
+        return md5 in self.md5s
+
+    def find_duplicates(self, image: Union[str, bytes], max_distance: Optional[int] = None) -> List[Tuple[int, str]]:
+        """
+        Returns (distance, path) of indexed duplicates of given image path or bytes, nearest first.
+        Exact md5 matches are returned with distance 0.
+        """
+        if max_distance is None:
+            max_distance = self.max_distance
+        md5, phash = None, None
+        if isinstance(image, bytes):
+            md5 = md5_bytes(image)
+        elif os.path.abspath(image) in self.entries:
+            md5, phash = self.entries[os.path.abspath(image)]
+        else:
+            md5 = md5_file(image)
+        results = [(0, self.md5s[md5])] if md5 in self.md5s else []
+        if phash is None:
+            phash = perceptual_hash(image, self.hash_size)
+        results.extend(result for result in self.tree.search(phash, max_distance) if result[1] != self.md5s.get(md5))
+        return results
+
+    def add_root(self, root: str, recursive: bool = True) -> int:
+        """
+        Indexes all images under root. Already indexed paths are skipped.
+        Crawled files are named <md5>.<ext>, for those the filename is used as md5 instead of reading the file.
+        Returns number of newly indexed images.
+        """
+        paths = []
+        if recursive:
+            for dirpath, _, files in os.walk(root):
+                paths.extend(os.path.join(dirpath, file) for file in files if os.path.splitext(file)[-1].lower() in IMAGE_EXTS)
+        else:
+            with os.scandir(root) as entries:
+                paths.extend(entry.path for entry in entries if entry.is_file() and os.path.splitext(entry.name)[-1].lower() in IMAGE_EXTS)
+        added = 0
+        for path in tqdm(paths, desc=f'Indexing {root}'):
+            if os.path.abspath(path) in self.entries:
+                continue
+            stem = os.path.splitext(os.path.basename(path))[0].lower()
+            md5 = stem if MD5_PATTERN.match(stem) else None
+            try:
+                self.add(path, md5=md5)
+            except Exception as exception:
+                print(f"Failed to index {path}: {exception}")
+                continue
+            added += 1
+        return added
+
+    def duplicate_groups(self) -> List[List[str]]:
+        """
+        Returns groups of paths which are duplicates of each other (groups of size > 1).
+        """
+        visited = set()
+        groups = []
+        for path, (_, phash) in self.entries.items():
+            if path in visited:
+                continue
+            group = [p for _, p in self.tree.search(phash, self.max_distance) if p not in visited]
+            visited.update(group)
+            if len(group) > 1:
+                groups.append(group)
+        return groups
+
+    def save(self, path: str) -> None:
+        """
+        Saves index as json.
+        """
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({
+                'max_distance': self.max_distance,
+                'hash_size': self.hash_size,
+                'entries': [[p, md5, f'{phash:x}'] for p, (md5, phash) in self.entries.items()],
+            }, f)
+
+    @staticmethod
+    def load(path: str) -> "DedupIndex":
+        """
+        Loads index saved with save().
+        """
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        index = DedupIndex(max_distance=data['max_distance'], hash_size=data['hash_size'])
+        for p, md5, phash in data['entries']:
+            index.add(p, md5=md5, phash=int(phash, 16))
+        return index
+
+def load_or_create_index(path: Optional[str], max_distance: int = 4) -> DedupIndex:
+    """
+    Loads index from path if exists, else returns empty index.
+    """
+    if path and os.path.exists(path):
+        return DedupIndex.load(path)
+    return DedupIndex(max_distance=max_distance)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--roots', type=str, nargs='+', required=True, help='Dataset roots to index')
+    parser.add_argument('--index', type=str, default='dedup_index.json', help='Index file, updated incrementally')
+    parser.add_argument('--max-distance', type=int, default=4, help='Max Hamming distance to consider as duplicate')
+    parser.add_argument('--no-recursive', action='store_true', help='Only index top level of each root')
+    parser.add_argument('--report', action='store_true', help='Print duplicate groups')
+    args = parser.parse_args()
+    dedup_index = load_or_create_index(args.index, args.max_distance)
+    dedup_index.max_distance = args.max_distance
+    for root in args.roots:
+        print(f"Indexed {dedup_index.add_root(root, recursive=not args.no_recursive)} new images from {root}")
+    dedup_index.save(args.index)
+    if args.report:
+        for group in dedup_index.duplicate_groups():
+            print(' | '.join(group))
@@ -0,0 +1,150 @@
+"""
+Exports dataset (image + tags + caption) into size bounded tar shards, readable by WebDataset.
+Each sample is stored as <key>.<image ext>, <key>.txt (caption), <key>.tags (tags), <key>.json (metadata).
+Image bytes are copied without re-encoding.
+index.jsonl holds byte offsets of each member for random access: tar can be read with f.seek(offset); f.read(size).
+
+Usage:
+    python -m utils.export_shards --dataset aibooru --output aibooru_shards --max-shard-size 1024 --seed 42 --workers 8
+"""
+import argparse
+import io
+import json
+import os
+import pathlib
+import tarfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from random import Random
+from typing import Dict, List, Optional
+from PIL import Image
+from tqdm import tqdm
+from utils.captions import read_best_result, read_tags, sanity_check, get_tags_list
+from utils.storage import list_files
+
+IMAGE_EXTS = ('.jpg', '.jpeg', '.png', '.webp', '.gif')
+
+def collect_samples(dataset:str, require_caption:bool = True) -> List[Dict]:
+    """
+    Collects samples from the dataset, picks the best caption with read_best_result.
+    """
+    samples = []
+    for image_path in tqdm(list_files(dataset), desc='Collecting'):
+        extension = pathlib.Path(image_path).suffix
+        if extension.lower() not in IMAGE_EXTS:
+            continue
+        tags = read_tags(image_path)
+        caption, caption_source = read_best_result(image_path, tags)
+        if caption is None and require_caption:
+            continue
+        samples.append({
+            'key': os.path.basename(image_path)[:-len(extension)].replace('.', '_'), # webdataset splits key at first dot
+            'image_path': image_path,
+            'caption': caption,
+            'caption_source': caption_source,
+            'tags': tags,
+            'size': os.path.getsize(image_path) + len((caption or '').encode('utf-8')) + len((tags or '').encode('utf-8')),
+        })
+    return samples
+
+def plan_shards(samples:List[Dict], max_shard_size:int, max_shard_samples:Optional[int] = None) -> List[List[Dict]]:
+    """
+    Splits samples into consecutive shards bounded by byte size and sample count.
+    """
+    shards = [[]]
+    current_size = 0
+    for sample in samples:
+        full = max_shard_samples is not None and len(shards[-1]) >= max_shard_samples
+        if shards[-1] and (current_size + sample['size'] > max_shard_size or full):
+            shards.append([])
+            current_size = 0
+        shards[-1].append(sample)
+        current_size += sample['size']
+    return [shard for shard in shards if shard]
+
+def _add_bytes(tar:tarfile.TarFile, name:str, data:bytes, mtime:float) -> List[int]:
+    """
+    Adds bytes as tar member, returns [offset, size] of the data inside the tar file.
+    """
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = mtime
+    tar.addfile(info, io.BytesIO(data))
+    # data is padded to blocks and ends at the current position, headers (long names) may vary in size
+    padded_size = -(-info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+    return [tar.offset - padded_size, info.size]
+
+def write_shard(shard_path:str, samples:List[Dict]) -> List[Dict]:
+    """
+    Writes one shard through temp file and rename. Returns index entries of the samples.
+    """
+    index_entries = []
+    temp_path = shard_path + '.tmp'
+    shard_name = os.path.basename(shard_path)
+    with tarfile.open(temp_path, 'w', format=tarfile.GNU_FORMAT) as tar:
+        for sample in samples:
+            key = sample['key']
+            mtime = os.path.getmtime(sample['image_path']) # keeps shards reproducible
+            extension = pathlib.Path(sample['image_path']).suffix.lower()
+            with open(sample['image_path'], 'rb') as f:
+                image_bytes = f.read()
+            try:
+                with Image.open(io.BytesIO(image_bytes)) as image:
+                    width, height = image.size # header only, no decode
+            except Exception:
+                width, height = None, None
+            missing_tags = sanity_check(sample['tags'], sample['caption']) if sample['tags'] is not None else []
+            tag_count = len(get_tags_list(sample['tags'])) if sample['tags'] is not None else 0
+            metadata = {
+                'key': key,
+                'source': sample['image_path'],
+                'caption_source': sample['caption_source'],
+                'width': width,
+                'height': height,
+                'missing_tags': missing_tags,
+                'sanity_score': 1 - len(missing_tags) / tag_count if tag_count else None,
+            }
+            members = {extension.lstrip('.'): _add_bytes(tar, key + extension, image_bytes, mtime)}
+            if sample['caption'] is not None:
+                members['txt'] = _add_bytes(tar, key + '.txt', sample['caption'].encode('utf-8'), mtime)
+            if sample['tags'] is not None:
+                members['tags'] = _add_bytes(tar, key + '.tags', sample['tags'].encode('utf-8'), mtime)
+            members['json'] = _add_bytes(tar, key + '.json', json.dumps(metadata, ensure_ascii=False).encode('utf-8'), mtime)
+            index_entries.append({'key': key, 'shard': shard_name, 'members': members})
+    os.replace(temp_path, shard_path)
+    return index_entries
+
+def export_shards(dataset:str, output:str, max_shard_size:int = 1 << 30, max_shard_samples:Optional[int] = None,
+                  seed:int = 0, workers:int = 4, require_caption:bool = True) -> int:
+    """
+    Exports dataset into shards. Sample order is deterministic for the same seed and dataset.
+    Returns number of written shards.
+    """
+    os.makedirs(output, exist_ok=True)
+    samples = collect_samples(dataset, require_caption)
+    samples.sort(key=lambda x: x['image_path']) # listing order is filesystem dependent
+    Random(seed).shuffle(samples)
+    shards = plan_shards(samples, max_shard_size, max_shard_samples)
+    print(f"Writing {len(samples)} samples into {len(shards)} shards")
+    shard_entries = [None] * len(shards)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(write_shard, os.path.join(output, f'shard-{i:06d}.tar'), shard): i for i, shard in enumerate(shards)}
+        for future in tqdm(as_completed(futures), total=len(futures), desc='Writing shards'):
+            shard_entries[futures[future]] = future.result()
+    with open(os.path.join(output, 'index.jsonl'), 'w', encoding='utf-8') as f:
+        for entries in shard_entries:
+            for entry in entries:
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+    return len(shards)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', type=str, required=True, help='Dataset folder, flat or sharded')
+    parser.add_argument('--output', type=str, required=True, help='Output folder for shards')
+    parser.add_argument('--max-shard-size', type=int, default=1024, help='Max shard size in MB')
+    parser.add_argument('--max-shard-samples', type=int, default=None, help='Max samples per shard')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for deterministic shuffle')
+    parser.add_argument('--workers', type=int, default=4, help='Parallel shard writers')
+    parser.add_argument('--allow-missing-caption', action='store_true', help='Export images without caption')
+    args = parser.parse_args()
+    export_shards(args.dataset, args.output, args.max_shard_size * 1024 * 1024, args.max_shard_samples,
+                  args.seed, args.workers, require_caption=not args.allow_missing_caption)
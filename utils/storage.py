@@ -0,0 +1,284 @@
+"""
+Sharded content-addressed storage layout for datasets.
+Files are stored as <root>/ab/cd/<key>.* where abcd is the md5 prefix of the key, so sidecars
+(<key>.txt, <key>_gemini.txt, ...) stay in the same directory as their image.
+Listing goes through the index file (one relative path per line) instead of readdir.
+
+Usage:
+    python -m utils.storage migrate --src aibooru --dst aibooru_sharded
+    python -m utils.storage reindex --root aibooru_sharded
+"""
+import argparse
+import fnmatch
+import hashlib
+import os
+import re
+import shutil
+import threading
+from typing import Dict, List, Optional
+from tqdm import tqdm
+
+INDEX_FILE = 'index.txt'
+INDEX_HEADER = re.compile(r'# depth=(\d+) width=(\d+)')
+MD5_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+# sidecars share the key of the image they belong to
+SIDECAR_SUFFIX_PATTERN = re.compile(r'(_gemini(_\d+|_request|_error)?|_annotated|_gpt4|_tags)$')
+
+def is_sharded(root: str) -> bool:
+    """
+    Returns True if root is a sharded storage (has an index file starting with the layout header).
+    A plain index.txt of an image folder does not count.
+    """
+    return _read_header(os.path.join(root, INDEX_FILE)) is not None
+
+def _read_header(index_path: str) -> Optional[re.Match]:
+    try:
+        with open(index_path, 'r', encoding='utf-8') as f:
+            return INDEX_HEADER.match(f.readline())
+    except (OSError, UnicodeDecodeError):
+        return None
+
+def key_from_filename(filename: str) -> str:
+    """
+    Returns storage key of a file, sidecar suffixes are stripped so sidecars map to their image.
+    <md5>.png, <md5>.txt, <md5>_gemini_1.txt -> <md5>
+    """
+    stem = os.path.basename(filename).split('.')[0]
+    return SIDECAR_SUFFIX_PATTERN.sub('', stem)
+
+class ShardedStorage:
+    """
+    Resolves keys to <root>/ab/cd/ directories and maintains the index file.
+    """
+    def __init__(self, root: str, depth: int = 2, width: int = 2):
+        self.root = root
+        self.depth = depth
+        self.width = width
+        self.lock = threading.Lock()
+        self._indexed = None
+        os.makedirs(root, exist_ok=True)
+        index_path = os.path.join(root, INDEX_FILE)
+        if not os.path.isfile(index_path):
+            with open(index_path, 'w', encoding='utf-8') as f:
+                f.write(f'# depth={depth} width={width}\n')
+        else:
+            # layout of existing storage wins over arguments
+            match = _read_header(index_path)
+            if match is None:
+                raise ValueError(f'{index_path} exists but is not a storage index')
+            self.depth, self.width = int(match.group(1)), int(match.group(2))
+
+    def shard_dir(self, key: str) -> str:
+        """
+        Returns directory for given key. Keys which are not md5 are hashed for the prefix.
+        """
+        digest = key.lower() if MD5_PATTERN.match(key.lower()) else hashlib.md5(key.encode('utf-8')).hexdigest()
+        parts = [digest[i * self.width:(i + 1) * self.width] for i in range(self.depth)]
+        return os.path.join(self.root, *parts)
+
+    def resolve(self, filename: str) -> str:
+        """
+        Returns full path for the filename, e.g. <md5>_gemini.txt -> <root>/ab/cd/<md5>_gemini.txt
+        """
+        filename = os.path.basename(filename)
+        return os.path.join(self.shard_dir(key_from_filename(filename)), filename)
+
+    def _load_index(self) -> None:
+        if self._indexed is not None:
+            return
+        self._indexed = {}
+        with open(os.path.join(self.root, INDEX_FILE), 'r', encoding='utf-8') as f:
+            for line in f:
+                relative_path = line.rstrip('\n')
+                if relative_path and not relative_path.startswith('#'):
+                    self._indexed[relative_path] = None # dict keeps insertion order
+
+    def register(self, path: str) -> None:
+        """
+        Adds already written file under root to the index.
+        """
+        relative_path = os.path.relpath(path, self.root).replace(os.sep, '/')
+        with self.lock:
+            self._load_index()
+            if relative_path in self._indexed:
+                return
+            self._indexed[relative_path] = None
+            with open(os.path.join(self.root, INDEX_FILE), 'a', encoding='utf-8') as f:
+                f.write(relative_path + '\n')
+
+    def put(self, source: str, move: bool = False) -> str:
+        """
+        Copies or moves the file into storage and registers it. Returns the stored path.
+        """
+        target = self.resolve(source)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if move:
+            shutil.move(source, target)
+        else:
+            shutil.copy2(source, target)
+        self.register(target)
+        return target
+
+    def exists(self, filename: str) -> bool:
+        """
+        Returns True if filename is indexed.
+        """
+        relative_path = os.path.relpath(self.resolve(filename), self.root).replace(os.sep, '/')
+        with self.lock:
+            self._load_index()
+            return relative_path in self._indexed
+
+    def list(self, pattern: str = '*') -> List[str]:
+        """
+        Returns full paths of indexed files whose filename matches the pattern.
+        """
+        with self.lock:
+            self._load_index()
+            relative_paths = list(self._indexed)
+        return [os.path.join(self.root, *p.split('/')) for p in relative_paths if fnmatch.fnmatch(p.rsplit('/', 1)[-1], pattern)]
+
+    def rebuild_index(self) -> int:
+        """
+        Rewrites the index from the directory tree. Returns number of indexed files.
+        """
+        relative_paths = []
+        for dirpath, _, files in os.walk(self.root):
+            for file in files:
+                if dirpath == self.root and file == INDEX_FILE:
+                    continue
+                relative_paths.append(os.path.relpath(os.path.join(dirpath, file), self.root).replace(os.sep, '/'))
+        relative_paths.sort()
+        with self.lock:
+            temp_path = os.path.join(self.root, INDEX_FILE + '.tmp')
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                f.write(f'# depth={self.depth} width={self.width}\n')
+                f.writelines(p + '\n' for p in relative_paths)
+            os.replace(temp_path, os.path.join(self.root, INDEX_FILE))
+            self._indexed = dict.fromkeys(relative_paths)
+        return len(relative_paths)
+
+_storages: Dict[str, ShardedStorage] = {}
+_storages_lock = threading.Lock()
+
+def get_storage(root: str) -> ShardedStorage:
+    """
+    Returns shared ShardedStorage of root, so the index is read once per process and writers share its lock.
+    """
+    root = os.path.abspath(root)
+    with _storages_lock:
+        if root not in _storages:
+            _storages[root] = ShardedStorage(root)
+        return _storages[root]
+
+def find_root(path: str, max_depth: int = 4) -> Optional[str]:
+    """
+    Returns the sharded storage root holding path, None for flat folders.
+    The root is the nearest parent with a storage index, and path must sit exactly at its shard depth.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    for level in range(max_depth + 1):
+        match = _read_header(os.path.join(directory, INDEX_FILE))
+        if match is not None:
+            return directory if level == int(match.group(1)) else None
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            break
+        directory = parent
+    return None
+
+def register_path(path: str) -> None:
+    """
+    Adds a file written next to dataset files (sidecars, downloads) to the index of its storage, no-op for flat folders.
+    """
+    root = find_root(path)
+    if root is not None:
+        get_storage(root).register(os.path.abspath(path))
+
+def list_files(root: str, pattern: str = '*') -> List[str]:
+    """
+    Lists files matching the pattern in a flat folder or a sharded storage.
+    Scripts should use this instead of glob / listdir so both layouts work.
+    """
+    if is_sharded(root):
+        return get_storage(root).list(pattern)
+    with os.scandir(root) as entries:
+        return [entry.path for entry in entries if entry.is_file() and fnmatch.fnmatch(entry.name, pattern)]
+
+def resolve_path(root: str, filename: str) -> str:
+    """
+    Returns path of filename inside root, for both flat and sharded layouts. Shard directories are created.
+    Writers should register_path the file once written.
+    """
+    if is_sharded(root):
+        path = get_storage(root).resolve(filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+    return os.path.join(root, os.path.basename(filename))
+
+def migrate(source: str, target: str, move: bool = True, depth: int = 2, width: int = 2, batch_size: int = 1000) -> int:
+    """
+    Converts a flat folder into sharded storage. Returns number of migrated files.
+    The index is appended every batch_size files. Rerunning an interrupted migration rebuilds the index first,
+    so files moved after the last append are listed again, then moves the rest.
+    Files already indexed are not appended again, copies of them are skipped.
+    """
+    resuming = is_sharded(target)
+    storage = ShardedStorage(target, depth=depth, width=width)
+    if resuming:
+        storage.rebuild_index()
+    storage._load_index()
+    indexed = storage._indexed
+    with os.scandir(source) as entries:
+        files = [entry.path for entry in entries if entry.is_file()]
+    created_dirs = set()
+    relative_paths = []
+    migrated = 0
+    index_path = os.path.join(target, INDEX_FILE)
+    for file in tqdm(files, desc='Migrating'):
+        target_path = storage.resolve(file)
+        relative_path = os.path.relpath(target_path, target).replace(os.sep, '/')
+        if relative_path in indexed and not move:
+            continue
+        target_dir = os.path.dirname(target_path)
+        if target_dir not in created_dirs:
+            os.makedirs(target_dir, exist_ok=True)
+            created_dirs.add(target_dir)
+        if move:
+            shutil.move(file, target_path)
+        else:
+            shutil.copy2(file, target_path)
+        if relative_path in indexed:
+            continue # left in source by an interrupted move, already listed
+        indexed[relative_path] = None
+        relative_paths.append(relative_path)
+        if len(relative_paths) >= batch_size:
+            _append_index(index_path, relative_paths)
+            migrated += len(relative_paths)
+            relative_paths = []
+    _append_index(index_path, relative_paths)
+    return migrated + len(relative_paths)
+
+def _append_index(index_path: str, relative_paths: List[str]) -> None:
+    # one append per batch instead of one write per file
+    if relative_paths:
+        with open(index_path, 'a', encoding='utf-8') as f:
+            f.writelines(p + '\n' for p in relative_paths)
+            f.flush()
+            os.fsync(f.fileno())
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    migrate_parser = subparsers.add_parser('migrate', help='Convert flat folder into sharded storage')
+    migrate_parser.add_argument('--src', type=str, required=True, help='Flat folder')
+    migrate_parser.add_argument('--dst', type=str, required=True, help='Sharded storage root')
+    migrate_parser.add_argument('--copy', action='store_true', help='Copy instead of move')
+    migrate_parser.add_argument('--depth', type=int, default=2, help='Number of directory levels')
+    migrate_parser.add_argument('--width', type=int, default=2, help='Hex characters per level')
+    reindex_parser = subparsers.add_parser('reindex', help='Rebuild index file from directory tree')
+    reindex_parser.add_argument('--root', type=str, required=True, help='Sharded storage root')
+    args = parser.parse_args()
+    if args.command == 'migrate':
+        print(f"Migrated {migrate(args.src, args.dst, move=not args.copy, depth=args.depth, width=args.width)} files")
+    else:
+        print(f"Indexed {ShardedStorage(args.root).rebuild_index()} files")